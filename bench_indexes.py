@@ -0,0 +1,127 @@
+"""Time the CRM hot queries on a synthetic tenant with and without CLIENT_INDEXES.
+
+    python bench_indexes.py --customers 200000 --repeat 5
+"""
+import argparse
+import random
+import sqlite3
+import tempfile
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from crm5 import (CLIENT_INDEXES, SchemaMigrator, apply_sqlite_profile,
+                  create_client_indexes, drop_client_indexes)
+
+STAGES = ["Prospecting", "Qualification", "Proposal", "Negotiation", "Closed Won", "Closed Lost"]
+TASK_STATUSES = ["Not Started", "In Progress", "Completed", "Delayed"]
+
+# name -> (sql, params factory); mirrors the queries in crm5.py
+HOT_QUERIES = {
+    "recent activities": ("""
+        SELECT contacts.date, customers.name as customer_name, contacts.type, contacts.notes
+        FROM contacts
+        JOIN customers ON contacts.customer_id = customers.id
+        ORDER BY contacts.date DESC
+        LIMIT 10""", lambda n: ()),
+    "contacts for customer": ("""
+        SELECT COUNT(*) FROM contacts WHERE customer_id=?""",
+        lambda n: (random.randint(1, n),)),
+    "deals for customer": ("""
+        SELECT * FROM deals WHERE customer_id=?""", lambda n: (random.randint(1, n),)),
+    "tasks for customer": ("""
+        SELECT * FROM tasks WHERE customer_id=?""", lambda n: (random.randint(1, n),)),
+    "deals in stage": ("""
+        SELECT COUNT(*), SUM(amount) FROM deals WHERE stage=?""",
+        lambda n: (random.choice(STAGES),)),
+    "tasks due on day": ("""
+        SELECT COUNT(*) FROM tasks WHERE due_date >= ? AND due_date < ? AND status != 'Completed'""",
+        lambda n: _day_range()),
+    "leads by score": ("""
+        SELECT name, lead_score FROM customers WHERE status='Lead'
+        ORDER BY lead_score DESC LIMIT 50""", lambda n: ()),
+}
+
+
+def _day_range():
+    day = datetime(2024, 1, 1) + timedelta(days=random.randint(0, 730))
+    return day.strftime("%Y-%m-%d"), (day + timedelta(days=1)).strftime("%Y-%m-%d")
+
+
+def build_tenant(db_path, customers, seed=42):
+    """Create a migrated client database filled with synthetic rows"""
+    rng = random.Random(seed)
+    conn = apply_sqlite_profile(sqlite3.connect(str(db_path)))
+    SchemaMigrator.migrate(conn)
+    start = datetime(2024, 1, 1)
+
+    def when(days=730):
+        return (start + timedelta(seconds=rng.randint(0, days * 86400))).strftime("%Y-%m-%d %H:%M:%S")
+
+    conn.executemany(
+        "INSERT INTO customers (name, email, company, status, lead_score, created_date) VALUES (?, ?, ?, ?, ?, ?)",
+        ((f"Customer {i}", f"customer{i}@example.com", f"Company {i % 5000}",
+          rng.choice(["Lead", "Customer", "Inactive"]), rng.randint(0, 100), when())
+         for i in range(customers)))
+    conn.executemany(
+        "INSERT INTO contacts (customer_id, type, notes, date) VALUES (?, ?, ?, ?)",
+        ((rng.randint(1, customers), rng.choice(["Email", "Phone", "Meeting", "Note"]),
+          "Synthetic interaction", when()) for _ in range(customers * 5)))
+    conn.executemany(
+        "INSERT INTO deals (customer_id, title, amount, stage, probability, expected_close) VALUES (?, ?, ?, ?, ?, ?)",
+        ((rng.randint(1, customers), "Deal", rng.uniform(500, 50000), rng.choice(STAGES),
+          rng.randint(0, 100), when()) for _ in range(customers * 2)))
+    conn.executemany(
+        "INSERT INTO tasks (customer_id, title, description, due_date, status) VALUES (?, ?, ?, ?, ?)",
+        ((rng.randint(1, customers), "Task", "", when()[:10], rng.choice(TASK_STATUSES))
+         for _ in range(customers * 2)))
+    conn.commit()
+    return conn
+
+
+def time_queries(conn, customers, repeat):
+    """Best-of-repeat latency in milliseconds for each hot query"""
+    timings = {}
+    for name, (sql, params) in HOT_QUERIES.items():
+        best = float("inf")
+        for _ in range(repeat):
+            args = params(customers)
+            started = time.perf_counter()
+            conn.execute(sql, args).fetchall()
+            best = min(best, time.perf_counter() - started)
+        timings[name] = best * 1000
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--customers", type=int, default=100000,
+                        help="customers to generate (contacts x5, deals and tasks x2)")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    db_path = Path(tempfile.mkdtemp()) / "bench_client.db"
+    started = time.perf_counter()
+    conn = build_tenant(db_path, args.customers)
+    print(f"Built {db_path} with {args.customers} customers in {time.perf_counter() - started:.1f}s")
+
+    drop_client_indexes(conn)
+    conn.execute("ANALYZE")
+    before = time_queries(conn, args.customers, args.repeat)
+
+    started = time.perf_counter()
+    create_client_indexes(conn)
+    conn.execute("ANALYZE")
+    conn.commit()
+    print(f"Created {len(CLIENT_INDEXES)} indexes in {time.perf_counter() - started:.1f}s\n")
+    after = time_queries(conn, args.customers, args.repeat)
+
+    print(f"{'query':<24}{'no index (ms)':>15}{'indexed (ms)':>15}{'speedup':>10}")
+    for name in HOT_QUERIES:
+        speedup = before[name] / after[name] if after[name] else float("inf")
+        print(f"{name:<24}{before[name]:>15.2f}{after[name]:>15.2f}{speedup:>9.1f}x")
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -8,10 +8,224 @@ from pathlib import Path
 import icalendar
 import numpy as np
 from sklearn.preprocessing import MinMaxScaler
+from sklearn.cluster import MiniBatchKMeans
+import joblib
+from scipy.signal import lfilter
 import json
 import base64
+import csv
+import gzip
+import io
+import os
+import shutil
+import tempfile
+import pyarrow as pa
+import pyarrow.parquet as pq
+import threading
+import time
+import asyncio
+import smtplib
+from email.message import EmailMessage
+import re
+import string
+import bisect
+import heapq
+from collections import OrderedDict
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+
+
+# PRAGMAs applied to every connection DatabaseManager hands out
+SQLITE_PERFORMANCE_PROFILE = {
+    'journal_mode': 'WAL',          # readers no longer block behind writers
+    'synchronous': 'NORMAL',        # safe with WAL, far fewer fsyncs
+    'cache_size': -65536,           # negative values are KiB (64 MB)
+    'mmap_size': 268435456,         # 256 MB memory-mapped reads
+    'temp_store': 'MEMORY',
+    'busy_timeout': 5000,           # milliseconds
+}
+
+_SYNCHRONOUS_NAMES = {0: 'OFF', 1: 'NORMAL', 2: 'FULL', 3: 'EXTRA'}
+_TEMP_STORE_NAMES = {0: 'DEFAULT', 1: 'FILE', 2: 'MEMORY'}
+
+def apply_sqlite_profile(conn, profile=None):
+    """Apply a performance profile's PRAGMAs to a connection"""
+    profile = SQLITE_PERFORMANCE_PROFILE if profile is None else profile
+    for pragma, value in profile.items():
+        conn.execute(f"PRAGMA {pragma} = {value}").fetchall()
+    return conn
+
+def get_sqlite_settings(conn):
+    """Report the effective value of each profile PRAGMA on a connection"""
+    settings = {}
+    for pragma in SQLITE_PERFORMANCE_PROFILE:
+        value = conn.execute(f"PRAGMA {pragma}").fetchone()[0]
+        if pragma == 'synchronous':
+            value = _SYNCHRONOUS_NAMES.get(value, value)
+        elif pragma == 'temp_store':
+            value = _TEMP_STORE_NAMES.get(value, value)
+        elif pragma == 'journal_mode':
+            value = value.upper()
+        settings[pragma] = value
+    return settings
+
+
+class ConnectionPool:
+    """Process-wide pool of SQLite connections keyed by client database"""
+
+    def __init__(self, db_dir, max_connections=8, max_tenants=64,
+                 health_check_interval=30, acquire_timeout=10, profile=None):
+        self.db_dir = Path(db_dir)
+        self.profile = profile
+        self.max_connections = max_connections
+        self.max_tenants = max_tenants
+        self.health_check_interval = health_check_interval
+        self.acquire_timeout = acquire_timeout
+        # client_db -> {'idle': [(conn, last_used)], 'in_use': int}, oldest first
+        self._tenants = OrderedDict()
+        self._cond = threading.Condition()
+        self._local = threading.local()
+
+    def _connect(self, client_db):
+        conn = sqlite3.connect(str(self.db_dir / client_db), check_same_thread=False)
+        return apply_sqlite_profile(conn, self.profile)
+
+    @staticmethod
+    def _is_healthy(conn):
+        try:
+            conn.execute("SELECT 1").fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
+    @staticmethod
+    def _close_quietly(conn):
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+
+    def _evict_idle_tenants(self):
+        """Close least recently used tenants with no checked-out connections"""
+        for client_db in list(self._tenants):
+            if len(self._tenants) <= self.max_tenants:
+                break
+            tenant = self._tenants[client_db]
+            if tenant['in_use'] == 0:
+                for conn, _ in tenant['idle']:
+                    self._close_quietly(conn)
+                del self._tenants[client_db]
+
+    def acquire(self, client_db):
+        """Check out a healthy connection, waiting while the tenant is at capacity"""
+        deadline = time.monotonic() + self.acquire_timeout
+        with self._cond:
+            while True:
+                tenant = self._tenants.get(client_db)
+                if tenant is None:
+                    tenant = {'idle': [], 'in_use': 0}
+                    self._tenants[client_db] = tenant
+                self._tenants.move_to_end(client_db)
+                self._evict_idle_tenants()
+                if tenant['idle']:
+                    conn, last_used = tenant['idle'].pop()
+                    tenant['in_use'] += 1
+                    break
+                if tenant['in_use'] < self.max_connections:
+                    conn, last_used = None, None
+                    tenant['in_use'] += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError(f"No free connection for {client_db}")
+                self._cond.wait(remaining)
+
+        # Connecting and health checks happen outside the lock
+        try:
+            if (conn is not None
+                    and time.monotonic() - last_used > self.health_check_interval
+                    and not self._is_healthy(conn)):
+                self._close_quietly(conn)
+                conn = None
+            if conn is None:
+                conn = self._connect(client_db)
+        except Exception:
+            with self._cond:
+                tenant['in_use'] -= 1
+                self._cond.notify()
+            raise
+        return conn
+
+    def release(self, client_db, conn):
+        """Return a connection to its tenant's idle list"""
+        healthy = True
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            healthy = False
+
+        with self._cond:
+            tenant = self._tenants.get(client_db)
+            if tenant is None:
+                self._close_quietly(conn)
+                return
+            tenant['in_use'] -= 1
+            if healthy:
+                tenant['idle'].append((conn, time.monotonic()))
+            else:
+                self._close_quietly(conn)
+            self._cond.notify()
+
+    def _leases(self):
+        if not hasattr(self._local, 'leases'):
+            self._local.leases = {}
+        return self._local.leases
+
+    def lease(self, client_db):
+        """Get the connection leased to the current thread, acquiring one if needed"""
+        leases = self._leases()
+        conn = leases.get(client_db)
+        if conn is None:
+            conn = self.acquire(client_db)
+            leases[client_db] = conn
+        return conn
+
+    def release_thread(self):
+        """Return every connection leased to the current thread"""
+        leases = self._leases()
+        while leases:
+            client_db, conn = leases.popitem()
+            self.release(client_db, conn)
+
+    def stats(self):
+        """Snapshot of idle and checked-out connections per tenant"""
+        with self._cond:
+            return {client_db: {'idle': len(t['idle']), 'in_use': t['in_use']}
+                    for client_db, t in self._tenants.items()}
+
+    def close_all(self):
+        with self._cond:
+            for tenant in self._tenants.values():
+                for conn, _ in tenant['idle']:
+                    self._close_quietly(conn)
+            self._tenants.clear()
+
 
 class DatabaseManager:
+    # Override before the first connection to change the PRAGMAs applied
+    profile = dict(SQLITE_PERFORMANCE_PROFILE)
+
+    @staticmethod
+    def pool():
+        """Get the process-wide client connection pool, shared by every session"""
+        return _shared_pool()
+
+    @staticmethod
+    def release_connections():
+        """Return the current thread's leased connections to the pool"""
+        _shared_pool().release_thread()
+
     def __init__(self):
         # Create necessary directories
         self.db_dir = Path("client_databases")
@@ -20,6 +234,7 @@ class DatabaseManager:
         # Initialize the main authentication database
         self.auth_db_path = Path("auth.db")
         self.auth_db = sqlite3.connect(str(self.auth_db_path), check_same_thread=False)
+        apply_sqlite_profile(self.auth_db, self.profile)
         self.init_auth_db()
 
     def init_auth_db(self):
@@ -40,19 +255,17 @@ class DatabaseManager:
         db_name = f"client_{hashlib.md5((company_name + timestamp).encode()).hexdigest()[:10]}.db"
         db_path = self.db_dir / db_name
         
-        # Initialize the client's database
-        conn = sqlite3.connect(str(db_path))
-        c = conn.cursor()
-        
-        # Initialize all tables
-        self._init_client_tables(c)
-        
-        conn.commit()
-        conn.close()
+        # Initialize the client's database at the latest schema version
+        conn = apply_sqlite_profile(sqlite3.connect(str(db_path)), self.profile)
+        try:
+            SchemaMigrator.migrate(conn)
+        finally:
+            conn.close()
         
         return db_name
 
-    def _init_client_tables(self, cursor):
+    @staticmethod
+    def _init_client_tables(cursor):
         """Initialize all tables for a new client database"""
         # Core tables
         tables = {
@@ -178,13 +391,707 @@ class DatabaseManager:
         for table_name, create_statement in tables.items():
             cursor.execute(create_statement)
 
+    def get_connection(self, client_db):
+        """Lease a pooled connection to a client database for this script run"""
+        return self.pool().lease(client_db)
+
+    def tenant_settings(self, client_db):
+        """Effective SQLite settings for a client database"""
+        return get_sqlite_settings(self.get_connection(client_db))
+
+
+# Streamlit re-executes this module on every rerun, so objects meant to live
+# for the whole process are held in the resource cache, not class attributes
+@st.cache_resource(show_spinner=False, on_release=ConnectionPool.close_all)
+def _shared_pool():
+    return ConnectionPool(Path("client_databases"), profile=DatabaseManager.profile)
+
+# Schema migrations, tracked per client database with PRAGMA user_version
+def _add_missing_column(cursor, table, column, definition):
+    """Add a column to an existing table if an older schema lacks it"""
+    columns = [row[1] for row in cursor.execute(f"PRAGMA table_info({table})")]
+    if column not in columns:
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+def _migration_core_tables(cursor):
+    DatabaseManager._init_client_tables(cursor)
+    # Databases created by earlier versions have no lead_score column
+    _add_missing_column(cursor, 'customers', 'lead_score', 'INTEGER DEFAULT 0')
+
+def _migration_enhanced_schema(cursor):
+    # Internal messaging system
+    cursor.execute('''CREATE TABLE IF NOT EXISTS internal_messages
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  sender_id INTEGER,
+                  receiver_id INTEGER,
+                  message TEXT,
+                  sent_date TIMESTAMP,
+                  read_status BOOLEAN)''')
+    
+    # Meeting notes and follow-ups
+    cursor.execute('''CREATE TABLE IF NOT EXISTS meeting_notes
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  customer_id INTEGER,
+                  meeting_date TIMESTAMP,
+                  attendees TEXT,
+                  notes TEXT,
+                  action_items TEXT,
+                  follow_up_date TIMESTAMP)''')
+    
+    # Customer preferences
+    cursor.execute('''CREATE TABLE IF NOT EXISTS customer_preferences
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  customer_id INTEGER,
+                  preferred_contact_method TEXT,
+                  preferred_meeting_time TEXT,
+                  interests TEXT,
+                  birthday DATE)''')
+    
+    # Sales forecasting
+    cursor.execute('''CREATE TABLE IF NOT EXISTS sales_forecasts
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  period TEXT,
+                  predicted_revenue REAL,
+                  confidence_level INTEGER,
+                  notes TEXT)''')
+
+    # Performance metrics
+    cursor.execute('''CREATE TABLE IF NOT EXISTS performance_metrics
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  user_id INTEGER,
+                  metric_type TEXT,
+                  value REAL,
+                  date TIMESTAMP)''')
+
+def _migration_advanced_schema(cursor):
+    # Calendar events
+    cursor.execute('''CREATE TABLE IF NOT EXISTS calendar_events
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  title TEXT,
+                  description TEXT,
+                  start_time TIMESTAMP,
+                  end_time TIMESTAMP,
+                  customer_id INTEGER,
+                  event_type TEXT,
+                  location TEXT,
+                  attendees TEXT,
+                  FOREIGN KEY (customer_id) REFERENCES customers(id))''')
+    
+    # Document storage
+    cursor.execute('''CREATE TABLE IF NOT EXISTS documents
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  name TEXT,
+                  type TEXT,
+                  content BLOB,
+                  customer_id INTEGER,
+                  upload_date TIMESTAMP,
+                  tags TEXT,
+                  FOREIGN KEY (customer_id) REFERENCES customers(id))''')
+    
+    # Automation rules
+    cursor.execute('''CREATE TABLE IF NOT EXISTS automation_rules
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  name TEXT,
+                  trigger_type TEXT,
+                  trigger_conditions TEXT,
+                  action_type TEXT,
+                  action_details TEXT,
+                  is_active BOOLEAN)''')
+    
+    # Lead scoring rules
+    cursor.execute('''CREATE TABLE IF NOT EXISTS lead_scoring_rules
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  attribute TEXT,
+                  condition TEXT,
+                  score INTEGER)''')
+
+def _migration_communication_tables(cursor):
+    cursor.execute('''CREATE TABLE IF NOT EXISTS email_templates
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  name TEXT,
+                  subject TEXT,
+                  body TEXT,
+                  created_date TIMESTAMP)''')
+
+    cursor.execute('''CREATE TABLE IF NOT EXISTS communication_logs
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  customer_id INTEGER,
+                  type TEXT,
+                  subject TEXT,
+                  content TEXT,
+                  sent_date TIMESTAMP,
+                  status TEXT,
+                  FOREIGN KEY (customer_id) REFERENCES customers(id))''')
+
+    cursor.execute('''CREATE TABLE IF NOT EXISTS custom_fields
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  entity_type TEXT,
+                  field_name TEXT,
+                  field_type TEXT,
+                  required BOOLEAN)''')
+
+def _migration_table_versions(cursor):
+    # Per-table write counters shared by every process using the database
+    cursor.execute('''CREATE TABLE IF NOT EXISTS table_versions
+                 (table_name TEXT PRIMARY KEY,
+                  version INTEGER NOT NULL DEFAULT 0)''')
+
+# Rollup tables kept current by triggers on their source table. Key and
+# measure expressions use {row}, which becomes NEW, OLD or the source alias.
+SUMMARY_TABLES = {
+    'deal_stage_summary': {
+        'source': 'deals',
+        'watch': ['stage', 'amount'],
+        'keys': {'stage': "COALESCE({row}.stage, '')"},
+        'count': 'deal_count',
+        'sums': {'total_amount': "COALESCE({row}.amount, 0)"},
+        'filter': None,
+    },
+    'deal_daily_summary': {
+        'source': 'deals',
+        'watch': ['stage', 'amount', 'expected_close'],
+        'keys': {'close_day': "date({row}.expected_close)",
+                 'stage': "COALESCE({row}.stage, '')"},
+        'count': 'deal_count',
+        'sums': {'total_amount': "COALESCE({row}.amount, 0)"},
+        'filter': "date({row}.expected_close) IS NOT NULL",
+    },
+    'customer_status_summary': {
+        'source': 'customers',
+        'watch': ['status'],
+        'keys': {'status': "COALESCE({row}.status, '')"},
+        'count': 'customer_count',
+        'sums': {},
+        'filter': None,
+    },
+    'customer_daily_summary': {
+        'source': 'customers',
+        'watch': ['status', 'created_date'],
+        'keys': {'created_day': "date({row}.created_date)",
+                 'status': "COALESCE({row}.status, '')"},
+        'count': 'customer_count',
+        'sums': {},
+        'filter': "date({row}.created_date) IS NOT NULL",
+    },
+    'task_due_summary': {
+        'source': 'tasks',
+        'watch': ['status', 'due_date'],
+        'keys': {'due_day': "date({row}.due_date)"},
+        'count': 'open_tasks',
+        'sums': {},
+        'filter': "date({row}.due_date) IS NOT NULL AND {row}.status != 'Completed'",
+    },
+}
+
+def _summary_statements(name, spec):
+    """Build the CREATE TABLE and trigger statements for a rollup table"""
+    keys, sums, count = list(spec['keys']), list(spec['sums']), spec['count']
+
+    def exprs(mapping, row):
+        return ", ".join(expr.format(row=row) for expr in mapping.values())
+
+    def condition(row):
+        return spec['filter'].format(row=row) if spec['filter'] else "1"
+
+    def add(row):
+        updates = ", ".join([f"{count} = {count} + 1"] +
+                            [f"{col} = {col} + excluded.{col}" for col in sums])
+        values = ", ".join(filter(None, [exprs(spec['keys'], row), "1", exprs(spec['sums'], row)]))
+        return (f"INSERT INTO {name} ({', '.join(keys + [count] + sums)}) "
+                f"SELECT {values} WHERE {condition(row)} "
+                f"ON CONFLICT({', '.join(keys)}) DO UPDATE SET {updates};")
+
+    def remove(row):
+        updates = ", ".join([f"{count} = {count} - 1"] +
+                            [f"{col} = {col} - {spec['sums'][col].format(row=row)}" for col in sums])
+        match = " AND ".join(f"{col} = {spec['keys'][col].format(row=row)}" for col in keys)
+        return (f"UPDATE {name} SET {updates} WHERE {match} AND ({condition(row)}); "
+                f"DELETE FROM {name} WHERE {match} AND {count} <= 0;")
+
+    columns = ([f"{col} TEXT NOT NULL" for col in keys] +
+               [f"{count} INTEGER NOT NULL DEFAULT 0"] +
+               [f"{col} REAL NOT NULL DEFAULT 0" for col in sums])
+    source, watch = spec['source'], ", ".join(spec['watch'])
+    return [
+        f"CREATE TABLE IF NOT EXISTS {name} ({', '.join(columns)}, PRIMARY KEY ({', '.join(keys)}))",
+        f"CREATE TRIGGER IF NOT EXISTS {name}_insert AFTER INSERT ON {source} "
+        f"BEGIN {add('NEW')} END",
+        f"CREATE TRIGGER IF NOT EXISTS {name}_delete AFTER DELETE ON {source} "
+        f"BEGIN {remove('OLD')} END",
+        f"CREATE TRIGGER IF NOT EXISTS {name}_update AFTER UPDATE OF {watch} ON {source} "
+        f"BEGIN {remove('OLD')} {add('NEW')} END",
+    ]
+
+def rebuild_summary_tables(cursor, names=None):
+    """Recompute rollup tables from their source tables"""
+    for name in names or SUMMARY_TABLES:
+        spec = SUMMARY_TABLES[name]
+        keys = list(spec['keys'])
+        sums = ", ".join(f"SUM({expr.format(row='src')})" for expr in spec['sums'].values())
+        condition = spec['filter'].format(row='src') if spec['filter'] else "1"
+        cursor.execute(f"DELETE FROM {name}")
+        cursor.execute(
+            f"INSERT INTO {name} ({', '.join(keys + [spec['count']] + list(spec['sums']))}) "
+            f"SELECT {', '.join(expr.format(row='src') for expr in spec['keys'].values())}, "
+            f"COUNT(*){', ' + sums if sums else ''} "
+            f"FROM {spec['source']} AS src WHERE {condition} "
+            f"GROUP BY {', '.join(str(i + 1) for i in range(len(keys)))}")
+
+def _migration_summary_tables(cursor):
+    for name, spec in SUMMARY_TABLES.items():
+        for statement in _summary_statements(name, spec):
+            cursor.execute(statement)
+    rebuild_summary_tables(cursor)
+
+# Secondary indexes for the hot lookups, joins and sorts: name -> (table, columns)
+CLIENT_INDEXES = {
+    'idx_customers_status_score': ('customers', 'status, lead_score DESC'),
+    # Keyset pages filtered by status walk this in id order instead of sorting
+    'idx_customers_status_id': ('customers', 'status, id'),
+    'idx_contacts_customer_id': ('contacts', 'customer_id'),
+    'idx_contacts_date': ('contacts', 'date DESC'),
+    'idx_deals_customer_id': ('deals', 'customer_id'),
+    'idx_deals_stage': ('deals', 'stage'),
+    'idx_deals_expected_close': ('deals', 'expected_close'),
+    'idx_tasks_customer_id': ('tasks', 'customer_id'),
+    'idx_tasks_due_date': ('tasks', 'due_date, status'),
+    'idx_communication_logs_customer_id': ('communication_logs', 'customer_id'),
+    'idx_meeting_notes_customer_id': ('meeting_notes', 'customer_id'),
+    'idx_documents_customer_id': ('documents', 'customer_id'),
+    'idx_calendar_events_customer_id': ('calendar_events', 'customer_id'),
+}
+
+def create_client_indexes(cursor, names=None):
+    """Create the managed indexes that are missing"""
+    for name in names or CLIENT_INDEXES:
+        table, columns = CLIENT_INDEXES[name]
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({columns})")
+
+def drop_client_indexes(cursor, names=None):
+    """Drop managed indexes (used by the index benchmark)"""
+    for name in names or CLIENT_INDEXES:
+        cursor.execute(f"DROP INDEX IF EXISTS {name}")
+
+def _migration_client_indexes(cursor):
+    create_client_indexes(cursor)
+    cursor.execute("ANALYZE")
+
+# FTS5 indexes over searchable text, kept in sync by triggers on the
+# content table: table -> (result label, indexed columns)
+SEARCH_INDEXES = {
+    'customers': ('Customer', ['name', 'email', 'company']),
+    'contacts': ('Contact Note', ['type', 'notes']),
+    'meeting_notes': ('Meeting Note', ['attendees', 'notes', 'action_items']),
+    'blog_posts': ('Blog Post', ['title', 'content']),
+    'landing_pages': ('Landing Page', ['title', 'content']),
+}
+
+def _search_index_statements(table, columns):
+    """Build the FTS5 table and sync triggers for an external-content index"""
+    fts = f"{table}_fts"
+    cols = ", ".join(columns)
+    new_values = ", ".join(f"new.{col}" for col in columns)
+    old_values = ", ".join(f"old.{col}" for col in columns)
+    insert = f"INSERT INTO {fts}(rowid, {cols}) VALUES (new.id, {new_values});"
+    delete = (f"INSERT INTO {fts}({fts}, rowid, {cols}) "
+              f"VALUES ('delete', old.id, {old_values});")
+    return [
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5({cols}, content='{table}', "
+        f"content_rowid='id', tokenize='unicode61 remove_diacritics 2', prefix='2 3')",
+        f"CREATE TRIGGER IF NOT EXISTS {fts}_insert AFTER INSERT ON {table} BEGIN {insert} END",
+        f"CREATE TRIGGER IF NOT EXISTS {fts}_delete AFTER DELETE ON {table} BEGIN {delete} END",
+        f"CREATE TRIGGER IF NOT EXISTS {fts}_update AFTER UPDATE OF {cols} ON {table} "
+        f"BEGIN {delete} {insert} END",
+    ]
+
+def rebuild_search_indexes(cursor):
+    """Re-index every searchable table from its content table"""
+    for table in SEARCH_INDEXES:
+        cursor.execute(f"INSERT INTO {table}_fts({table}_fts) VALUES ('rebuild')")
+
+def _migration_search_indexes(cursor):
+    for table, (_, columns) in SEARCH_INDEXES.items():
+        for statement in _search_index_statements(table, columns):
+            cursor.execute(statement)
+    rebuild_search_indexes(cursor)
+
+def _migration_scoring_attributes(cursor):
+    # Customer attributes that lead scoring rules can refer to
+    _add_missing_column(cursor, 'customers', 'company_size', 'INTEGER')
+    _add_missing_column(cursor, 'customers', 'industry', 'TEXT')
+    _add_missing_column(cursor, 'customers', 'budget', 'REAL')
+
+# Writes that can change a customer's lead score: table -> (customer id column, watched columns)
+LEAD_SCORE_SOURCES = {
+    'contacts': ('customer_id', ['customer_id']),
+    'communication_logs': ('customer_id', ['customer_id']),
+    'meeting_notes': ('customer_id', ['customer_id']),
+    'customers': ('id', ['status', 'company_size', 'industry', 'budget']),
+}
+
+def _migration_lead_score_queue(cursor):
+    cursor.execute('''CREATE TABLE IF NOT EXISTS lead_score_queue
+                 (customer_id INTEGER PRIMARY KEY,
+                  queued_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+    # NOT EXISTS rather than OR IGNORE: an outer UPSERT (import in update
+    # mode) overrides a trigger's conflict clause and would fail on queued ids
+    for table, (id_column, watch) in LEAD_SCORE_SOURCES.items():
+        for event, row in [("INSERT", "NEW"), ("DELETE", "OLD"),
+                           (f"UPDATE OF {', '.join(watch)}", "NEW")]:
+            name = f"{table}_lead_score_{event.split()[0].lower()}"
+            cursor.execute(
+                f"CREATE TRIGGER IF NOT EXISTS {name} AFTER {event} ON {table} "
+                f"WHEN {row}.{id_column} IS NOT NULL BEGIN "
+                f"INSERT INTO lead_score_queue (customer_id) SELECT {row}.{id_column} "
+                f"WHERE NOT EXISTS (SELECT 1 FROM lead_score_queue "
+                f"WHERE customer_id = {row}.{id_column}); END")
+
+def _migration_customer_segments(cursor):
+    _add_missing_column(cursor, 'customers', 'segment', 'TEXT')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_customers_segment ON customers (segment)")
+    # A deal change clears the customer's segment so it gets reassigned
+    for event, row in [("INSERT", "NEW"), ("DELETE", "OLD"),
+                       ("UPDATE OF customer_id, amount", "OLD"), ("UPDATE OF customer_id, amount", "NEW")]:
+        name = f"deals_segment_{event.split()[0].lower()}_{row.lower()}"
+        cursor.execute(
+            f"CREATE TRIGGER IF NOT EXISTS {name} AFTER {event} ON deals "
+            f"BEGIN UPDATE customers SET segment = NULL "
+            f"WHERE id = {row}.customer_id AND segment IS NOT NULL; END")
+
+def _migration_forecast_columns(cursor):
+    # sales_forecasts holds one row per (model, period) from the forecasting engine
+    _add_missing_column(cursor, 'sales_forecasts', 'model', 'TEXT')
+    _add_missing_column(cursor, 'sales_forecasts', 'lower_bound', 'REAL')
+    _add_missing_column(cursor, 'sales_forecasts', 'upper_bound', 'REAL')
+    _add_missing_column(cursor, 'sales_forecasts', 'source_version', 'INTEGER')
+    _add_missing_column(cursor, 'sales_forecasts', 'generated_at', 'TIMESTAMP')
+
+# Tables whose row changes are logged to changes for incremental exports
+CHANGE_CAPTURE_TABLES = ['customers', 'deals', 'tasks', 'contacts', 'communication_logs']
+
+def _migration_change_capture(cursor):
+    # Append-only change log; id doubles as the export watermark
+    cursor.execute('''CREATE TABLE IF NOT EXISTS changes
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  table_name TEXT NOT NULL,
+                  row_id INTEGER NOT NULL,
+                  op TEXT NOT NULL,
+                  ts TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_changes_table ON changes (table_name, id)")
+    cursor.execute('''CREATE TABLE IF NOT EXISTS export_watermarks
+                 (table_name TEXT PRIMARY KEY,
+                  change_id INTEGER NOT NULL,
+                  exported_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+    for table in CHANGE_CAPTURE_TABLES:
+        for event, row in [("INSERT", "NEW"), ("UPDATE", "NEW"), ("DELETE", "OLD")]:
+            cursor.execute(
+                f"CREATE TRIGGER IF NOT EXISTS {table}_changes_{event.lower()} "
+                f"AFTER {event} ON {table} BEGIN "
+                f"INSERT INTO changes (table_name, row_id, op) "
+                f"VALUES ('{table}', {row}.id, '{event}'); END")
+
+def _migration_document_hashes(cursor):
+    # Document bodies move to the on-disk BlobStore; rows keep the SHA-256 key
+    _add_missing_column(cursor, 'documents', 'content_hash', 'TEXT')
+    _add_missing_column(cursor, 'documents', 'size', 'INTEGER')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_documents_content_hash ON documents (content_hash)")
+
+def _migration_app_settings(cursor):
+    # Per-tenant application preferences
+    cursor.execute('''CREATE TABLE IF NOT EXISTS app_settings
+                 (key TEXT PRIMARY KEY,
+                  value TEXT)''')
+
+def _migration_email_outbox(cursor):
+    # Undelivered emails; the message itself lives in communication_logs.
+    # next_attempt_at is a Unix time, NULL once delivery has given up.
+    cursor.execute('''CREATE TABLE IF NOT EXISTS email_outbox
+                 (log_id INTEGER PRIMARY KEY,
+                  to_email TEXT NOT NULL,
+                  attempts INTEGER NOT NULL DEFAULT 0,
+                  next_attempt_at REAL,
+                  locked_until REAL,
+                  last_error TEXT,
+                  FOREIGN KEY (log_id) REFERENCES communication_logs(id))''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_email_outbox_due ON email_outbox (next_attempt_at)")
+
+# Automation trigger -> (table, event, condition on the row, customer id,
+# entity id, JSON payload, time the event becomes due)
+AUTOMATION_EVENTS = {
+    'New Lead': ('customers', 'INSERT', "NEW.status = 'Lead'", "NEW.id", "NEW.id",
+                 "json_object('lead_source', NEW.lead_source)", "datetime('now')"),
+    'Deal Stage Change': ('deals', 'UPDATE OF stage', "OLD.stage IS NOT NEW.stage",
+                          "NEW.customer_id", "NEW.id",
+                          "json_object('from_stage', OLD.stage, 'to_stage', NEW.stage)",
+                          "datetime('now')"),
+    'Score Change': ('customers', 'UPDATE OF lead_score', "OLD.lead_score IS NOT NEW.lead_score",
+                     "NEW.id", "NEW.id",
+                     "json_object('old_score', OLD.lead_score, 'new_score', NEW.lead_score)",
+                     "datetime('now')"),
+    'Task Due': ('tasks', 'INSERT', "NEW.due_date IS NOT NULL AND COALESCE(NEW.status, '') != 'Completed'",
+                 "NEW.customer_id", "NEW.id", "json_object('due_date', NEW.due_date)",
+                 "datetime(NEW.due_date)"),
+    'Task Rescheduled': ('tasks', 'UPDATE OF due_date',
+                         "NEW.due_date IS NOT OLD.due_date AND NEW.due_date IS NOT NULL "
+                         "AND COALESCE(NEW.status, '') != 'Completed'",
+                         "NEW.customer_id", "NEW.id", "json_object('due_date', NEW.due_date)",
+                         "datetime(NEW.due_date)"),
+}
+
+def _migration_automation_events(cursor):
+    _add_missing_column(cursor, 'customers', 'lead_source', 'TEXT')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_automation_rules_trigger ON automation_rules (trigger_type)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_workflows_trigger ON workflows (trigger_type)")
+    # Pending events, consumed by process_automation_events once available_at passes
+    cursor.execute('''CREATE TABLE IF NOT EXISTS automation_events
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  event_type TEXT NOT NULL,
+                  customer_id INTEGER,
+                  entity_id INTEGER,
+                  payload TEXT,
+                  available_at TIMESTAMP NOT NULL)''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_automation_events_due ON automation_events (available_at)")
+    cursor.execute('''CREATE TABLE IF NOT EXISTS automation_runs
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  source TEXT,
+                  rule_id INTEGER,
+                  event_type TEXT,
+                  customer_id INTEGER,
+                  action_type TEXT,
+                  status TEXT,
+                  detail TEXT,
+                  run_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+    for event, (table, operation, condition, customer_id, entity_id, payload, available_at) in AUTOMATION_EVENTS.items():
+        # Rescheduled tasks raise the same event as new ones
+        trigger_type = 'Task Due' if event == 'Task Rescheduled' else event
+        name = f"{table}_automation_{event.lower().replace(' ', '_')}"
+        # Only record events some active rule or workflow listens for
+        cursor.execute(
+            f"CREATE TRIGGER IF NOT EXISTS {name} AFTER {operation} ON {table} "
+            f"WHEN {condition} AND (EXISTS (SELECT 1 FROM automation_rules "
+            f"WHERE trigger_type = '{trigger_type}' AND is_active) "
+            f"OR EXISTS (SELECT 1 FROM workflows WHERE trigger_type = '{trigger_type}' "
+            f"AND status = 'active')) BEGIN "
+            f"INSERT INTO automation_events (event_type, customer_id, entity_id, payload, available_at) "
+            f"VALUES ('{trigger_type}', {customer_id}, {entity_id}, {payload}, {available_at}); END")
+
+def _migration_scheduled_actions(cursor):
+    # Delayed automation actions; run_at is a Unix time
+    cursor.execute('''CREATE TABLE IF NOT EXISTS scheduled_actions
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  rule_id INTEGER,
+                  rule_name TEXT,
+                  event_type TEXT,
+                  customer_id INTEGER,
+                  action_type TEXT NOT NULL,
+                  details TEXT,
+                  run_at REAL NOT NULL,
+                  status TEXT NOT NULL DEFAULT 'pending',
+                  attempts INTEGER NOT NULL DEFAULT 0,
+                  locked_until REAL,
+                  last_error TEXT)''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_scheduled_actions_pending "
+                   "ON scheduled_actions (run_at) WHERE status = 'pending'")
+
+def _migration_background_jobs(cursor):
+    # Long operations run by JobRunner; progress runs from 0 to 1 and
+    # locked_until is the Unix time the owning process's lease expires
+    cursor.execute('''CREATE TABLE IF NOT EXISTS background_jobs
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  kind TEXT NOT NULL,
+                  description TEXT,
+                  locked_until REAL,
+                  status TEXT NOT NULL DEFAULT 'queued',
+                  progress REAL NOT NULL DEFAULT 0,
+                  message TEXT,
+                  result TEXT,
+                  error TEXT,
+                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                  started_at TIMESTAMP,
+                  finished_at TIMESTAMP)''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_background_jobs_kind ON background_jobs (kind, id)")
+
+def _migration_customer_keyset_index(cursor):
+    create_client_indexes(cursor, ['idx_customers_status_id'])
+    cursor.execute("ANALYZE customers")
+
+# Ordered list of (version, description, migration); append new steps only
+MIGRATIONS = [
+    (1, "Core CRM tables", _migration_core_tables),
+    (2, "Messaging, meetings, forecasts and metrics", _migration_enhanced_schema),
+    (3, "Calendar, documents, automation and lead scoring", _migration_advanced_schema),
+    (4, "Email templates, communication logs and custom fields", _migration_communication_tables),
+    (5, "Table version counters for cache invalidation", _migration_table_versions),
+    (6, "Trigger-maintained pipeline, customer and task rollups", _migration_summary_tables),
+    (7, "Indexes for joins, stage filters, due dates and recent activity", _migration_client_indexes),
+    (8, "FTS5 search over customers, notes and content", _migration_search_indexes),
+    (9, "Company size, industry and budget for lead scoring", _migration_scoring_attributes),
+    (10, "Queue of customers whose lead score needs recomputing", _migration_lead_score_queue),
+    (11, "Stored customer segments, cleared when deals change", _migration_customer_segments),
+    (12, "Model and confidence interval columns for sales forecasts", _migration_forecast_columns),
+    (13, "Change capture log and export watermarks", _migration_change_capture),
+    (14, "Content hashes for documents kept in the blob store", _migration_document_hashes),
+    (15, "Tenant application settings", _migration_app_settings),
+    (16, "Outbox of emails awaiting delivery", _migration_email_outbox),
+    (17, "Automation events, run log and lead source", _migration_automation_events),
+    (18, "Scheduled actions for automation delays", _migration_scheduled_actions),
+    (19, "Background jobs with persisted progress", _migration_background_jobs),
+    (20, "Customer index in keyset order for status-filtered pages", _migration_customer_keyset_index),
+]
+
+
+class SchemaMigrator:
+    """Applies pending MIGRATIONS to client databases"""
+
+    @staticmethod
+    def latest_version():
+        return MIGRATIONS[-1][0]
+
+    @staticmethod
+    def current_version(conn):
+        return conn.execute("PRAGMA user_version").fetchone()[0]
+
+    @classmethod
+    def migrate(cls, conn):
+        """Apply pending migrations in one transaction, returning (from, to) versions"""
+        start = cls.current_version(conn)
+        if start >= cls.latest_version():
+            return start, start
+
+        if conn.in_transaction:
+            conn.commit()
+        # Take the write lock first so concurrent processes migrate only once
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            start = cls.current_version(conn)
+            cursor = conn.cursor()
+            for version, _, migration in MIGRATIONS:
+                if version > start:
+                    migration(cursor)
+            cursor.execute(f"PRAGMA user_version = {cls.latest_version()}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        return start, cls.latest_version()
+
+    @classmethod
+    def ensure_migrated(cls, client_db, conn):
+        """Migrate a client database unless this process has already done so"""
+        key = str((Path("client_databases") / client_db).resolve())
+        store = _migrated_databases()
+        if key in store['paths']:
+            return
+        cls.migrate(conn)
+        with store['lock']:
+            store['paths'].add(key)
+
+    @classmethod
+    def migrate_all(cls, db_dir="client_databases", max_workers=8):
+        """Migrate every client database in db_dir in parallel"""
+        def migrate_file(db_path):
+            conn = apply_sqlite_profile(sqlite3.connect(str(db_path), timeout=30),
+                                        DatabaseManager.profile)
+            try:
+                return db_path.name, cls.migrate(conn)
+            finally:
+                conn.close()
+
+        db_paths = sorted(Path(db_dir).glob("*.db"))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return dict(executor.map(migrate_file, db_paths))
+
+@st.cache_resource(show_spinner=False)
+def _migrated_databases():
+    # paths: resolved paths of databases already at the latest version in this process
+    return {'paths': set(), 'lock': threading.Lock()}
+
+
+def mark_tables_changed(conn, *tables):
+    """Bump the version counters of tables written in the current transaction"""
+    conn.executemany("""INSERT INTO table_versions (table_name, version) VALUES (?, 1)
+                        ON CONFLICT(table_name) DO UPDATE SET version = version + 1""",
+                     [(table,) for table in tables])
+
+
+class MetricsCache:
+    """Per-tenant cache of query results, invalidated through table_versions
+
+    Each tenant gets a read-only watcher connection. PRAGMA data_version on
+    it changes whenever any other connection, in this or another process,
+    commits, so table_versions is only re-read after a write.
+    """
+    max_tenants = 64
+
+    @classmethod
+    def _tenant(cls, client_db):
+        tenants = _metrics_cache_store()['tenants']
+        tenant = tenants.get(client_db)
+        if tenant is None:
+            db_path = DatabaseManager.pool().db_dir / client_db
+            conn = sqlite3.connect(str(db_path), check_same_thread=False)
+            tenant = {'conn': conn, 'data_version': None, 'versions': {}, 'entries': {}}
+            tenants[client_db] = tenant
+            while len(tenants) > cls.max_tenants:
+                _, evicted = tenants.popitem(last=False)
+                evicted['conn'].close()
+        tenants.move_to_end(client_db)
+        return tenant
+
+    @classmethod
+    def table_versions(cls, client_db):
+        """Current write counters for a tenant's tables"""
+        with _metrics_cache_store()['lock']:
+            tenant = cls._tenant(client_db)
+            conn = tenant['conn']
+            data_version = conn.execute("PRAGMA data_version").fetchone()[0]
+            if data_version != tenant['data_version']:
+                tenant['versions'] = dict(conn.execute(
+                    "SELECT table_name, version FROM table_versions").fetchall())
+                tenant['data_version'] = data_version
+            return tenant['versions']
+
+    @classmethod
+    def get(cls, client_db, key, tables, compute):
+        """Return the cached value for key, recomputing if any of tables changed"""
+        versions = cls.table_versions(client_db)
+        stamp = tuple(versions.get(table, 0) for table in tables)
+        with _metrics_cache_store()['lock']:
+            entry = cls._tenant(client_db)['entries'].get(key)
+        if entry is not None and entry[0] == stamp:
+            return entry[1]
+
+        # Versions were read first, so a concurrent write can only make this stale-safe
+        value = compute()
+        with _metrics_cache_store()['lock']:
+            cls._tenant(client_db)['entries'][key] = (stamp, value)
+        return value
+
+    @classmethod
+    def clear(cls, client_db=None):
+        cls._close(_metrics_cache_store(), client_db)
+
+    @staticmethod
+    def _close(store, client_db=None):
+        with store['lock']:
+            tenants = store['tenants']
+            for name in [client_db] if client_db else list(tenants):
+                tenant = tenants.pop(name, None)
+                if tenant:
+                    tenant['conn'].close()
+
+@st.cache_resource(show_spinner=False, on_release=MetricsCache._close)
+def _metrics_cache_store():
+    # tenants: client_db -> {'conn', 'data_version', 'versions', 'entries'}, oldest first
+    return {'tenants': OrderedDict(), 'lock': threading.RLock()}
+
 
 def get_client_db():
     """Get database connection for the current client"""
     if hasattr(st.session_state, 'client_db'):
         db_path = Path("client_databases") / st.session_state.client_db
         if db_path.exists():
-            return sqlite3.connect(str(db_path), check_same_thread=False)
+            return DatabaseManager.pool().lease(st.session_state.client_db)
     return None
 # Authentication functions
 def hash_password(password):
@@ -253,117 +1160,15 @@ def login():
 # Modified helper functions
 
 def init_client_tables():
-    """Initialize or update tables for a client's database"""
+    """Bring the client's database up to the latest schema (once per process)"""
     conn = get_client_db()
     if conn:
-        c = conn.cursor()
-        
-        # Create all necessary tables
-        # Customers table
-        c.execute('''CREATE TABLE IF NOT EXISTS customers
-                     (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                      name TEXT NOT NULL,
-                      email TEXT UNIQUE,
-                      phone TEXT,
-                      company TEXT,
-                      status TEXT,
-                      created_date TIMESTAMP)''')
-        
-        # Contacts table
-        c.execute('''CREATE TABLE IF NOT EXISTS contacts
-                     (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                      customer_id INTEGER,
-                      type TEXT,
-                      notes TEXT,
-                      date TIMESTAMP,
-                      FOREIGN KEY (customer_id) REFERENCES customers(id))''')
-        
-        c.execute('''CREATE TABLE IF NOT EXISTS deals
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  customer_id INTEGER,
-                  title TEXT,
-                  amount REAL,
-                  stage TEXT,
-                  probability INTEGER,
-                  expected_close TIMESTAMP,
-                  FOREIGN KEY (customer_id) REFERENCES customers(id))''')
-    
-        # Create tasks table
-        c.execute('''CREATE TABLE IF NOT EXISTS tasks
-                     (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                      customer_id INTEGER,
-                      title TEXT,
-                      description TEXT,
-                      due_date TIMESTAMP,
-                      status TEXT,
-                      FOREIGN KEY (customer_id) REFERENCES customers(id))''')
-        
-        # Create users table
-        c.execute('''CREATE TABLE IF NOT EXISTS users
-                     (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                      username TEXT UNIQUE,
-                      password TEXT,
-                      role TEXT)''')
-        c.execute('''CREATE TABLE IF NOT EXISTS landing_pages
-                     (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                      title TEXT,
-                      content TEXT,
-                      template TEXT,
-                      meta_description TEXT,
-                      published BOOLEAN,
-                      visits INTEGER DEFAULT 0)''')
-        
-        # Blog posts
-        c.execute('''CREATE TABLE IF NOT EXISTS blog_posts
-                     (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                      title TEXT,
-                      content TEXT,
-                      author_id INTEGER,
-                      categories TEXT,
-                      tags TEXT,
-                      status TEXT,
-                      published_date TIMESTAMP)''')
-        
-        # Marketing campaigns
-        c.execute('''CREATE TABLE IF NOT EXISTS campaigns
-                     (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                      name TEXT,
-                      type TEXT,
-                      start_date TIMESTAMP,
-                      end_date TIMESTAMP,
-                      budget REAL,
-                      status TEXT,
-                      target_audience TEXT)''')
-        
-        # Forms
-        c.execute('''CREATE TABLE IF NOT EXISTS forms
-                     (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                      name TEXT,
-                      fields TEXT,
-                      submission_count INTEGER DEFAULT 0,
-                      thank_you_message TEXT)''')
-        
-        # Keywords
-        c.execute('''CREATE TABLE IF NOT EXISTS keywords
-                     (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                      keyword TEXT,
-                      difficulty INTEGER,
-                      volume INTEGER,
-                      ranking INTEGER)''')
-        
-        # Workflow automation
-        c.execute('''CREATE TABLE IF NOT EXISTS workflows
-                     (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                      name TEXT,
-                      trigger_type TEXT,
-                      conditions TEXT,
-                      actions TEXT,
-                      status TEXT)''')
-        
-        conn.commit()
+        SchemaMigrator.ensure_migrated(st.session_state.client_db, conn)
         return conn
     return None
 
+LEAD_SOURCES = ["Website", "Referral", "Social Media"]
+
 # Modified main functions
 def add_customer():
     st.subheader("Add New Customer")
@@ -378,39 +1183,143 @@ def add_customer():
         phone = st.text_input("Phone")
         company = st.text_input("Company")
         status = st.selectbox("Status", ["Lead", "Customer", "Inactive"])
+        lead_source = st.selectbox("Lead Source", [None] + LEAD_SOURCES,
+                                   format_func=lambda source: source or "Unknown")
+        company_size = st.number_input("Company Size (employees)", min_value=0, step=1)
+        industry = st.text_input("Industry")
+        budget = st.number_input("Budget", min_value=0.0)
         
         if st.form_submit_button("Add Customer"):
             c = conn.cursor()
             try:
-                c.execute("""INSERT INTO customers (name, email, phone, company, status, created_date)
-                            VALUES (?, ?, ?, ?, ?, ?)""",
-                         (name, email, phone, company, status, datetime.now()))
+                c.execute("""INSERT INTO customers (name, email, phone, company, status, created_date,
+                                                    company_size, industry, budget, lead_source)
+                            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                         (name, email, phone, company, status, datetime.now(),
+                          company_size or None, industry or None, budget or None, lead_source))
+                mark_tables_changed(conn, 'customers')
                 conn.commit()
                 st.success("Customer added successfully!")
             except sqlite3.IntegrityError:
                 st.error("Email already exists!")
 
+def _fts_query(text):
+    """Turn free text into an FTS5 query of quoted prefix terms"""
+    terms = [term.replace('"', '""') for term in text.split()]
+    return " ".join(f'"{term}"*' for term in terms)
+
+def global_search(conn, text, limit=20):
+    """Ranked full-text hits across every SEARCH_INDEXES table"""
+    query = _fts_query(text)
+    if not query:
+        return pd.DataFrame(columns=['type', 'id', 'match', 'score'])
+
+    # Each index contributes its own top hits; bm25 ranks lower-is-better
+    parts, params = [], []
+    for table, (label, _) in SEARCH_INDEXES.items():
+        fts = f"{table}_fts"
+        parts.append(f"""SELECT * FROM (
+            SELECT '{label}' as type, rowid as id,
+                   snippet({fts}, -1, '**', '**', '...', 12) as match,
+                   bm25({fts}) as score
+            FROM {fts} WHERE {fts} MATCH ? ORDER BY score LIMIT ?)""")
+        params.extend([query, limit])
+    return pd.read_sql_query(
+        " UNION ALL ".join(parts) + " ORDER BY score LIMIT ?", conn, params=params + [limit])
+
+def show_search_results(text):
+    conn = get_client_db()
+    if not conn:
+        return
+    results = global_search(conn, text)
+    with st.expander(f"Search results for \"{text}\" ({len(results)})", expanded=True):
+        if results.empty:
+            st.info("No matches")
+        else:
+            st.dataframe(results.drop(columns=['score']), hide_index=True)
+
+def _customer_filters(statuses, search):
+    """Build the WHERE clause and parameters for the customer list filters"""
+    clauses, params = [], []
+    if statuses:
+        clauses.append(f"status IN ({', '.join('?' * len(statuses))})")
+        params.extend(statuses)
+    if search:
+        pattern = "%" + search.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+        clauses.append("(name LIKE ? ESCAPE '\\' OR email LIKE ? ESCAPE '\\')")
+        params.extend([pattern, pattern])
+    return clauses, params
+
+def _customer_keyset_query(columns, statuses, search, after_id, limit):
+    """SQL and parameters for the next limit matching customers after after_id
+
+    Each status is its own idx_customers_status_id range, already in id
+    order, so several statuses are merged as they stream instead of every
+    match being sorted.
+    """
+    clauses, params = _customer_filters(None, search)
+    arms, arm_params = [], []
+    for status in statuses or [None]:
+        where = (['status = ?'] if status is not None else []) + clauses + ['id > ?']
+        arms.append(f"SELECT {columns} FROM customers WHERE {' AND '.join(where)}")
+        arm_params += ([status] if status is not None else []) + params + [after_id]
+    return f"{' UNION ALL '.join(arms)} ORDER BY id LIMIT ?", arm_params + [limit]
+
+def fetch_customers_page(conn, statuses=None, search="", page_size=50, after_id=0):
+    """Fetch one keyset page of customers (ordered by id) plus the total match count"""
+    clauses, params = _customer_filters(statuses, search)
+    sql, page_params = _customer_keyset_query("*", statuses, search, after_id, page_size + 1)
+    page_df = pd.read_sql_query(sql, conn, params=page_params)
+
+    if search:
+        total = conn.execute(f"SELECT COUNT(*) FROM customers WHERE {' AND '.join(clauses)}",
+                             params).fetchone()[0]
+    else:
+        # Status-only counts come from the trigger-maintained rollup
+        total = conn.execute(f"""SELECT COALESCE(SUM(customer_count), 0)
+                                 FROM customer_status_summary
+                                 WHERE {' AND '.join(clauses) or '1'}""", params).fetchone()[0]
+
+    has_next = len(page_df) > page_size
+    page_df = page_df.head(page_size)
+    last_id = int(page_df['id'].iloc[-1]) if not page_df.empty else after_id
+    return {'rows': page_df, 'total': total, 'has_next': has_next, 'last_id': last_id}
+
 def view_customers():
     st.subheader("Customer List")
     conn = get_client_db()
     if not conn:
         st.error("Database connection error")
         return
-        
-    df = pd.read_sql_query("SELECT * FROM customers", conn)
     
     # Filters
-    status_filter = st.multiselect("Filter by Status", df['status'].unique())
-    if status_filter:
-        df = df[df['status'].isin(status_filter)]
+    statuses = [row[0] for row in conn.execute(
+        "SELECT status FROM customer_status_summary WHERE status != '' ORDER BY status")]
+    status_filter = st.multiselect("Filter by Status", statuses)
     
     # Search
     search = st.text_input("Search customers")
-    if search:
-        df = df[df['name'].str.contains(search, case=False) | 
-                df['email'].str.contains(search, case=False)]
-    
-    st.dataframe(df)
+    page_size = st.selectbox("Rows per page", [25, 50, 100, 250], index=1)
+
+    # Keyset pagination: a stack of the last id before each visited page
+    signature = (tuple(status_filter), search, page_size)
+    if st.session_state.get('customers_filter') != signature:
+        st.session_state.customers_filter = signature
+        st.session_state.customers_page_starts = [0]
+    page_starts = st.session_state.customers_page_starts
+
+    page = fetch_customers_page(conn, status_filter, search, page_size, page_starts[-1])
+    st.dataframe(page['rows'])
+    st.caption(f"Page {len(page_starts)} of {max(1, -(-page['total'] // page_size))} "
+               f"({page['total']} matching customers)")
+
+    col1, col2 = st.columns(2)
+    if col1.button("Previous page", disabled=len(page_starts) == 1):
+        page_starts.pop()
+        st.rerun()
+    if col2.button("Next page", disabled=not page['has_next']):
+        page_starts.append(page['last_id'])
+        st.rerun()
 
 def manage_deals():
     st.subheader("Deal Management")
@@ -433,6 +1342,7 @@ def manage_deals():
             c.execute("""INSERT INTO deals (customer_id, title, amount, stage, probability, expected_close)
                         VALUES (?, ?, ?, ?, ?, ?)""",
                      (customer_id, title, amount, stage, probability, expected_close))
+            mark_tables_changed(conn, 'deals')
             conn.commit()
             st.success("Deal added successfully!")
     # View deals
@@ -444,8 +1354,12 @@ def manage_deals():
     """, conn)
     
     # Deal pipeline visualization
-    fig = px.bar(deals_df, x="stage", y="amount", color="probability",
-                 title="Deal Pipeline", hover_data=["title", "customer_name"])
+    stage_df = pd.read_sql_query("""
+        SELECT NULLIF(stage, '') as stage, deal_count, total_amount
+        FROM deal_stage_summary
+    """, conn)
+    fig = px.bar(stage_df, x="stage", y="total_amount",
+                 title="Deal Pipeline", hover_data=["deal_count"])
     st.plotly_chart(fig)
     
     st.dataframe(deals_df)
@@ -467,6 +1381,7 @@ def manage_tasks():
             c.execute("""INSERT INTO tasks (customer_id, title, description, due_date, status)
                         VALUES (?, ?, ?, ?, ?)""",
                      (customer_id, title, description, due_date, status))
+            mark_tables_changed(conn, 'tasks')
             conn.commit()
             st.success("Task added successfully!")
     
@@ -501,6 +1416,7 @@ def manage_contacts():
             c.execute("""INSERT INTO contacts (customer_id, type, notes, date)
                         VALUES (?, ?, ?, ?)""",
                      (customer_id, contact_type, notes, datetime.now()))
+            mark_tables_changed(conn, 'contacts')
             conn.commit()
             st.success("Contact record added successfully!")
     
@@ -523,24 +1439,27 @@ def show_dashboard():
     if not conn:
         st.error("Database connection error")
         return
+    client_db = st.session_state.client_db
     
     # Key metrics
     col1, col2, col3, col4 = st.columns(4)
     
     # Total customers
-    total_customers = pd.read_sql_query("""
-        SELECT COUNT(*) as count FROM customers
-    """, conn).iloc[0]['count']
+    total_customers = MetricsCache.get(client_db, 'total_customers', ['customers'],
+        lambda: pd.read_sql_query("""
+            SELECT COALESCE(SUM(customer_count), 0) as count
+            FROM customer_status_summary
+        """, conn).iloc[0]['count'])
     col1.metric("Total Customers", total_customers)
     
-    # [Rest of the dashboard code with updated database connections...]
     # Total deals and pipeline value
-    deals_data = pd.read_sql_query("""
-        SELECT COUNT(*) as count, 
-               COALESCE(SUM(amount), 0) as total_amount 
-        FROM deals 
-        WHERE stage != 'Closed Lost'
-    """, conn)
+    deals_data = MetricsCache.get(client_db, 'active_deals', ['deals'],
+        lambda: pd.read_sql_query("""
+            SELECT COALESCE(SUM(deal_count), 0) as count, 
+                   COALESCE(SUM(total_amount), 0) as total_amount 
+            FROM deal_stage_summary 
+            WHERE stage NOT IN ('Closed Lost', '')
+        """, conn))
     
     active_deals = deals_data.iloc[0]['count']
     pipeline_value = deals_data.iloc[0]['total_amount']
@@ -548,23 +1467,24 @@ def show_dashboard():
     col2.metric("Active Deals", active_deals)
     col3.metric("Pipeline Value", f"${pipeline_value:,.2f}")
     
-    # Tasks due today
-    tasks_due = pd.read_sql_query("""
-        SELECT COUNT(*) as count 
-        FROM tasks 
-        WHERE date(due_date) = date('now') 
-        AND status != 'Completed'
-    """, conn).iloc[0]['count']
+    # Tasks due today (keyed by the UTC date that date('now') uses)
+    today = time.strftime('%Y-%m-%d', time.gmtime())
+    tasks_due = MetricsCache.get(client_db, ('tasks_due', today), ['tasks'],
+        lambda: pd.read_sql_query("""
+            SELECT COALESCE(SUM(open_tasks), 0) as count 
+            FROM task_due_summary 
+            WHERE due_day = date('now')
+        """, conn).iloc[0]['count'])
     col4.metric("Tasks Due Today", tasks_due)
     
     # Deal pipeline chart
-    deals_df = pd.read_sql_query("""
-        SELECT stage, 
-               COUNT(*) as count, 
-               COALESCE(SUM(amount), 0) as total_amount
-        FROM deals 
-        GROUP BY stage
-    """, conn)
+    deals_df = MetricsCache.get(client_db, 'deals_by_stage', ['deals'],
+        lambda: pd.read_sql_query("""
+            SELECT NULLIF(stage, '') as stage, 
+                   deal_count as count, 
+                   total_amount
+            FROM deal_stage_summary
+        """, conn))
     
     if not deals_df.empty:
         fig1 = px.bar(deals_df, x="stage", y="total_amount",
@@ -575,71 +1495,22 @@ def show_dashboard():
     
     # Recent activities
     st.subheader("Recent Activities")
-    activities_df = pd.read_sql_query("""
-        SELECT contacts.date, 
-               customers.name as customer_name, 
-               contacts.type, 
-               contacts.notes
-        FROM contacts 
-        JOIN customers ON contacts.customer_id = customers.id
-        ORDER BY contacts.date DESC 
-        LIMIT 10
-    """, conn)
+    activities_df = MetricsCache.get(client_db, 'recent_activities', ['contacts', 'customers'],
+        lambda: pd.read_sql_query("""
+            SELECT contacts.date, 
+                   customers.name as customer_name, 
+                   contacts.type, 
+                   contacts.notes
+            FROM contacts 
+            JOIN customers ON contacts.customer_id = customers.id
+            ORDER BY contacts.date DESC 
+            LIMIT 10
+        """, conn))
     
     if not activities_df.empty:
         st.dataframe(activities_df)
     else:
         st.info("No recent activities to display")
-def update_enhanced_schema():
-    conn = get_client_db()
-    c = conn.cursor()
-    
-    # Internal messaging system
-    c.execute('''CREATE TABLE IF NOT EXISTS internal_messages
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  sender_id INTEGER,
-                  receiver_id INTEGER,
-                  message TEXT,
-                  sent_date TIMESTAMP,
-                  read_status BOOLEAN)''')
-    
-    # Meeting notes and follow-ups
-    c.execute('''CREATE TABLE IF NOT EXISTS meeting_notes
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  customer_id INTEGER,
-                  meeting_date TIMESTAMP,
-                  attendees TEXT,
-                  notes TEXT,
-                  action_items TEXT,
-                  follow_up_date TIMESTAMP)''')
-    
-    # Customer preferences
-    c.execute('''CREATE TABLE IF NOT EXISTS customer_preferences
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  customer_id INTEGER,
-                  preferred_contact_method TEXT,
-                  preferred_meeting_time TEXT,
-                  interests TEXT,
-                  birthday DATE)''')
-    
-    # Sales forecasting
-    c.execute('''CREATE TABLE IF NOT EXISTS sales_forecasts
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  period TEXT,
-                  predicted_revenue REAL,
-                  confidence_level INTEGER,
-                  notes TEXT)''')
-
-    # Performance metrics
-    c.execute('''CREATE TABLE IF NOT EXISTS performance_metrics
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  user_id INTEGER,
-                  metric_type TEXT,
-                  value REAL,
-                  date TIMESTAMP)''')
-
-    conn.commit()
-    return conn
 
 def team_collaboration():
     st.subheader("Team Collaboration")
@@ -674,24 +1545,238 @@ def meeting_management():
                      (customer, meeting_date, attendees, notes, action_items, follow_up))
             conn.commit()
 
+# Sales forecasting engine
+FORECAST_HORIZON = 6
+FORECAST_CONFIDENCE = 80
+_FORECAST_Z = 1.2816  # two-sided 80% normal interval
+
+def monthly_weighted_pipeline(conn, client_db=None):
+    """Probability-weighted deal amount per month, with missing months filled as 0"""
+    def load():
+        series = pd.read_sql_query("""
+            SELECT strftime('%Y-%m', expected_close) as period,
+                   SUM(amount * probability / 100.0) as weighted_amount
+            FROM deals
+            WHERE expected_close IS NOT NULL
+            GROUP BY period
+            ORDER BY period
+        """, conn).dropna(subset=['period'])
+        if series.empty:
+            return series
+        periods = pd.period_range(series['period'].iloc[0], series['period'].iloc[-1], freq='M')
+        return (series.set_index('period')['weighted_amount']
+                .reindex(periods.strftime('%Y-%m'), fill_value=0.0)
+                .fillna(0.0).rename_axis('period').reset_index())
+
+    if client_db is None:
+        return load()
+    return MetricsCache.get(client_db, 'monthly_weighted_pipeline', ['deals'], load)
+
+def _forecast_models(y, horizon, window=3, alpha=0.5, season=12):
+    """Point forecasts and one-step in-sample errors for each model, via NumPy"""
+    n = len(y)
+    steps = np.arange(1, horizon + 1)
+    models = {}
+
+    # Rolling mean: fitted[t] is the mean of the window ending at t-1
+    w = min(window, n)
+    rolling = np.convolve(y, np.ones(w) / w, mode='valid')
+    models['Rolling mean'] = (np.full(horizon, rolling[-1]), y[w:] - rolling[:-1])
+
+    # Simple exponential smoothing as a first-order IIR filter
+    level = lfilter([alpha], [1, alpha - 1], y, zi=[(1 - alpha) * y[0]])[0]
+    models['Exponential smoothing'] = (np.full(horizon, level[-1]), y[1:] - level[:-1])
+
+    # Seasonal naive: repeat the value from one season earlier
+    if n > season:
+        models['Seasonal naive'] = (y[n - season + (steps - 1) % season], y[season:] - y[:-season])
+    return models
+
+def compute_sales_forecasts(y, horizon=FORECAST_HORIZON):
+    """Forecasts with 80% intervals that widen with the square root of the horizon"""
+    results = {}
+    spread = _FORECAST_Z * np.sqrt(np.arange(1, horizon + 1))
+    for model, (forecast, errors) in _forecast_models(np.asarray(y, dtype=float), horizon).items():
+        sigma = errors.std(ddof=1) if len(errors) > 1 else 0.0
+        results[model] = (forecast, np.maximum(forecast - spread * sigma, 0), forecast + spread * sigma)
+    return results
+
+def refresh_sales_forecasts(conn, client_db=None, horizon=FORECAST_HORIZON):
+    """Recompute stored forecasts if deals changed since they were generated"""
+    version = MetricsCache.table_versions(client_db).get('deals', 0) if client_db else None
+    stored = conn.execute("SELECT MAX(source_version), COUNT(*) FROM sales_forecasts "
+                          "WHERE model IS NOT NULL").fetchone()
+    if version is not None and stored[1] and stored[0] == version:
+        return False
+
+    history = monthly_weighted_pipeline(conn, client_db)
+    rows = []
+    if len(history) > 1:
+        last = pd.Period(history['period'].iloc[-1], freq='M')
+        periods = [(last + step).strftime('%Y-%m') for step in range(1, horizon + 1)]
+        for model, (forecast, lower, upper) in compute_sales_forecasts(
+                history['weighted_amount'].to_numpy(), horizon).items():
+            rows.extend((period, model, float(f), float(lo), float(hi), FORECAST_CONFIDENCE,
+                         version, datetime.now(), f"{model} over {len(history)} months")
+                        for period, f, lo, hi in zip(periods, forecast, lower, upper))
+
+    conn.execute("DELETE FROM sales_forecasts WHERE model IS NOT NULL")
+    conn.executemany("""INSERT INTO sales_forecasts
+                        (period, model, predicted_revenue, lower_bound, upper_bound,
+                         confidence_level, source_version, generated_at, notes)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""", rows)
+    conn.commit()
+    return True
+
+# Monte Carlo pipeline simulation
+# Probability that a deal closes this many months after its expected_close
+PIPELINE_SLIP = {-1: 0.10, 0: 0.60, 1: 0.20, 2: 0.10}
+
+def simulate_pipeline(amounts, probabilities, month_index, n_trials=10000,
+                      exact_deals=256, max_draws=2000000, slip=None, seed=None,
+                      min_month=None):
+    """P10/P50/P90 of closed revenue per month from Bernoulli draws on open deals
+
+    A deal contributes to month m with probability p * slip(m - expected
+    month). Per month, the largest candidates (exact_deals, capped so a
+    month costs at most max_draws random numbers) are drawn exactly; the
+    long tail of small deals is drawn as a normal with the same mean and
+    variance, which keeps 100k-deal pipelines well under a second. Months
+    before min_month (overdue deals) roll into min_month, merged so a deal
+    closes at most once per month. Returns a DataFrame indexed by month index plus a 'total' row.
+    """
+    slip = slip or PIPELINE_SLIP
+    rng = np.random.default_rng(seed)
+    exact_deals = max(16, min(exact_deals, max_draws // n_trials))
+    offsets = np.fromiter(slip.keys(), dtype=np.int64)
+    weights = np.fromiter(slip.values(), dtype=np.float64)
+
+    amounts = np.asarray(amounts, dtype=np.float64)
+    probabilities = np.clip(np.asarray(probabilities, dtype=np.float64), 0, 1)
+    month_index = np.asarray(month_index, dtype=np.int64)
+
+    def draw(a, p):
+        """n_trials samples of sum(a * Bernoulli(p))"""
+        samples = np.zeros(n_trials)
+        if len(a) > exact_deals:
+            order = np.argsort(a)
+            tail, head = order[:-exact_deals], order[-exact_deals:]
+            mean = a[tail] @ p[tail]
+            std = np.sqrt((a[tail] ** 2) @ (p[tail] * (1 - p[tail])))
+            samples += np.maximum(rng.normal(mean, std, n_trials), 0)
+            a, p = a[head], p[head]
+        for start in range(0, n_trials, 2000):
+            block = rng.random((min(2000, n_trials - start), len(a)), dtype=np.float32)
+            samples[start:start + len(block)] += (block < p).astype(np.float32) @ a
+        return samples
+
+    # Expand each deal into (month, amount, probability) candidates
+    pair_month = (month_index[:, None] + offsets).ravel()
+    pair_deal = np.repeat(np.arange(len(amounts)), len(offsets))
+    pair_p = (probabilities[:, None] * weights).ravel()
+    if min_month is not None and len(pair_month):
+        pair_month = np.maximum(pair_month, min_month)
+        # Sum the slip probabilities of candidates that now share a (deal, month)
+        key = (pair_month - min_month) * len(amounts) + pair_deal
+        key, inverse = np.unique(key, return_inverse=True)
+        pair_p = np.bincount(inverse.ravel(), weights=pair_p)
+        pair_month, pair_deal = key // len(amounts) + min_month, key % len(amounts)
+    pair_amount = amounts[pair_deal]
+    order = np.argsort(pair_month, kind='stable')
+    pair_month, pair_amount, pair_p = pair_month[order], pair_amount[order], pair_p[order]
+    months, starts = np.unique(pair_month, return_index=True)
+    bounds = np.append(starts, len(pair_month))
+
+    rows = {}
+    for month, start, end in zip(months, bounds[:-1], bounds[1:]):
+        rows[int(month)] = np.percentile(draw(pair_amount[start:end], pair_p[start:end]), [10, 50, 90])
+    rows['total'] = np.percentile(draw(amounts, probabilities), [10, 50, 90])
+    return pd.DataFrame.from_dict(rows, orient='index', columns=['p10', 'p50', 'p90'])
+
+def pipeline_simulation(conn, client_db=None, n_trials=10000):
+    """Simulate open deals from the current month onward, cached on the deals version"""
+    now = datetime.now()
+    current = now.year * 12 + now.month - 1
+
+    def run():
+        started = time.perf_counter()
+        deals = np.array(conn.execute("""
+            SELECT amount, probability,
+                   CAST(strftime('%Y', expected_close) AS INTEGER) * 12
+                   + CAST(strftime('%m', expected_close) AS INTEGER) - 1
+            FROM deals
+            WHERE stage NOT IN ('Closed Won', 'Closed Lost')
+            AND amount > 0 AND probability > 0
+        """).fetchall(), dtype=np.float64).reshape(-1, 3)
+        # Undated deals are expected this month
+        months = np.nan_to_num(deals[:, 2], nan=current).astype(np.int64)
+        result = simulate_pipeline(deals[:, 0], deals[:, 1] / 100, months, n_trials,
+                                   min_month=current)
+        return {'result': result, 'deals': len(deals), 'seconds': time.perf_counter() - started}
+
+    if client_db is None:
+        return run()
+    return MetricsCache.get(client_db, ('pipeline_simulation', n_trials, current), ['deals'], run)
+
+def show_pipeline_simulation():
+    st.subheader("Pipeline Revenue Simulation")
+
+    n_trials = st.select_slider("Trials", [10000, 25000, 50000, 100000], value=10000)
+    simulation = pipeline_simulation(get_client_db(), st.session_state.client_db, n_trials)
+    result = simulation['result']
+    if simulation['deals'] == 0:
+        st.info("No open deals to simulate")
+        return
+
+    by_month = result.drop(index='total')
+    by_month.index = [f"{month // 12}-{month % 12 + 1:02d}" for month in by_month.index]
+    by_month = by_month.rename_axis('month').reset_index()
+    fig = px.line(by_month, x='month', y=['p10', 'p50', 'p90'],
+                  title='Simulated Closed Revenue per Month (P10 / P50 / P90)')
+    st.plotly_chart(fig)
+
+    total = result.loc['total']
+    col1, col2, col3 = st.columns(3)
+    col1.metric("P10 Total", f"${total['p10']:,.0f}")
+    col2.metric("P50 Total", f"${total['p50']:,.0f}")
+    col3.metric("P90 Total", f"${total['p90']:,.0f}")
+    st.dataframe(by_month.round(2), hide_index=True)
+    st.caption(f"{n_trials:,} trials over {simulation['deals']:,} open deals in "
+               f"{simulation['seconds'] * 1000:.0f} ms (cached until deals change)")
+
 def sales_forecasting():
     st.subheader("Sales Forecasting")
     
-    historical_data = pd.read_sql_query("""
-        SELECT strftime('%Y-%m', expected_close) as period,
-               SUM(amount * probability / 100) as weighted_amount
-        FROM deals
-        GROUP BY period
-        ORDER BY period
-    """, get_client_db())
+    conn = get_client_db()
+    client_db = st.session_state.client_db
+    refresh_sales_forecasts(conn, client_db)
+    historical_data = monthly_weighted_pipeline(conn, client_db)
+    forecasts = pd.read_sql_query("""
+        SELECT period, model, predicted_revenue, lower_bound, upper_bound, confidence_level
+        FROM sales_forecasts
+        WHERE model IS NOT NULL
+        ORDER BY model, period
+    """, conn)
     
-    # Simple moving average forecast
-    if not historical_data.empty:
-        historical_data['forecast'] = historical_data['weighted_amount'].rolling(window=3).mean()
-        
-        fig = px.line(historical_data, x='period', y=['weighted_amount', 'forecast'],
-                     title='Sales Forecast')
-        st.plotly_chart(fig)
+    if historical_data.empty:
+        st.info("No deals with expected close dates to forecast from")
+        return
+    if forecasts.empty:
+        st.info("At least two months of deal history are needed for a forecast")
+        return
+
+    model = st.selectbox("Forecast Model", forecasts['model'].unique())
+    selected = forecasts[forecasts['model'] == model]
+    fig = px.line(historical_data, x='period', y='weighted_amount', title='Sales Forecast')
+    fig.add_scatter(x=selected['period'], y=selected['predicted_revenue'], name=model)
+    fig.add_scatter(x=selected['period'], y=selected['upper_bound'], name='Upper bound',
+                    line={'dash': 'dot'})
+    fig.add_scatter(x=selected['period'], y=selected['lower_bound'], name='Lower bound',
+                    line={'dash': 'dot'}, fill='tonexty')
+    st.plotly_chart(fig)
+    st.caption(f"{selected['confidence_level'].iloc[0]}% intervals; "
+               "recomputed only when deals change")
+    st.dataframe(selected.drop(columns=['model']), hide_index=True)
 
 def performance_dashboard():
     st.subheader("Performance Metrics")
@@ -719,7 +1804,7 @@ def manage_email_templates():
         body = st.text_area("Email Body")
         
         # Template variables helper
-        st.info("Available variables: {customer_name}, {company_name}, {deal_value}, {due_date}")
+        st.info("Available variables: " + ", ".join(f"{{{name}}}" for name in TEMPLATE_VARIABLES))
         
         if st.form_submit_button("Save Template"):
             conn = get_client_db()
@@ -751,11 +1836,415 @@ def manage_email_templates():
                 conn.commit()
                 st.success("Template updated successfully!")
 
-def send_email(to_email, subject, body):
-    # This is a placeholder for email sending functionality
-    # In a real application, you would configure your SMTP server
-    st.info(f"Email would be sent to: {to_email}\nSubject: {subject}\nBody: {body}")
-    return True
+# Outbound email, delivered in the background by EmailOutboxWorker
+SMTP_SETTINGS = {
+    'host': os.environ.get('CRM_SMTP_HOST', 'localhost'),
+    'port': int(os.environ.get('CRM_SMTP_PORT', '25')),
+    'username': os.environ.get('CRM_SMTP_USER'),
+    'password': os.environ.get('CRM_SMTP_PASSWORD'),
+    'starttls': os.environ.get('CRM_SMTP_STARTTLS') == '1',
+    'sender': os.environ.get('CRM_SMTP_FROM', 'crm@localhost'),
+    'timeout': 30,
+}
+
+def clean_email_address(address):
+    """The address without surrounding whitespace, or None if it cannot be sent to"""
+    if not isinstance(address, str):
+        return None
+    address = address.strip()
+    if not address or '\r' in address or '\n' in address:
+        return None
+    return address
+
+def queue_emails(conn, messages, commit=True):
+    """Queue (customer_id, to_email, subject, body) messages for delivery
+
+    Each message gets a 'Queued' communication_logs row and an outbox
+    entry, all in one transaction. Messages without a usable address
+    (missing, or with a line break that would corrupt the headers) are
+    skipped. Returns the number queued.
+    """
+    now = time.time()
+    count = 0
+    for customer_id, to_email, subject, body in messages:
+        to_email = clean_email_address(to_email)
+        if to_email is None:
+            continue
+        log_id = conn.execute("""INSERT INTO communication_logs
+                                 (customer_id, type, subject, content, status)
+                                 VALUES (?, 'Email', ?, ?, 'Queued')""",
+                              (customer_id, subject, body)).lastrowid
+        conn.execute("INSERT INTO email_outbox (log_id, to_email, next_attempt_at) VALUES (?, ?, ?)",
+                     (log_id, to_email, now))
+        count += 1
+    mark_tables_changed(conn, 'communication_logs')
+    if commit:
+        conn.commit()
+    return count
+
+def outbox_status(conn):
+    """(messages awaiting delivery, messages that gave up) in the outbox"""
+    total, pending = conn.execute(
+        "SELECT COUNT(*), COUNT(next_attempt_at) FROM email_outbox").fetchone()
+    return pending, total - pending
+
+def _is_permanent_smtp_error(error):
+    """5xx replies will not succeed on retry"""
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(code >= 500 for code, _ in error.recipients.values())
+    return isinstance(error, smtplib.SMTPResponseException) and error.smtp_code >= 500
+
+
+class SMTPConnectionPool:
+    """Fixed number of SMTP sessions reused across messages
+
+    Blocking smtplib calls run in threads via asyncio.to_thread; each
+    session is used by one send at a time.
+    """
+
+    def __init__(self, settings, size=4):
+        self.settings = settings
+        self._slots = asyncio.Queue()
+        for _ in range(size):
+            self._slots.put_nowait(None)  # connected lazily
+
+    def _connect(self):
+        settings = self.settings
+        smtp = smtplib.SMTP(settings['host'], settings['port'], timeout=settings['timeout'])
+        if settings['starttls']:
+            smtp.starttls()
+        if settings['username']:
+            smtp.login(settings['username'], settings['password'])
+        return smtp
+
+    @staticmethod
+    def _close(smtp):
+        try:
+            smtp.quit()
+        except (smtplib.SMTPException, OSError):
+            smtp.close()
+
+    def _send(self, smtp, message):
+        """Runs in a thread; returns (session to keep or None, error or None)"""
+        try:
+            if smtp is None:
+                smtp = self._connect()
+            smtp.send_message(message)
+            return smtp, None
+        except smtplib.SMTPServerDisconnected as e:
+            return None, e
+        except (smtplib.SMTPRecipientsRefused, smtplib.SMTPResponseException) as e:
+            return smtp, e  # rejected by the server, session still usable
+        except (smtplib.SMTPException, OSError) as e:
+            if smtp is not None:
+                smtp.close()
+            return None, e
+
+    async def send(self, message):
+        """Deliver one message; returns the SMTP error, or None if accepted"""
+        smtp = await self._slots.get()
+        try:
+            reused = smtp is not None
+            smtp, error = await asyncio.to_thread(self._send, smtp, message)
+            if reused and isinstance(error, smtplib.SMTPServerDisconnected):
+                # The server dropped an idle session; retry on a fresh one
+                smtp, error = await asyncio.to_thread(self._send, None, message)
+            return error
+        finally:
+            self._slots.put_nowait(smtp)
+
+    async def close(self):
+        while not self._slots.empty():
+            smtp = self._slots.get_nowait()
+            if smtp is not None:
+                await asyncio.to_thread(self._close, smtp)
+
+
+class EmailOutboxWorker:
+    """Process-wide background delivery of every tenant's email_outbox
+
+    An asyncio loop on a daemon thread claims due messages in batches, sends
+    them concurrently over an SMTPConnectionPool and records the outcome in
+    communication_logs.status. Failures are retried with exponential backoff
+    until max_attempts; 5xx rejections fail immediately. Claims carry a
+    lease so several processes can share a tenant's outbox.
+    """
+
+    def __init__(self, db_dir, smtp_settings=None, connections=4, batch_size=200,
+                 max_attempts=5, backoff=60, poll_interval=5, lease=300, profile=None):
+        self.db_dir = Path(db_dir)
+        self.smtp_settings = SMTP_SETTINGS if smtp_settings is None else smtp_settings
+        self.connections = connections
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.poll_interval = poll_interval
+        self.lease = lease
+        self.profile = profile
+        self._tenants = set()
+        self._stopping = False
+        self._loop = None
+        self._thread = None
+
+    @staticmethod
+    def instance():
+        """The shared worker, started on first use"""
+        return _shared_email_worker()
+
+    def start(self):
+        ready = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(ready,),
+                                        name="email-outbox", daemon=True)
+        self._thread.start()
+        ready.wait()
+
+    def stop(self, timeout=10):
+        self._loop.call_soon_threadsafe(self._request_stop)
+        self._thread.join(timeout)
+
+    def notify(self, client_db):
+        """Tell the worker that a tenant has mail to deliver"""
+        self._loop.call_soon_threadsafe(self._add_tenant, client_db)
+
+    def _add_tenant(self, client_db):
+        self._tenants.add(client_db)
+        self._wake.set()
+
+    def _request_stop(self):
+        self._stopping = True
+        self._wake.set()
+
+    def _run(self, ready):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        self._wake = asyncio.Event()
+        ready.set()
+        try:
+            self._loop.run_until_complete(self._main())
+        finally:
+            self._loop.close()
+
+    async def _main(self):
+        smtp = SMTPConnectionPool(self.smtp_settings, self.connections)
+        connections = {}
+        try:
+            while not self._stopping:
+                self._wake.clear()
+                busy = False
+                for client_db in list(self._tenants):
+                    conn = connections.get(client_db)
+                    if conn is None:
+                        conn = sqlite3.connect(str(self.db_dir / client_db))
+                        connections[client_db] = apply_sqlite_profile(conn, self.profile)
+                    try:
+                        busy |= await self._deliver_batch(conn, smtp) == self.batch_size
+                        pending = conn.execute("SELECT 1 FROM email_outbox "
+                                               "WHERE next_attempt_at IS NOT NULL LIMIT 1").fetchone()
+                    except Exception:
+                        # Locked, unavailable or a bad batch; the worker must outlive it
+                        # and claimed messages are retried once their lease expires
+                        conn.rollback()
+                        continue
+                    if not pending:
+                        self._tenants.discard(client_db)
+                        connections.pop(client_db).close()
+                if not busy:
+                    try:
+                        await asyncio.wait_for(self._wake.wait(), self.poll_interval)
+                    except asyncio.TimeoutError:
+                        pass
+        finally:
+            await smtp.close()
+            for conn in connections.values():
+                conn.close()
+
+    def _message(self, to_email, subject, body):
+        message = EmailMessage()
+        message['From'] = self.smtp_settings['sender']
+        message['To'] = to_email
+        message['Subject'] = subject or ''
+        message.set_content(body or '')
+        return message
+
+    async def _deliver_batch(self, conn, smtp):
+        """Claim, send and record one batch of due messages; returns its size"""
+        now = time.time()
+        claimed = [row[0] for row in conn.execute(
+            """UPDATE email_outbox SET locked_until = ?
+               WHERE log_id IN (SELECT log_id FROM email_outbox
+                                WHERE next_attempt_at <= ?
+                                  AND (locked_until IS NULL OR locked_until < ?)
+                                ORDER BY next_attempt_at LIMIT ?)
+               RETURNING log_id""",
+            (now + self.lease, now, now, self.batch_size)).fetchall()]
+        conn.commit()
+        if not claimed:
+            return 0
+
+        rows = conn.execute(
+            f"""SELECT o.log_id, o.to_email, o.attempts, l.subject, l.content
+                FROM email_outbox o JOIN communication_logs l ON l.id = o.log_id
+                WHERE o.log_id IN ({', '.join('?' * len(claimed))})""", claimed).fetchall()
+        # An address or subject that cannot go in a header fails only its own message
+        messages, failed = {}, []
+        for log_id, to_email, _, subject, body in rows:
+            try:
+                messages[log_id] = self._message(to_email, subject, body)
+            except (ValueError, TypeError) as e:
+                failed.append((f"Invalid message: {e}", log_id))
+        rows = [row for row in rows if row[0] in messages]
+        errors = await asyncio.gather(*(smtp.send(messages[row[0]]) for row in rows))
+
+        sent, retry = [], []
+        sent_date = datetime.now()
+        for (log_id, _, attempts, _, _), error in zip(rows, errors):
+            if error is None:
+                sent.append((sent_date, log_id))
+            elif attempts + 1 >= self.max_attempts or _is_permanent_smtp_error(error):
+                failed.append((str(error), log_id))
+            else:
+                retry.append((time.time() + self.backoff * 2 ** attempts, str(error), log_id))
+        conn.executemany("UPDATE communication_logs SET status = 'Sent', sent_date = ? WHERE id = ?", sent)
+        conn.executemany("DELETE FROM email_outbox WHERE log_id = ?", [(log_id,) for _, log_id in sent])
+        conn.executemany("""UPDATE email_outbox SET attempts = attempts + 1, next_attempt_at = ?,
+                            last_error = ?, locked_until = NULL WHERE log_id = ?""", retry)
+        conn.executemany("""UPDATE email_outbox SET attempts = attempts + 1, next_attempt_at = NULL,
+                            last_error = ?, locked_until = NULL WHERE log_id = ?""", failed)
+        conn.executemany("UPDATE communication_logs SET status = 'Failed' WHERE id = ?",
+                         [(log_id,) for _, log_id in failed])
+        mark_tables_changed(conn, 'communication_logs')
+        conn.commit()
+        return len(claimed)
+
+@st.cache_resource(show_spinner=False, on_release=EmailOutboxWorker.stop)
+def _shared_email_worker():
+    worker = EmailOutboxWorker(DatabaseManager.pool().db_dir, profile=DatabaseManager.profile)
+    worker.start()
+    return worker
+
+# Mail merge: variable -> (SQL expression, join it needs, default format spec)
+TEMPLATE_VARIABLES = {
+    'customer_name': ("c.name", None, None),
+    'customer_email': ("c.email", None, None),
+    'company_name': ("c.company", None, None),
+    'deal_value': ("open_deals.deal_value", 'open_deals', ',.2f'),
+    'due_date': ("date(open_tasks.due_date)", 'open_tasks', None),
+}
+# Per-customer aggregates, limited to the id range being rendered
+TEMPLATE_JOINS = {
+    'open_deals': """LEFT JOIN (SELECT customer_id, SUM(amount) AS deal_value FROM deals
+                                WHERE customer_id BETWEEN ? AND ?
+                                  AND stage NOT IN ('Closed Won', 'Closed Lost')
+                                GROUP BY customer_id) open_deals
+                     ON open_deals.customer_id = c.id""",
+    'open_tasks': """LEFT JOIN (SELECT customer_id, MIN(due_date) AS due_date FROM tasks
+                                WHERE customer_id BETWEEN ? AND ?
+                                  AND COALESCE(status, '') != 'Completed'
+                                GROUP BY customer_id) open_tasks
+                     ON open_tasks.customer_id = c.id""",
+}
+
+# Cached per process: a module-level lru_cache would be rebuilt on every rerun
+@st.cache_resource(show_spinner=False, max_entries=256)
+def compile_template(text):
+    """Parse template text once into (literal, variable, format spec) parts
+
+    Placeholders that are not TEMPLATE_VARIABLES are kept as literal text.
+    Raises ValueError for unbalanced braces.
+    """
+    parts = []
+    for literal, field, spec, conversion in string.Formatter().parse(text or ''):
+        if field is not None and field not in TEMPLATE_VARIABLES:
+            literal += "{" + field + (f"!{conversion}" if conversion else "") + (f":{spec}" if spec else "") + "}"
+            field = spec = None
+        parts.append((literal, field, spec or (TEMPLATE_VARIABLES[field][2] if field else None)))
+    return tuple(parts)
+
+def _render_parts(parts, values):
+    """Render compiled parts for every row of values in one pass"""
+    rendered = pd.Series('', index=values.index, dtype=object)
+    for literal, field, spec in parts:
+        if literal:
+            rendered = rendered + literal
+        if field:
+            column = values[field]
+            if spec:
+                column = column.map(lambda v: '' if pd.isna(v) else format(v, spec))
+            rendered = rendered + column.fillna('').astype(str)
+    return rendered
+
+def render_emails(conn, subject, body, statuses=None, after_id=0, limit=10000):
+    """Render a template for one keyset chunk of customers, ordered by id
+
+    Only the variables the template uses are fetched, with one joined query
+    per chunk. Returns customer_id, email, subject and body columns; an
+    empty frame means the audience is exhausted.
+    """
+    subject_parts, body_parts = compile_template(subject), compile_template(body)
+    fields = sorted({field for _, field, _ in subject_parts + body_parts if field})
+    clauses, params = _customer_filters(statuses, "")
+    ids = [row[0] for row in conn.execute(
+        *_customer_keyset_query("id", statuses, "", after_id, limit))]
+    if not ids:
+        return pd.DataFrame(columns=['customer_id', 'email', 'subject', 'body'])
+
+    joins = sorted({TEMPLATE_VARIABLES[field][1] for field in fields} - {None})
+    columns = "".join(f", {TEMPLATE_VARIABLES[field][0]} AS {field}" for field in fields)
+    values = pd.read_sql_query(f"""
+        SELECT c.id AS customer_id, c.email{columns}
+        FROM customers c {' '.join(TEMPLATE_JOINS[join] for join in joins)}
+        WHERE {' AND '.join(['c.id BETWEEN ? AND ?'] + clauses)}
+        ORDER BY c.id
+    """, conn, params=[ids[0], ids[-1]] * (len(joins) + 1) + params)
+    values['subject'] = _render_parts(subject_parts, values)
+    values['body'] = _render_parts(body_parts, values)
+    return values[['customer_id', 'email', 'subject', 'body']]
+
+def queue_campaign(conn, template_id, statuses=None, chunk_size=10000, progress=None):
+    """Render a template for every matching customer with an email and queue it"""
+    subject, body = conn.execute("SELECT subject, body FROM email_templates WHERE id = ?",
+                                 (template_id,)).fetchone()
+    after_id, queued = 0, 0
+    while not (chunk := render_emails(conn, subject, body, statuses, after_id, chunk_size)).empty:
+        after_id = int(chunk['customer_id'].iloc[-1])
+        chunk = chunk[chunk['email'].fillna('').str.strip() != '']
+        queued += queue_emails(conn, chunk.itertuples(index=False, name=None))
+        if progress:
+            progress(queued)
+    return queued
+
+def email_campaign():
+    st.subheader("Email Campaign")
+    conn = get_client_db()
+    templates_df = pd.read_sql_query("SELECT id, name, subject, body FROM email_templates", conn)
+    if templates_df.empty:
+        st.info("Create an email template first")
+        return
+    template_names = dict(zip(templates_df['id'], templates_df['name']))
+    template_id = int(st.selectbox("Template", list(template_names), format_func=template_names.get))
+    template = templates_df.set_index('id').loc[template_id]
+    statuses = st.multiselect("Customer Status", [row[0] for row in conn.execute(
+        "SELECT status FROM customer_status_summary WHERE status != '' ORDER BY status")])
+
+    clauses, params = _customer_filters(statuses, "")
+    clauses.append("COALESCE(email, '') != ''")
+    audience = conn.execute(f"SELECT COUNT(*) FROM customers WHERE {' AND '.join(clauses)}",
+                            params).fetchone()[0]
+    st.write(f"Audience: {audience:,} customers with an email address")
+
+    try:
+        preview = render_emails(conn, template['subject'], template['body'], statuses, limit=5)
+    except ValueError as e:
+        st.error(f"Template error: {str(e)}")
+        return
+    st.dataframe(preview, hide_index=True)
+
+    if audience and st.button("Queue Campaign"):
+        progress = st.progress(0.0)
+        queued = queue_campaign(conn, template_id, statuses,
+                                progress=lambda n: progress.progress(min(n / audience, 1.0)))
+        EmailOutboxWorker.instance().notify(st.session_state.client_db)
+        st.success(f"Queued {queued:,} emails for delivery")
 
 def manage_communications():
     st.subheader("Communication Management")
@@ -776,29 +2265,31 @@ def manage_communications():
             selected_template = st.selectbox("Select Template", templates_df['name'])
             template_data = templates_df[templates_df['name'] == selected_template].iloc[0]
             
-            # Parse template
-            subject = template_data['subject']
-            body = template_data['body']
-            
-            # Replace variables
-            subject = subject.replace("{customer_name}", customer_data['name'])
-            body = body.replace("{customer_name}", customer_data['name'])
+            # Fill in template variables for this customer
+            try:
+                rendered = render_emails(conn, template_data['subject'], template_data['body'],
+                                         after_id=int(customer_data['id']) - 1, limit=1)
+                subject, body = rendered.loc[0, 'subject'], rendered.loc[0, 'body']
+            except ValueError as e:
+                st.error(f"Template error: {str(e)}")
+                subject, body = template_data['subject'], template_data['body']
             
             # Allow editing
             final_subject = st.text_input("Subject", value=subject)
             final_body = st.text_area("Body", value=body)
             
-            if st.button("Send Email"):
-                if send_email(customer_data['email'], final_subject, final_body):
-                    # Log communication
-                    c = conn.cursor()
-                    c.execute("""INSERT INTO communication_logs 
-                               (customer_id, type, subject, content, sent_date, status)
-                               VALUES (?, ?, ?, ?, ?, ?)""",
-                             (customer_data['id'], 'Email', final_subject, 
-                              final_body, datetime.now(), 'Sent'))
-                    conn.commit()
-                    st.success("Email sent and logged successfully!")
+            has_email = clean_email_address(customer_data['email']) is not None
+            if not has_email:
+                st.warning(f"{selected_customer} has no valid email address; fix it before sending")
+            if st.button("Send Email", disabled=not has_email):
+                queue_emails(conn, [(int(customer_data['id']), customer_data['email'],
+                                     final_subject, final_body)])
+                EmailOutboxWorker.instance().notify(st.session_state.client_db)
+                st.success("Email queued for delivery!")
+
+        pending, failed = outbox_status(conn)
+        if pending or failed:
+            st.caption(f"Outbox: {pending} awaiting delivery, {failed} failed")
 
 # Enhanced Analytics Functions
 def show_enhanced_analytics():
@@ -815,11 +2306,12 @@ def show_enhanced_analytics():
         end_date = st.date_input("End Date", value=datetime.now())
     
     # Sales Performance
-    deals_df = pd.read_sql_query(f"""
-        SELECT stage, COUNT(*) as count, SUM(amount) as total_amount,
-               strftime('%Y-%m', expected_close) as month
-        FROM deals
-        WHERE date(expected_close) BETWEEN ? AND ?
+    deals_df = pd.read_sql_query("""
+        SELECT NULLIF(stage, '') as stage, SUM(deal_count) as count,
+               SUM(total_amount) as total_amount,
+               substr(close_day, 1, 7) as month
+        FROM deal_daily_summary
+        WHERE close_day BETWEEN ? AND ?
         GROUP BY stage, month
         ORDER BY month
     """, conn, params=(start_date, end_date))
@@ -837,12 +2329,12 @@ def show_enhanced_analytics():
         st.plotly_chart(fig2)
     
     # Customer Acquisition Analysis
-    customers_df = pd.read_sql_query(f"""
-        SELECT strftime('%Y-%m', created_date) as month,
-               COUNT(*) as new_customers,
-               status
-        FROM customers
-        WHERE date(created_date) BETWEEN ? AND ?
+    customers_df = pd.read_sql_query("""
+        SELECT substr(created_day, 1, 7) as month,
+               SUM(customer_count) as new_customers,
+               NULLIF(status, '') as status
+        FROM customer_daily_summary
+        WHERE created_day BETWEEN ? AND ?
         GROUP BY month, status
     """, conn, params=(start_date, end_date))
     
@@ -873,100 +2365,401 @@ def manage_custom_fields():
             conn.commit()
             st.success("Custom field added successfully!")
 
+def show_database_settings():
+    st.subheader("Database Settings")
+
+    db_manager = st.session_state.db_manager
+    settings = db_manager.tenant_settings(st.session_state.client_db)
+    settings_df = pd.DataFrame({
+        'setting': list(settings),
+        'effective': [str(value) for value in settings.values()],
+        'profile': [str(db_manager.profile.get(name)) for name in settings],
+    })
+    st.dataframe(settings_df)
+
+    pool_stats = db_manager.pool().stats().get(st.session_state.client_db, {})
+    st.write(f"Pooled connections: {pool_stats.get('in_use', 0)} in use, "
+             f"{pool_stats.get('idle', 0)} idle")
+
+    conn = get_client_db()
+    storage = get_app_setting(conn, 'document_storage', 'files')
+    choice = st.radio("Store new documents", list(DOCUMENT_STORAGE_OPTIONS),
+                      index=list(DOCUMENT_STORAGE_OPTIONS).index(storage),
+                      format_func=DOCUMENT_STORAGE_OPTIONS.get)
+    if choice != storage:
+        set_app_setting(conn, 'document_storage', choice)
+        st.success("Document storage updated")
+
+# Streaming CSV import
+# Importable tables: duplicate key column and columns never taken from a file
+IMPORT_TABLES = {
+    'customers': {'key': 'email', 'exclude': ['id', 'lead_score', 'segment']},
+    'deals': {'key': None, 'exclude': ['id']},
+    'tasks': {'key': None, 'exclude': ['id']},
+}
+
+def import_target_columns(conn, table):
+    """Importable columns of a table: name -> (declared type, required)"""
+    exclude = IMPORT_TABLES[table]['exclude']
+    return {name: (col_type.upper(), bool(notnull) and default is None)
+            for _, name, col_type, notnull, default, _ in conn.execute(f"PRAGMA table_info({table})")
+            if name not in exclude}
+
+def _normalize_column(name):
+    return re.sub(r'\W+', '_', str(name).strip().lower()).strip('_')
+
+def auto_map_columns(csv_columns, targets):
+    """Suggest a CSV column for each target column by normalized name"""
+    by_name = {_normalize_column(column): column for column in csv_columns}
+    return {target: by_name[target] for target in targets if target in by_name}
+
+def _validate_chunk(chunk, targets):
+    """Coerce a chunk of string columns to the target types
+
+    Returns (values DataFrame, error message per row, '' when valid).
+    """
+    errors = pd.Series('', index=chunk.index)
+    values = pd.DataFrame(index=chunk.index)
+    for column in chunk.columns:
+        col_type, required = targets[column]
+        raw = chunk[column].str.strip()
+        empty = raw == ''
+        if col_type in ('INTEGER', 'REAL'):
+            value = pd.to_numeric(raw.where(~empty), errors='coerce')
+            bad = value.isna() & ~empty
+            if col_type == 'INTEGER':
+                bad |= value.notna() & (value % 1 != 0)
+        elif col_type in ('TIMESTAMP', 'DATE'):
+            parsed = pd.to_datetime(raw.where(~empty), errors='coerce', format='mixed')
+            bad = parsed.isna() & ~empty
+            value = parsed.dt.strftime('%Y-%m-%d' if col_type == 'DATE' else '%Y-%m-%d %H:%M:%S')
+        elif col_type == 'BOOLEAN':
+            value = raw.str.lower().map({'1': 1, 'true': 1, 'yes': 1, '0': 0, 'false': 0, 'no': 0})
+            bad = value.isna() & ~empty
+        else:
+            value = raw
+            bad = pd.Series(False, index=chunk.index)
+        if required:
+            bad |= empty
+        values[column] = value.astype(object).where(value.notna() & ~empty, None)
+        errors = errors.where(~bad, errors + f"invalid {column}; ")
+    return values, errors.str.rstrip('; ')
+
+def import_csv(conn, file, table, mapping, chunk_size=5000, on_duplicate='skip',
+               progress=None, max_errors=100):
+    """Stream a CSV into table in chunk_size transactions
+
+    mapping is {csv column: table column}. Rows are validated against the
+    table schema; invalid rows are rejected with a reason instead of
+    aborting the import. progress(rows, fraction, rows_per_second) is
+    called after each chunk.
+    """
+    targets = import_target_columns(conn, table)
+    mapping = {source: target for source, target in mapping.items() if target in targets}
+    missing = [name for name, (_, required) in targets.items()
+               if required and name not in mapping.values()]
+    if missing:
+        raise ValueError(f"Required columns are not mapped: {', '.join(missing)}")
+    if not mapping:
+        raise ValueError("No columns are mapped")
+
+    columns = list(mapping.values())
+    sql = (f"INSERT INTO {table} ({', '.join(columns)}) "
+           f"VALUES ({', '.join('?' * len(columns))})")
+    key = IMPORT_TABLES[table]['key']
+    upsert = False
+    if key and key in columns:
+        if on_duplicate == 'update' and len(columns) > 1:
+            upsert = True
+            updates = ", ".join(f"{c} = excluded.{c}" for c in columns if c != key)
+            sql += f" ON CONFLICT({key}) DO UPDATE SET {updates}"
+        else:
+            sql += f" ON CONFLICT({key}) DO NOTHING"
+
+    total_size = file.seek(0, io.SEEK_END)
+    file.seek(0)
+    result = {'rows': 0, 'written': 0, 'inserted': 0, 'updated': 0, 'duplicates': 0,
+              'rejected': 0, 'errors': []}
+    started = time.perf_counter()
+    line = 1  # header
+    for chunk in pd.read_csv(file, chunksize=chunk_size, dtype=str, keep_default_na=False,
+                             usecols=list(mapping)):
+        chunk = chunk.rename(columns=mapping)[columns]
+        values, errors = _validate_chunk(chunk, targets)
+        invalid = errors != ''
+        for offset in np.flatnonzero(invalid.to_numpy()):
+            if len(result['errors']) < max_errors:
+                result['errors'].append((int(line + 1 + offset), errors.iloc[offset]))
+        rows = list(values[~invalid].itertuples(index=False, name=None))
+        row_lines = line + 1 + np.flatnonzero(~invalid.to_numpy())
+        # An upsert reports one changed row either way, so find the rows that
+        # will update an existing record (or one from earlier in the chunk)
+        updates = [False] * len(rows)
+        if upsert:
+            key_index = columns.index(key)
+            keys = [row[key_index] for row in rows if row[key_index] is not None]
+            seen = set()
+            for start in range(0, len(keys), 900):
+                batch = keys[start:start + 900]
+                seen.update(found for found, in conn.execute(
+                    f"SELECT {key} FROM {table} WHERE {key} IN ({', '.join('?' * len(batch))})",
+                    batch))
+            for i, row in enumerate(rows):
+                if row[key_index] is not None:
+                    updates[i] = row[key_index] in seen
+                    seen.add(row[key_index])
+
+        try:
+            written = conn.executemany(sql, rows).rowcount
+            updated = sum(updates)
+        except sqlite3.Error:
+            # Isolate the offending rows; each statement is atomic on its own
+            conn.rollback()
+            written = updated = 0
+            for row_line, row, is_update in zip(row_lines, rows, updates):
+                try:
+                    changed = conn.execute(sql, row).rowcount
+                except sqlite3.Error as e:
+                    result['rejected'] += 1
+                    if len(result['errors']) < max_errors:
+                        result['errors'].append((int(row_line), str(e)))
+                    continue
+                written += changed
+                updated += changed if is_update else 0
+        mark_tables_changed(conn, table)
+        conn.commit()
+
+        result['rows'] += len(chunk)
+        result['written'] += written
+        result['inserted'] += written - updated
+        result['updated'] += updated
+        result['rejected'] += int(invalid.sum())
+        line += len(chunk)
+        if progress:
+            elapsed = time.perf_counter() - started
+            fraction = file.tell() / total_size if total_size else 0.0
+            progress(result['rows'], fraction, result['rows'] / elapsed if elapsed else 0.0)
+
+    result['duplicates'] = result['rows'] - result['written'] - result['rejected']
+    result['seconds'] = time.perf_counter() - started
+    result['rows_per_second'] = result['rows'] / result['seconds'] if result['seconds'] else 0.0
+    return result
+
+# Streaming export
+EXPORT_TABLES = {
+    "Customers": "customers",
+    "Deals": "deals",
+    "Tasks": "tasks",
+    "Communications": "communication_logs",
+}
+# Format -> (file suffix, mime type)
+EXPORT_FORMATS = {
+    "CSV (gzip)": ('.csv.gz', 'application/gzip'),
+    "Parquet": ('.parquet', 'application/vnd.apache.parquet'),
+}
+# Declared type -> (Arrow type, SQLite storage classes it can hold)
+# Columns export_changes adds in front of the table's own
+CHANGE_EXPORT_COLUMNS = {'_op': 'TEXT', '_change_id': 'INTEGER', '_row_id': 'INTEGER'}
+_ARROW_TYPES = {
+    'INTEGER': (pa.int64(), ('integer', 'null')),
+    'BOOLEAN': (pa.int64(), ('integer', 'null')),
+    'REAL': (pa.float64(), ('integer', 'real', 'null')),
+}
+
+def _arrow_schema(conn, table, columns, rows_sql=None):
+    """Parquet schema from the table's declared column types
+
+    SQLite does not enforce declared types, so a numeric column holding any
+    other storage class is exported as strings rather than failing mid-file.
+    rows_sql limits that check to the rows being exported.
+    """
+    declared = {name: col_type.upper()
+                for _, name, col_type, *_ in conn.execute(f"PRAGMA table_info({table})")}
+    fields = []
+    for column in columns:
+        col_type = declared.get(column, CHANGE_EXPORT_COLUMNS.get(column))
+        arrow_type, storage = _ARROW_TYPES.get(col_type, (pa.string(), None))
+        if storage and column in declared and conn.execute(
+                f"SELECT 1 FROM {rows_sql or table} WHERE typeof({column}) NOT IN "
+                f"({', '.join('?' * len(storage))}) LIMIT 1", storage).fetchone():
+            arrow_type = pa.string()
+        fields.append((column, arrow_type))
+    return pa.schema(fields)
+
+def _arrow_batch(rows, schema):
+    arrays = []
+    for field, values in zip(schema, zip(*rows)):
+        if field.type == pa.string():
+            values = [None if v is None else str(v) for v in values]
+        arrays.append(pa.array(values, type=field.type))
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+def export_query(conn, query, params, path, export_format, table, batch_size=10000,
+                 rows_sql=None, progress=None):
+    """Write a query's result to path batch by batch; returns the row count
+
+    Rows are pulled with fetchmany so memory stays bounded by batch_size
+    however large the result is. table supplies column types for Parquet.
+    progress(rows written so far) is called after each batch.
+    """
+    cursor = conn.execute(query, params)
+    columns = [d[0] for d in cursor.description]
+    count = 0
+    if export_format == "Parquet":
+        schema = _arrow_schema(conn, table, columns, rows_sql)
+        with pq.ParquetWriter(path, schema, compression='zstd') as writer:
+            while rows := cursor.fetchmany(batch_size):
+                writer.write_table(_arrow_batch(rows, schema))
+                count += len(rows)
+                if progress:
+                    progress(count)
+    else:
+        with gzip.open(path, 'wt', newline='', encoding='utf-8', compresslevel=6) as f:
+            writer = csv.writer(f)
+            writer.writerow(columns)
+            while rows := cursor.fetchmany(batch_size):
+                writer.writerows(rows)
+                count += len(rows)
+                if progress:
+                    progress(count)
+    return count
+
+def export_table(conn, table, path, export_format, batch_size=10000, progress=None):
+    """Stream a whole table to path in export_format"""
+    return export_query(conn, f"SELECT * FROM {table}", (), path, export_format, table, batch_size,
+                        progress=progress)
+
+def get_export_watermark(conn, table):
+    """Change id up to which table has been exported (0 if never)"""
+    row = conn.execute("SELECT change_id FROM export_watermarks WHERE table_name = ?",
+                       (table,)).fetchone()
+    return row[0] if row else 0
+
+def latest_change_id(conn, table):
+    row = conn.execute("SELECT MAX(id) FROM changes WHERE table_name = ?", (table,)).fetchone()
+    return row[0] or 0
+
+def save_export_watermark(conn, table, change_id):
+    """Record an export up to change_id and drop the log entries it covered"""
+    conn.execute("""INSERT INTO export_watermarks (table_name, change_id) VALUES (?, ?)
+                    ON CONFLICT(table_name) DO UPDATE
+                    SET change_id = MAX(change_id, excluded.change_id),
+                        exported_at = CURRENT_TIMESTAMP""",
+                 (table, change_id))
+    conn.execute("DELETE FROM changes WHERE table_name = ? AND id <= ?", (table, change_id))
+    conn.commit()
+
+def export_changes(conn, table, path, export_format, since=0, batch_size=10000, progress=None):
+    """Export the rows of table changed after change id since
+
+    Each changed row appears once with its latest operation in _op; deleted
+    rows carry only _op and _row_id. Cost follows the number of changes,
+    not the table size. Returns (row count, new watermark).
+    """
+    until = latest_change_id(conn, table)
+    query = f"""SELECT c.op AS _op, c.id AS _change_id, c.row_id AS _row_id, t.*
+                FROM (SELECT MAX(id) AS id FROM changes
+                      WHERE table_name = ? AND id > ? AND id <= ?
+                      GROUP BY row_id) latest
+                JOIN changes c ON c.id = latest.id
+                LEFT JOIN {table} t ON t.id = c.row_id AND c.op != 'DELETE'
+                ORDER BY c.id"""
+    changed_rows = (f"(SELECT t.* FROM changes c JOIN {table} t ON t.id = c.row_id "
+                    f"WHERE c.table_name = '{table}' AND c.id > {int(since)} AND c.id <= {int(until)})")
+    count = export_query(conn, query, (table, since, until), path, export_format, table,
+                         batch_size, changed_rows, progress)
+    return count, max(until, since)
+
 def import_export_data():
     st.subheader("Data Import/Export")
     
     # Export Data
     st.write("### Export Data")
-    export_type = st.selectbox("Select data to export", 
-                              ["Customers", "Deals", "Tasks", "Communications"])
+    export_type = st.selectbox("Select data to export", list(EXPORT_TABLES))
+    export_format = st.radio("Export format", list(EXPORT_FORMATS), horizontal=True)
+    export_mode = st.radio("Export mode", ["Full table", "Changes since last export"],
+                           horizontal=True)
+    conn = get_client_db()
+    table = EXPORT_TABLES[export_type]
+    watermark = get_export_watermark(conn, table)
+    if export_mode != "Full table":
+        pending = conn.execute("SELECT COUNT(*) FROM changes WHERE table_name = ? AND id > ?",
+                               (table, watermark)).fetchone()[0]
+        st.caption(f"{pending:,} changes logged since the last export"
+                   if watermark else "No previous export; run a full export first")
     
-    if st.button("Export to CSV"):
-        conn = get_client_db()
-        if export_type == "Customers":
-            df = pd.read_sql_query("SELECT * FROM customers", conn)
-        elif export_type == "Deals":
-            df = pd.read_sql_query("SELECT * FROM deals", conn)
-        elif export_type == "Tasks":
-            df = pd.read_sql_query("SELECT * FROM tasks", conn)
+    if st.button("Prepare Export"):
+        if active_job(conn, 'export'):
+            st.warning("Another export is still running")
         else:
-            df = pd.read_sql_query("SELECT * FROM communication_logs", conn)
-        
-        csv = df.to_csv(index=False)
-        st.download_button(
-            label="Download CSV",
-            data=csv,
-            file_name=f"{export_type.lower()}_export.csv",
-            mime="text/csv"
-        )
+            # The new file replaces earlier exports of the same table. Changes in
+            # one that was never downloaded are still logged, so it covers them too
+            for (result,) in conn.execute("""SELECT result FROM background_jobs
+                                             WHERE kind = 'export' AND status = 'succeeded'
+                                               AND json_extract(result, '$.table') = ?""",
+                                          (table,)).fetchall():
+                Path(json.loads(result)['path']).unlink(missing_ok=True)
+            JobRunner.instance().submit(conn, st.session_state.client_db, 'export',
+                                        f"{export_type} export ({export_format})", export_job,
+                                        table, export_type, export_format,
+                                        export_mode != "Full table")
+    show_jobs('export')
     
     # Import Data
     st.write("### Import Data")
     import_type = st.selectbox("Select data to import", 
                               ["Customers", "Deals", "Tasks"])
-    uploaded_file = st.file_uploader("Choose a CSV file")
+    uploaded_file = st.file_uploader("Choose a CSV file", type=['csv'])
     
     if uploaded_file is not None:
+        conn = get_client_db()
+        table_name = import_type.lower()
         try:
-            df = pd.read_csv(uploaded_file)
-            st.write("Preview of data to be imported:")
-            st.write(df.head())
-            
-            if st.button("Confirm Import"):
-                conn = get_client_db()
-                table_name = import_type.lower()
-                df.to_sql(table_name, conn, if_exists='append', index=False)
-                st.success(f"Successfully imported {len(df)} records!")
+            preview = pd.read_csv(uploaded_file, nrows=5, dtype=str, keep_default_na=False)
         except Exception as e:
-            st.error(f"Error importing data: {str(e)}")
+            st.error(f"Could not read CSV: {str(e)}")
+            return
+        uploaded_file.seek(0)
+        st.write("Preview of data to be imported:")
+        st.write(preview)
+
+        targets = import_target_columns(conn, table_name)
+        suggested = auto_map_columns(preview.columns, targets)
+        mapping = {}
+        with st.expander("Column mapping", expanded=True):
+            options = ["(skip)"] + list(preview.columns)
+            for target in targets:
+                default = suggested.get(target)
+                choice = st.selectbox(target, options,
+                                      index=options.index(default) if default else 0,
+                                      key=f"import_map_{table_name}_{target}")
+                if choice != "(skip)":
+                    mapping[choice] = target
+
+        on_duplicate = 'skip'
+        if IMPORT_TABLES[table_name]['key']:
+            on_duplicate = st.radio(
+                f"Rows whose {IMPORT_TABLES[table_name]['key']} already exists",
+                ['skip', 'update'], horizontal=True,
+                format_func={'skip': "Skip", 'update': "Update existing record"}.get)
+        chunk_size = st.select_slider("Rows per transaction", [1000, 5000, 10000, 50000], value=5000)
+
+        if st.button("Confirm Import"):
+            if active_job(conn, 'import'):
+                st.warning("Another import is still running")
+            else:
+                # The job reads its own copy; the upload is reused by later reruns
+                fd, path = tempfile.mkstemp(prefix=f"import_{table_name}_", suffix=".csv")
+                with os.fdopen(fd, 'wb') as f:
+                    shutil.copyfileobj(uploaded_file, f)
+                uploaded_file.seek(0)
+                JobRunner.instance().submit(conn, st.session_state.client_db, 'import',
+                                            f"Import of {uploaded_file.name} into {table_name}",
+                                            import_job, path, table_name, mapping,
+                                            chunk_size, on_duplicate)
+
+    show_jobs('import')
 
-def update_advanced_schema():
-    conn = get_client_db()
-    c = conn.cursor()
-    
-    # Calendar events
-    c.execute('''CREATE TABLE IF NOT EXISTS calendar_events
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  title TEXT,
-                  description TEXT,
-                  start_time TIMESTAMP,
-                  end_time TIMESTAMP,
-                  customer_id INTEGER,
-                  event_type TEXT,
-                  location TEXT,
-                  attendees TEXT,
-                  FOREIGN KEY (customer_id) REFERENCES customers(id))''')
-    
-    # Document storage
-    c.execute('''CREATE TABLE IF NOT EXISTS documents
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  name TEXT,
-                  type TEXT,
-                  content BLOB,
-                  customer_id INTEGER,
-                  upload_date TIMESTAMP,
-                  tags TEXT,
-                  FOREIGN KEY (customer_id) REFERENCES customers(id))''')
-    
-    # Automation rules
-    c.execute('''CREATE TABLE IF NOT EXISTS automation_rules
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  name TEXT,
-                  trigger_type TEXT,
-                  trigger_conditions TEXT,
-                  action_type TEXT,
-                  action_details TEXT,
-                  is_active BOOLEAN)''')
-    
-    # Lead scoring rules
-    c.execute('''CREATE TABLE IF NOT EXISTS lead_scoring_rules
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                  attribute TEXT,
-                  condition TEXT,
-                  score INTEGER)''')
-    
-    conn.commit()
-    return conn
 def content_management():
     st.subheader("Content Management")
     
@@ -1115,6 +2908,7 @@ def workflow_automation():
                         VALUES (?, ?, ?, ?, ?)""",
                      (name, trigger, json.dumps(workflow_data["conditions"]), 
                       json.dumps(workflow_data["actions"]), "active"))
+            mark_tables_changed(conn, 'workflows')
             conn.commit()
             
 def calendar_management():
@@ -1168,44 +2962,732 @@ def calendar_management():
                 mime="text/calendar"
             )
 
+class BlobStore:
+    """Deduplicated on-disk file store keyed by the SHA-256 of the content
+
+    Blobs live at <root>/<hash[:2]>/<hash>. Writes stream into a staged
+    temp file that is renamed into place, so a blob is either complete or
+    absent. Callers publish and detach blobs inside a write transaction
+    (BEGIN IMMEDIATE), which orders them against each other's reference
+    checks across every connection and process.
+    """
+    chunk_size = 1024 * 1024
+
+    def __init__(self, root):
+        self.root = Path(root)
+
+    @classmethod
+    def for_tenant(cls, client_db):
+        return cls(DatabaseManager.pool().db_dir / "blobs" / Path(client_db).stem)
+
+    def path(self, content_hash):
+        return self.root / content_hash[:2] / content_hash
+
+    def stage(self, stream):
+        """Write a binary stream to a temp file; returns (temp path, content hash, size)"""
+        self.root.mkdir(parents=True, exist_ok=True)
+        digest, size = hashlib.sha256(), 0
+        fd, tmp = tempfile.mkstemp(dir=self.root, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                while chunk := stream.read(self.chunk_size):
+                    digest.update(chunk)
+                    f.write(chunk)
+                    size += len(chunk)
+        except BaseException:
+            Path(tmp).unlink(missing_ok=True)
+            raise
+        return tmp, digest.hexdigest(), size
+
+    def publish(self, tmp, content_hash):
+        """Move a staged file into place, or drop it if the content is already stored"""
+        target = self.path(content_hash)
+        if target.exists():
+            os.unlink(tmp)
+        else:
+            target.parent.mkdir(exist_ok=True)
+            os.replace(tmp, target)
+
+    def open(self, content_hash):
+        return open(self.path(content_hash), 'rb')
+
+    def detach(self, content_hash):
+        """Rename a blob aside for deletion; returns the new path, or None if absent"""
+        path = self.path(content_hash)
+        detached = path.with_name(path.name + '.deleted')
+        try:
+            os.replace(path, detached)
+        except FileNotFoundError:
+            return None
+        return detached
+
+# Where new documents are stored: app_settings value -> label
+DOCUMENT_STORAGE_OPTIONS = {
+    'files': "File store (deduplicated on disk)",
+    'database': "Inside the database",
+}
+
+def get_app_setting(conn, key, default=None):
+    row = conn.execute("SELECT value FROM app_settings WHERE key = ?", (key,)).fetchone()
+    return row[0] if row else default
+
+def set_app_setting(conn, key, value):
+    conn.execute("""INSERT INTO app_settings (key, value) VALUES (?, ?)
+                    ON CONFLICT(key) DO UPDATE SET value = excluded.value""", (key, value))
+    conn.commit()
+
+def insert_document(conn, store, file, customer_id, tags, storage='files'):
+    """Insert a document, streaming its content to the blob store or a BLOB
+
+    Database storage reserves the BLOB with zeroblob() and fills it through
+    incremental BLOB I/O, so neither path holds the whole file in memory.
+    """
+    size = file.seek(0, io.SEEK_END)
+    file.seek(0)
+    content_hash = staged = None
+    if storage == 'files':
+        staged, content_hash, size = store.stage(file)
+    if conn.in_transaction:
+        conn.commit()
+    # Publish and insert under the write lock delete_document checks references with
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        if staged:
+            store.publish(staged, content_hash)
+            staged = None
+        cursor = conn.execute("""INSERT INTO documents
+                                 (name, type, content, content_hash, size, customer_id, upload_date, tags)
+                                 VALUES (?, ?, CASE WHEN ? IS NULL THEN zeroblob(?) END, ?, ?, ?, ?, ?)""",
+                              (file.name, file.type, content_hash, size, content_hash, size,
+                               customer_id, datetime.now(), tags))
+        if content_hash is None:
+            with conn.blobopen('documents', 'content', cursor.lastrowid) as blob:
+                while chunk := file.read(store.chunk_size):
+                    blob.write(chunk)
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        if staged:
+            Path(staged).unlink(missing_ok=True)
+        raise
+    return cursor.lastrowid
+
+def open_document(conn, store, doc_id):
+    """File-like reader over a document, wherever its content is stored"""
+    content_hash, in_database = conn.execute(
+        "SELECT content_hash, content IS NOT NULL FROM documents WHERE id = ?",
+        (doc_id,)).fetchone()
+    if content_hash:
+        return store.open(content_hash)
+    if in_database:
+        return conn.blobopen('documents', 'content', doc_id, readonly=True)
+    return io.BytesIO()
+
+def load_document(client_db, doc_id):
+    """Content of a document for a download button
+
+    Uses its own pooled connection so it can run after the script run
+    that rendered the button has finished. The whole content is read:
+    st.download_button reads a returned file object into memory anyway,
+    so handing it the open file would only leave it unclosed.
+    """
+    pool = DatabaseManager.pool()
+    conn = pool.acquire(client_db)
+    try:
+        with open_document(conn, BlobStore.for_tenant(client_db), doc_id) as f:
+            return f.read()
+    finally:
+        pool.release(client_db, conn)
+
+def delete_document(conn, store, doc_id):
+    """Delete a document and its blob once no other document shares it
+
+    The reference check and detaching the blob happen in one write
+    transaction, so a concurrent upload of the same content either lands
+    first (and keeps the blob) or publishes a fresh copy afterwards.
+    """
+    if conn.in_transaction:
+        conn.commit()
+    conn.execute("BEGIN IMMEDIATE")
+    detached = None
+    try:
+        row = conn.execute("SELECT content_hash FROM documents WHERE id = ?", (doc_id,)).fetchone()
+        conn.execute("DELETE FROM documents WHERE id = ?", (doc_id,))
+        if row and row[0] and not conn.execute(
+                "SELECT 1 FROM documents WHERE content_hash = ? LIMIT 1", row).fetchone():
+            detached = store.detach(row[0])
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        if detached:
+            os.replace(detached, store.path(row[0]))
+        raise
+    if detached:
+        detached.unlink(missing_ok=True)
+
+def move_documents_to_store(conn, store):
+    """Move legacy BLOB contents into the blob store one document at a time"""
+    ids = [row[0] for row in conn.execute(
+        "SELECT id FROM documents WHERE content_hash IS NULL AND content IS NOT NULL")]
+    for doc_id in ids:
+        with conn.blobopen('documents', 'content', doc_id, readonly=True) as blob:
+            staged, content_hash, size = store.stage(blob)
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            store.publish(staged, content_hash)
+            conn.execute("UPDATE documents SET content_hash = ?, size = ?, content = NULL "
+                         "WHERE id = ?", (content_hash, size, doc_id))
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            Path(staged).unlink(missing_ok=True)
+            raise
+    return len(ids)
+
+DOCUMENT_PREVIEW_BYTES = 64 * 1024
+
 def document_management():
     st.subheader("Document Management")
+    conn = get_client_db()
+    store = BlobStore.for_tenant(st.session_state.client_db)
     
     # Upload document
     uploaded_file = st.file_uploader("Upload Document", 
         type=['pdf', 'doc', 'docx', 'txt'])
     if uploaded_file:
-        name = uploaded_file.name
-        content = uploaded_file.read()
-        customer_id = st.selectbox("Related Customer",
-            pd.read_sql_query("SELECT id, name FROM customers", init_db())['name'])
+        customers = pd.read_sql_query("SELECT id, name FROM customers", conn)
+        customer_names = dict(zip(customers['id'], customers['name']))
+        customer_id = st.selectbox("Related Customer", list(customer_names),
+                                   format_func=customer_names.get)
         tags = st.text_input("Tags (comma-separated)")
         
         if st.button("Save Document"):
-            conn = get_client_db()
-            c = conn.cursor()
-            c.execute("""INSERT INTO documents
-                        (name, type, content, customer_id, upload_date, tags)
-                        VALUES (?, ?, ?, ?, ?, ?)""",
-                     (name, uploaded_file.type, content, 
-                      customer_id, datetime.now(), tags))
-            conn.commit()
+            insert_document(conn, store, uploaded_file,
+                            None if customer_id is None else int(customer_id), tags,
+                            storage=get_app_setting(conn, 'document_storage', 'files'))
             st.success("Document uploaded successfully!")
 
+    # Stored documents
+    documents = pd.read_sql_query("""
+        SELECT d.id, d.name, d.type, COALESCE(d.size, length(d.content)) as size,
+               c.name as customer, d.upload_date, d.tags
+        FROM documents d LEFT JOIN customers c ON d.customer_id = c.id
+        ORDER BY d.id DESC
+    """, conn)
+    if documents.empty:
+        return
+    st.write("### Documents")
+    st.dataframe(documents, hide_index=True)
+
+    legacy = conn.execute("SELECT COUNT(*) FROM documents "
+                          "WHERE content_hash IS NULL AND content IS NOT NULL").fetchone()[0]
+    if legacy and st.button(f"Move {legacy} documents stored in the database to the file store"):
+        moved = move_documents_to_store(conn, store)
+        st.success(f"Moved {moved} documents")
+
+    names = dict(zip(documents['id'], documents['name']))
+    doc_id = int(st.selectbox("Document", list(names), format_func=names.get))
+    doc = documents.set_index('id').loc[doc_id]
+    col1, col2 = st.columns(2)
+    with col1:
+        # Read from disk only when the download is requested
+        st.download_button("Download", data=partial(load_document, st.session_state.client_db, doc_id),
+                           file_name=doc['name'], mime=doc['type'] or None)
+    with col2:
+        if st.button("Delete Document"):
+            delete_document(conn, store, doc_id)
+            st.rerun()
+
+    if (doc['type'] or '').startswith('text/'):
+        with open_document(conn, store, doc_id) as f:
+            head = f.read(DOCUMENT_PREVIEW_BYTES)
+        st.text(head.decode('utf-8', errors='replace'))
+        if doc['size'] and doc['size'] > DOCUMENT_PREVIEW_BYTES:
+            st.caption(f"Showing the first {DOCUMENT_PREVIEW_BYTES // 1024} KB")
+
+# Automation engine
+# Workflow condition field -> customers column
+WORKFLOW_FIELDS = {"Email": 'email', "Company Size": 'company_size', "Industry": 'industry'}
+# Customer columns an "Update Field" action may set
+AUTOMATION_UPDATE_FIELDS = ['status', 'industry', 'lead_source']
+
+def _as_number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class AutomationRuleIndex:
+    """Active automation rules and workflows, indexed for event matching
+
+    Conditions are parsed once when the index is built. Each trigger type
+    has its own lookup structure, so an event only touches the rules that
+    can match it: stage pairs, lead sources and equality conditions are
+    dict keys, score and numeric thresholds are sorted for bisection.
+    """
+
+    def __init__(self, rules, workflows):
+        self.stage_changes = {}        # (from stage, to stage) -> [rule]
+        self.new_leads = {}            # lead source -> ([minimum score], [rule]) sorted
+        self.score_thresholds = ([], [])  # sorted thresholds, rules
+        self.task_due = []
+        self.workflows = {}            # trigger -> {'equals', 'greater', 'contains'}
+        self.size = 0
+
+        for rule_id, name, trigger_type, conditions, action_type, details in rules:
+            rule = {'source': 'rule', 'id': rule_id, 'name': name,
+                    'action_type': action_type, 'details': json.loads(details or '{}')}
+            conditions = json.loads(conditions or '{}')
+            if trigger_type == 'Deal Stage Change':
+                key = (conditions.get('from_stage'), conditions.get('to_stage'))
+                self.stage_changes.setdefault(key, []).append(rule)
+            elif trigger_type == 'New Lead':
+                self._insort(self.new_leads.setdefault(conditions.get('lead_source'), ([], [])),
+                             _as_number(conditions.get('minimum_score')) or 0, rule)
+            elif trigger_type == 'Score Change':
+                self._insort(self.score_thresholds,
+                             _as_number(conditions.get('minimum_score')) or 0, rule)
+            elif trigger_type == 'Task Due':
+                self.task_due.append(rule)
+            else:
+                continue
+            self.size += 1
+
+        for workflow_id, name, trigger_type, conditions, actions in workflows:
+            conditions = json.loads(conditions or '{}')
+            index = self.workflows.setdefault(
+                trigger_type, {'equals': {}, 'greater': {}, 'contains': []})
+            field = WORKFLOW_FIELDS.get(conditions.get('field'))
+            value = str(conditions.get('value') or '').strip()
+            operator = conditions.get('operator')
+            workflow = {'source': 'workflow', 'id': workflow_id, 'name': name,
+                        'actions': json.loads(actions or '[]')}
+            if field is None:
+                continue
+            if operator == 'Equals':
+                index['equals'].setdefault((field, value.lower()), []).append(workflow)
+            elif operator == 'Greater Than' and _as_number(value) is not None:
+                self._insort(index['greater'].setdefault(field, ([], [])), _as_number(value), workflow)
+            elif operator == 'Contains':
+                index['contains'].append((field, value.lower(), workflow))
+            else:
+                continue
+            self.size += 1
+
+    @staticmethod
+    def _insort(pair, key, rule):
+        keys, rules = pair
+        position = bisect.bisect_right(keys, key)
+        keys.insert(position, key)
+        rules.insert(position, rule)
+
+    def _workflow_matches(self, trigger_type, customer):
+        index = self.workflows.get(trigger_type)
+        if not index or not customer:
+            return []
+        matched = []
+        for field in WORKFLOW_FIELDS.values():
+            value = customer.get(field)
+            matched.extend(index['equals'].get((field, str(value if value is not None else '').lower()), []))
+            number = _as_number(value)
+            if number is not None and field in index['greater']:
+                keys, rules = index['greater'][field]
+                matched.extend(rules[:bisect.bisect_left(keys, number)])
+        # Substring conditions cannot be keyed and are checked one by one
+        matched.extend(workflow for field, needle, workflow in index['contains']
+                       if needle in str(customer.get(field) or '').lower())
+        return matched
+
+    def match(self, event_type, payload, customer):
+        """Rules and workflows that an event fires"""
+        if event_type == 'Deal Stage Change':
+            rules = self.stage_changes.get((payload.get('from_stage'), payload.get('to_stage')), [])
+        elif event_type == 'New Lead':
+            keys, candidates = self.new_leads.get(payload.get('lead_source'), ([], []))
+            score = (customer or {}).get('lead_score') or 0
+            rules = candidates[:bisect.bisect_right(keys, score)]
+        elif event_type == 'Score Change':
+            # Rules whose threshold was crossed upwards: old < threshold <= new
+            keys, candidates = self.score_thresholds
+            old, new = payload.get('old_score') or 0, payload.get('new_score') or 0
+            rules = candidates[bisect.bisect_right(keys, old):bisect.bisect_right(keys, new)]
+        elif event_type == 'Task Due':
+            rules = self.task_due
+        else:
+            rules = []
+        return list(rules) + self._workflow_matches(event_type, customer)
+
+def get_automation_index(conn, client_db=None):
+    """AutomationRuleIndex of active rules, cached until the rule tables change"""
+    def build():
+        rules = conn.execute("""SELECT id, name, trigger_type, trigger_conditions, action_type,
+                                       action_details
+                                FROM automation_rules WHERE is_active""").fetchall()
+        workflows = conn.execute("""SELECT id, name, trigger_type, conditions, actions
+                                    FROM workflows WHERE status = 'active'""").fetchall()
+        return AutomationRuleIndex(rules, workflows)
+
+    if client_db is None:
+        return build()
+    return MetricsCache.get(client_db, 'automation_index', ['automation_rules', 'workflows'], build)
+
+def execute_automation_action(conn, action_type, details, customer, rule_name):
+    """Carry out one action for a customer; returns (status, detail, table written)"""
+    customer_id = customer['id'] if customer else None
+    if details is None:
+        return 'skipped', f"{action_type} needs parameters workflows do not store", None
+    if action_type == "Send Email":
+        template = conn.execute("SELECT subject, body FROM email_templates WHERE id = ?",
+                                (details.get('template_id'),)).fetchone()
+        if template is None:
+            return 'skipped', "template not found", None
+        if not customer or clean_email_address(customer.get('email')) is None:
+            return 'skipped', "customer has no valid email address", None
+        rendered = render_emails(conn, *template, after_id=customer_id - 1, limit=1)
+        queue_emails(conn, rendered.itertuples(index=False, name=None), commit=False)
+        return 'done', f"queued email to {customer['email']}", 'communication_logs'
+    if action_type == "Create Task":
+        conn.execute("""INSERT INTO tasks (customer_id, title, description, status)
+                        VALUES (?, ?, ?, 'Not Started')""",
+                     (customer_id, details.get('task_title') or rule_name,
+                      f"Assigned to {details.get('assignee', 'team')} by automation '{rule_name}'"))
+        return 'done', "task created", 'tasks'
+    if action_type == "Create Deal":
+        conn.execute("""INSERT INTO deals (customer_id, title, amount, stage, probability)
+                        VALUES (?, ?, 0, 'Prospecting', 10)""", (customer_id, rule_name))
+        return 'done', "deal created", 'deals'
+    if action_type == "Update Field":
+        field = details.get('field')
+        if field not in AUTOMATION_UPDATE_FIELDS or customer_id is None:
+            return 'skipped', f"cannot update {field}", None
+        conn.execute(f"UPDATE customers SET {field} = ? WHERE id = ?", (details.get('value'), customer_id))
+        return 'done', f"{field} set to {details.get('value')}", 'customers'
+    if action_type == "Notify Team":
+        conn.execute("""INSERT INTO internal_messages (sender_id, receiver_id, message, sent_date, read_status)
+                        VALUES (NULL, NULL, ?, ?, 0)""",
+                     (details.get('message') or f"Automation '{rule_name}' fired"
+                      + (f" for {customer['name']}" if customer else ""), datetime.now()))
+        return 'done', "team notified", None
+    return 'skipped', f"{action_type} has no parameters to run with", None
+
+def _load_automation_customers(conn, customer_ids):
+    """Customer fields rules and actions use, keyed by id, in one query"""
+    customer_ids = list({customer_id for customer_id in customer_ids if customer_id is not None})
+    if not customer_ids:
+        return {}
+    cursor = conn.execute(f"""SELECT id, name, email, status, lead_score, company_size,
+                                     industry, lead_source
+                              FROM customers WHERE id IN ({', '.join('?' * len(customer_ids))})""",
+                          customer_ids)
+    columns = [d[0] for d in cursor.description]
+    return {row[0]: dict(zip(columns, row)) for row in cursor}
+
+def process_automation_events(conn, client_db=None, batch_size=500, max_batches=None):
+    """Match due automation events against the rule index and run their actions
+
+    Customer and task details for a batch are loaded with one query each.
+    Each batch is claimed, handled and deleted under one write lock, so
+    concurrent callers never run the same event twice. Returns the number
+    processed.
+    """
+    index = get_automation_index(conn, client_db)
+    processed, batches = 0, 0
+    while max_batches is None or batches < max_batches:
+        if conn.in_transaction:
+            conn.commit()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            count, changed = _process_automation_batch(conn, index, batch_size)
+            if not count:
+                conn.rollback()
+                break
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        processed += count
+        batches += 1
+        if client_db and 'communication_logs' in changed:
+            EmailOutboxWorker.instance().notify(client_db)
+        if client_db and 'scheduled_actions' in changed:
+            ActionScheduler.instance().notify(client_db)
+    return processed
+
+def _process_automation_batch(conn, index, batch_size):
+    """Handle one batch of due events inside the caller's transaction
+
+    Returns (events handled, tables written); no events means none was due.
+    """
+    events = conn.execute("""SELECT id, event_type, customer_id, entity_id, payload
+                             FROM automation_events WHERE available_at <= datetime('now')
+                             ORDER BY available_at, id LIMIT ?""", (batch_size,)).fetchall()
+    if not events:
+        return 0, set()
+    customers = _load_automation_customers(conn, [event[2] for event in events])
+    task_ids = [event[3] for event in events if event[1] == 'Task Due']
+    tasks = {}
+    if task_ids:
+        tasks = {row[0]: row[1:] for row in conn.execute(
+            f"SELECT id, due_date, status FROM tasks WHERE id IN ({', '.join('?' * len(task_ids))})",
+            task_ids)}
+
+    runs, changed = [], {'automation_events'}
+    for event_id, event_type, customer_id, entity_id, payload in events:
+        payload = json.loads(payload or '{}')
+        if event_type == 'Task Due':
+            # Skip tasks completed, deleted or rescheduled since the event was raised
+            due_date, status = tasks.get(entity_id, (None, None))
+            if due_date != payload.get('due_date') or status == 'Completed':
+                continue
+        customer = customers.get(customer_id)
+        for rule in index.match(event_type, payload, customer):
+            actions = ([(rule['action_type'], rule['details'])] if rule['source'] == 'rule'
+                       else [(action, {} if action in ("Create Task", "Create Deal") else None)
+                             for action in rule['actions']])
+            for action_type, details in actions:
+                delay = _as_number((details or {}).get('delay_hours')) or 0
+                if delay > 0:
+                    run_at = time.time() + delay * 3600
+                    conn.execute("""INSERT INTO scheduled_actions
+                                    (rule_id, rule_name, event_type, customer_id, action_type,
+                                     details, run_at) VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                                 (rule['id'], rule['name'], event_type, customer_id,
+                                  action_type, json.dumps(details), run_at))
+                    status, detail, table = 'scheduled', f"runs in {delay:g} hours", 'scheduled_actions'
+                else:
+                    try:
+                        status, detail, table = execute_automation_action(
+                            conn, action_type, details, customer, rule['name'])
+                    except (sqlite3.Error, ValueError, TypeError) as e:
+                        status, detail, table = 'failed', str(e), None
+                if table:
+                    changed.add(table)
+                runs.append((rule['source'], rule['id'], event_type, customer_id,
+                             action_type, status, detail))
+    conn.executemany("""INSERT INTO automation_runs
+                        (source, rule_id, event_type, customer_id, action_type, status, detail)
+                        VALUES (?, ?, ?, ?, ?, ?, ?)""", runs)
+    conn.executemany("DELETE FROM automation_events WHERE id = ?", [(event[0],) for event in events])
+    mark_tables_changed(conn, *changed)
+    return len(events), changed
+
+def run_scheduled_actions(conn, job_ids, lease=300, max_attempts=3, retry_delay=300):
+    """Claim and execute scheduled actions; returns tables written
+
+    A claim is a lease on locked_until, so a job whose runner died becomes
+    due again once the lease expires. Finished jobs are deleted and logged
+    to automation_runs; failures retry until max_attempts.
+    """
+    now = time.time()
+    jobs = conn.execute(
+        f"""UPDATE scheduled_actions SET locked_until = ?
+            WHERE id IN ({', '.join('?' * len(job_ids))}) AND status = 'pending'
+              AND run_at <= ? AND (locked_until IS NULL OR locked_until < ?)
+            RETURNING id, rule_id, rule_name, event_type, customer_id, action_type, details, attempts""",
+        [now + lease, *job_ids, now, now]).fetchall()
+    conn.commit()
+    if not jobs:
+        return set()
+
+    customers = _load_automation_customers(conn, [job[4] for job in jobs])
+    changed, runs, done, retry, failed = {'scheduled_actions'}, [], [], [], []
+    for job_id, rule_id, rule_name, event_type, customer_id, action_type, details, attempts in jobs:
+        details = json.loads(details or '{}')
+        details.pop('delay_hours', None)
+        try:
+            status, detail, table = execute_automation_action(
+                conn, action_type, details, customers.get(customer_id), rule_name)
+        except (sqlite3.Error, ValueError, TypeError) as e:
+            status, detail, table = 'failed', str(e), None
+        if table:
+            changed.add(table)
+        if status != 'failed':
+            done.append((job_id,))
+        elif attempts + 1 >= max_attempts:
+            failed.append((detail, job_id))
+        else:
+            retry.append((time.time() + retry_delay, detail, job_id))
+        runs.append(('rule', rule_id, event_type, customer_id, action_type, status, detail))
+    conn.executemany("DELETE FROM scheduled_actions WHERE id = ?", done)
+    conn.executemany("""UPDATE scheduled_actions SET attempts = attempts + 1, run_at = ?,
+                        last_error = ?, locked_until = NULL WHERE id = ?""", retry)
+    conn.executemany("""UPDATE scheduled_actions SET attempts = attempts + 1, status = 'failed',
+                        last_error = ?, locked_until = NULL WHERE id = ?""", failed)
+    conn.executemany("""INSERT INTO automation_runs
+                        (source, rule_id, event_type, customer_id, action_type, status, detail)
+                        VALUES (?, ?, ?, ?, ?, ?, ?)""", runs)
+    mark_tables_changed(conn, *changed)
+    conn.commit()
+    return changed
+
+
+class ActionScheduler:
+    """Process-wide timer that runs delayed automation actions when due
+
+    Jobs are durable rows in each tenant's scheduled_actions table. The
+    timer thread keeps the jobs due within `lookahead` seconds in a heap,
+    loaded through the partial index on pending run_at, sleeps until the
+    earliest one and hands due batches to a thread pool. On start it picks
+    up every tenant with pending jobs, so schedules survive restarts.
+    """
+
+    def __init__(self, db_dir, workers=4, lookahead=60, batch_size=100, max_loaded=5000,
+                 profile=None):
+        self.db_dir = Path(db_dir)
+        self.lookahead = lookahead
+        self.batch_size = batch_size
+        self.max_loaded = max_loaded
+        self.profile = profile
+        self.workers = workers
+        self._heap = []          # (run_at, client_db, job id)
+        self._loaded = set()     # (client_db, job id) in the heap or running
+        self._tenants = set()
+        self._stale = set()      # tenants to reload before the next refill
+        self._saturated = set()  # tenants with more due jobs than max_loaded
+        self._next_refill = 0
+        self._stopping = False
+        self._cond = threading.Condition()
+        self._executor = None
+        self._thread = None
+
+    @staticmethod
+    def instance():
+        """The shared scheduler, started on first use"""
+        return _shared_action_scheduler()
+
+    def start(self):
+        self._executor = ThreadPoolExecutor(max_workers=self.workers,
+                                            thread_name_prefix="scheduled-actions")
+        for db_path in sorted(self.db_dir.glob("*.db")):
+            conn = self._connect(db_path.name)
+            try:
+                if conn.execute("SELECT 1 FROM scheduled_actions WHERE status = 'pending' LIMIT 1").fetchone():
+                    self._tenants.add(db_path.name)
+            except sqlite3.Error:
+                pass  # not migrated yet
+            finally:
+                conn.close()
+        self._thread = threading.Thread(target=self._run, name="action-scheduler", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=10):
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        self._thread.join(timeout)
+        self._executor.shutdown(wait=True)
+
+    def notify(self, client_db):
+        """Tell the scheduler a tenant has new or changed jobs"""
+        with self._cond:
+            self._tenants.add(client_db)
+            self._stale.add(client_db)
+            self._cond.notify()
+
+    def _connect(self, client_db):
+        conn = sqlite3.connect(str(self.db_dir / client_db), check_same_thread=False)
+        return apply_sqlite_profile(conn, self.profile)
+
+    def _refill(self, tenants):
+        """Load pending jobs due within the lookahead window into the heap"""
+        now = time.time()
+        for client_db in tenants:
+            conn = self._connect(client_db)
+            try:
+                rows = conn.execute("""SELECT id, run_at FROM scheduled_actions
+                                       WHERE status = 'pending' AND run_at <= ?
+                                         AND (locked_until IS NULL OR locked_until < ?)
+                                       ORDER BY run_at LIMIT ?""",
+                                    (now + self.lookahead, now, self.max_loaded)).fetchall()
+                has_more = rows or conn.execute(
+                    "SELECT 1 FROM scheduled_actions WHERE status = 'pending' LIMIT 1").fetchone()
+            except sqlite3.Error:
+                continue
+            finally:
+                conn.close()
+            with self._cond:
+                for job_id, run_at in rows:
+                    if (client_db, job_id) not in self._loaded:
+                        self._loaded.add((client_db, job_id))
+                        heapq.heappush(self._heap, (run_at, client_db, job_id))
+                if len(rows) == self.max_loaded:
+                    self._saturated.add(client_db)
+                if not has_more:
+                    self._tenants.discard(client_db)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if self._stopping:
+                    return
+                now = time.time()
+                if now >= self._next_refill:
+                    tenants, self._next_refill = set(self._tenants), now + self.lookahead / 2
+                    self._stale.clear()
+                else:
+                    tenants, self._stale = self._stale, set()
+            if tenants:
+                self._refill(tenants)
+
+            with self._cond:
+                now = time.time()
+                due = {}
+                while self._heap and self._heap[0][0] <= now:
+                    _, client_db, job_id = heapq.heappop(self._heap)
+                    due.setdefault(client_db, []).append(job_id)
+                if not due and not self._stale and not self._stopping:
+                    wake_at = min(self._heap[0][0] if self._heap else self._next_refill,
+                                  self._next_refill)
+                    self._cond.wait(max(wake_at - now, 0))
+            for client_db, job_ids in due.items():
+                for start in range(0, len(job_ids), self.batch_size):
+                    self._executor.submit(self._run_batch, client_db, job_ids[start:start + self.batch_size])
+
+    def _run_batch(self, client_db, job_ids):
+        pool = DatabaseManager.pool()
+        conn = pool.acquire(client_db)
+        try:
+            changed = run_scheduled_actions(conn, job_ids)
+        except sqlite3.Error:
+            changed = set()  # left pending; reloaded once its lease expires
+        finally:
+            pool.release(client_db, conn)
+            with self._cond:
+                self._loaded.difference_update((client_db, job_id) for job_id in job_ids)
+                if client_db in self._saturated:
+                    # A backlog larger than one load: fetch the next jobs now
+                    self._saturated.discard(client_db)
+                    self._stale.add(client_db)
+                    self._cond.notify()
+        if 'communication_logs' in changed:
+            EmailOutboxWorker.instance().notify(client_db)
+
+@st.cache_resource(show_spinner=False, on_release=ActionScheduler.stop)
+def _shared_action_scheduler():
+    scheduler = ActionScheduler(DatabaseManager.pool().db_dir, profile=DatabaseManager.profile)
+    scheduler.start()
+    return scheduler
+
 def automation_rules():
     st.subheader("Automation Rules")
+    conn = get_client_db()
     
+    # Trigger and action are chosen outside the form so their fields update
+    trigger_type = st.selectbox("Trigger", 
+        ["New Lead", "Deal Stage Change", "Task Due", "Score Change"])
+    action_type = st.selectbox("Action",
+        ["Send Email", "Create Task", "Update Field", "Notify Team"])
+    templates = dict(conn.execute("SELECT id, name FROM email_templates").fetchall())
+
     # Add automation rule
     with st.form("add_automation"):
         name = st.text_input("Rule Name")
-        trigger_type = st.selectbox("Trigger", 
-            ["New Lead", "Deal Stage Change", "Task Due", "Score Change"])
         
         # Dynamic conditions based on trigger
         if trigger_type == "New Lead":
             conditions = {
-                "lead_source": st.selectbox("Lead Source",
-                    ["Website", "Referral", "Social Media"]),
+                "lead_source": st.selectbox("Lead Source", LEAD_SOURCES),
                 "minimum_score": st.number_input("Minimum Score", min_value=0)
             }
         elif trigger_type == "Deal Stage Change":
@@ -1215,16 +3697,16 @@ def automation_rules():
                 "to_stage": st.selectbox("To Stage",
                     ["Qualification", "Proposal", "Closed Won"])
             }
-        
-        action_type = st.selectbox("Action",
-            ["Send Email", "Create Task", "Update Field", "Notify Team"])
+        elif trigger_type == "Score Change":
+            conditions = {"minimum_score": st.number_input("Score Reaches", min_value=0)}
+        else:
+            conditions = {}
         
         # Dynamic action details
         if action_type == "Send Email":
             action_details = {
-                "template_id": st.selectbox("Email Template",
-                    pd.read_sql_query("SELECT id, name FROM email_templates", 
-                                    init_db())['name']),
+                "template_id": st.selectbox("Email Template", list(templates),
+                                            format_func=templates.get),
                 "delay_hours": st.number_input("Delay (hours)", min_value=0)
             }
         elif action_type == "Create Task":
@@ -1233,9 +3715,15 @@ def automation_rules():
                 "assignee": st.selectbox("Assignee",
                     ["Sales Rep", "Account Manager", "Support"])
             }
+        elif action_type == "Update Field":
+            action_details = {
+                "field": st.selectbox("Field", AUTOMATION_UPDATE_FIELDS),
+                "value": st.text_input("New Value")
+            }
+        else:
+            action_details = {"message": st.text_area("Message")}
         
         if st.form_submit_button("Create Rule"):
-            conn = get_client_db()
             c = conn.cursor()
             c.execute("""INSERT INTO automation_rules
                         (name, trigger_type, trigger_conditions,
@@ -1243,9 +3731,187 @@ def automation_rules():
                         VALUES (?, ?, ?, ?, ?, ?)""",
                      (name, trigger_type, json.dumps(conditions),
                       action_type, json.dumps(action_details), True))
+            mark_tables_changed(conn, 'automation_rules')
             conn.commit()
             st.success("Automation rule created!")
 
+    rules_df = pd.read_sql_query("""SELECT id, name, trigger_type, action_type, is_active
+                                    FROM automation_rules ORDER BY id""", conn)
+    if not rules_df.empty:
+        st.write("### Rules")
+        st.dataframe(rules_df, hide_index=True)
+        rule_names = dict(zip(rules_df['id'], rules_df['name']))
+        rule_id = int(st.selectbox("Rule", list(rule_names), format_func=rule_names.get))
+        if st.button("Activate / Deactivate"):
+            conn.execute("UPDATE automation_rules SET is_active = NOT is_active WHERE id = ?", (rule_id,))
+            mark_tables_changed(conn, 'automation_rules')
+            conn.commit()
+            st.rerun()
+
+    scheduled, next_run = conn.execute("SELECT COUNT(*), MIN(run_at) FROM scheduled_actions "
+                                       "WHERE status = 'pending'").fetchone()
+    if scheduled:
+        st.caption(f"{scheduled} delayed actions scheduled, next at "
+                   f"{datetime.fromtimestamp(next_run):%Y-%m-%d %H:%M}")
+
+    pending = conn.execute("SELECT COUNT(*) FROM automation_events "
+                           "WHERE available_at <= datetime('now')").fetchone()[0]
+    if pending and st.button(f"Process {pending} Pending Events"):
+        processed = process_automation_events(conn, st.session_state.client_db)
+        st.success(f"Processed {processed} events")
+
+    runs_df = pd.read_sql_query("""SELECT run_at, source, rule_id, event_type, customer_id,
+                                          action_type, status, detail
+                                   FROM automation_runs ORDER BY id DESC LIMIT 50""", conn)
+    if not runs_df.empty:
+        st.write("### Recent Runs")
+        st.dataframe(runs_df, hide_index=True)
+
+# Lead scoring engine
+# Rule attribute -> (kind, column in the scoring subquery)
+SCORING_ATTRIBUTES = {
+    'Company Size': ('numeric', 'company_size'),
+    'Budget': ('numeric', 'budget'),
+    'Industry': ('text', 'industry'),
+    'Interaction Level': ('numeric', 'interactions'),
+}
+
+# Used while a tenant has no rules of its own
+DEFAULT_SCORING_RULES = [
+    ('Company Size', '>100', 20),
+    ('Interaction Level', 'per interaction', 5),
+]
+
+_NUMERIC_CONDITION = re.compile(
+    r"^\s*(>=|<=|>|<|==|=)?\s*(-?\d+(?:\.\d+)?)(?:\s*-\s*(-?\d+(?:\.\d+)?))?")
+
+def _compile_condition(kind, column, condition):
+    """Translate one rule condition into a SQL predicate and its parameters"""
+    condition = (condition or "").strip()
+    if kind == 'numeric':
+        match = _NUMERIC_CONDITION.match(condition)
+        if not match:
+            return None
+        operator, low, high = match.groups()
+        if high is not None:
+            return f"{column} BETWEEN ? AND ?", [float(low), float(high)]
+        # A bare number means "at least"
+        operator = {'==': '=', None: '>='}.get(operator, operator)
+        return f"{column} {operator} ?", [float(low)]
+
+    if not condition:
+        return None
+    if condition.lower().startswith('contains '):
+        text = condition[9:].strip().replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        return f"{column} LIKE ? ESCAPE '\\'", [f"%{text}%"]
+    return f"lower({column}) = lower(?)", [condition.lstrip('=').strip()]
+
+def compile_scoring_rules(rules):
+    """Compile (attribute, condition, score) rows into one SQL score expression
+
+    Returns {'expression', 'params', 'skipped'}; skipped lists rules whose
+    attribute or condition could not be understood.
+    """
+    terms, params, skipped = [], [], []
+    for attribute, condition, score in rules or DEFAULT_SCORING_RULES:
+        kind, column = SCORING_ATTRIBUTES.get(attribute, (None, None))
+        if kind == 'numeric' and re.match(r"^\s*(per|each)\b", condition or "", re.IGNORECASE):
+            terms.append(f"COALESCE({column}, 0) * ?")
+            params.append(score)
+            continue
+        predicate = _compile_condition(kind, column, condition) if kind else None
+        if predicate is None:
+            skipped.append((attribute, condition, score))
+            continue
+        sql, predicate_params = predicate
+        terms.append(f"(CASE WHEN {sql} THEN ? ELSE 0 END)")
+        params.extend(predicate_params + [score])
+    return {'expression': " + ".join(terms) or "0", 'params': params, 'skipped': skipped}
+
+def get_scoring_plan(conn, client_db=None):
+    """Compiled scoring rules, cached per tenant until lead_scoring_rules changes"""
+    def compile_plan():
+        rules = conn.execute("SELECT attribute, condition, score FROM lead_scoring_rules").fetchall()
+        return compile_scoring_rules(rules)
+
+    if client_db is None:
+        return compile_plan()
+    return MetricsCache.get(client_db, 'lead_scoring_plan', ['lead_scoring_rules'], compile_plan)
+
+def scoring_query(plan, where="status = 'Lead'"):
+    """SELECT of (id, lead_score, score) for customers matching where, in one pass"""
+    return f"""
+        SELECT id, lead_score, {plan['expression']} as score
+        FROM (SELECT c.id, c.lead_score, c.company_size, c.budget, c.industry,
+                     (SELECT COUNT(*) FROM contacts WHERE customer_id = c.id)
+                     + (SELECT COUNT(*) FROM communication_logs WHERE customer_id = c.id)
+                     + (SELECT COUNT(*) FROM meeting_notes WHERE customer_id = c.id) as interactions
+              FROM customers c
+              WHERE {where})
+    """
+
+def calculate_lead_scores(conn, client_db=None):
+    """Score every lead in one pass and write changes in one transaction"""
+    timings = {}
+    started = time.perf_counter()
+    plan = get_scoring_plan(conn, client_db)
+    timings['compile'] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    scores_df = pd.read_sql_query(scoring_query(plan), conn, params=plan['params'])
+    timings['score'] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    changed = (scores_df['score'].to_numpy() != scores_df['lead_score'].fillna(-1).to_numpy())
+    updates = list(zip(np.rint(scores_df['score'].to_numpy()[changed]).astype(int).tolist(),
+                       scores_df['id'].to_numpy()[changed].tolist()))
+    if updates:
+        conn.executemany("UPDATE customers SET lead_score=? WHERE id=?", updates)
+        mark_tables_changed(conn, 'customers')
+    conn.commit()
+    timings['write'] = time.perf_counter() - started
+
+    return {'scored': len(scores_df), 'updated': len(updates), 'timings': timings,
+            'skipped': plan['skipped']}
+
+def process_lead_score_queue(conn, client_db=None, batch_size=500, max_batches=None):
+    """Rescore queued customers in small transactions, returning how many were rescored
+
+    Triggers from LEAD_SCORE_SOURCES fill lead_score_queue, so only customers
+    touched since the last run are recomputed. Non-leads are just dequeued.
+    """
+    plan = get_scoring_plan(conn, client_db)
+    processed = batches = 0
+    while max_batches is None or batches < max_batches:
+        if conn.in_transaction:
+            conn.commit()
+        # Hold the write lock so nothing is enqueued between scoring and dequeueing
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            ids = [row[0] for row in conn.execute(
+                "SELECT customer_id FROM lead_score_queue ORDER BY customer_id LIMIT ?",
+                (batch_size,))]
+            if not ids:
+                conn.rollback()
+                break
+            placeholders = ", ".join("?" * len(ids))
+            rows = conn.execute(
+                scoring_query(plan, f"c.status = 'Lead' AND c.id IN ({placeholders})"),
+                plan['params'] + ids).fetchall()
+            updates = [(int(round(score)), customer_id) for customer_id, lead_score, score in rows
+                       if lead_score != score]
+            if updates:
+                conn.executemany("UPDATE customers SET lead_score=? WHERE id=?", updates)
+                mark_tables_changed(conn, 'customers')
+            conn.execute(f"DELETE FROM lead_score_queue WHERE customer_id IN ({placeholders})", ids)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        processed += len(ids)
+        batches += 1
+    return processed
+
 def lead_scoring():
     st.subheader("Lead Scoring System")
     
@@ -1253,7 +3919,9 @@ def lead_scoring():
     with st.form("add_scoring_rule"):
         attribute = st.selectbox("Attribute",
             ["Company Size", "Industry", "Interaction Level", "Budget"])
-        condition = st.text_input("Condition (e.g., >100 employees)")
+        condition = st.text_input("Condition (e.g., >100 employees)",
+            help="Numbers: >100, <=5, 10-50 or a bare minimum. Text: an exact value "
+                 "or 'contains ...'. Use 'per interaction' to score each interaction.")
         score = st.number_input("Score Points", min_value=1)
         
         if st.form_submit_button("Add Scoring Rule"):
@@ -1263,106 +3931,588 @@ def lead_scoring():
                         (attribute, condition, score)
                         VALUES (?, ?, ?)""",
                      (attribute, condition, score))
+            mark_tables_changed(conn, 'lead_scoring_rules')
             conn.commit()
             st.success("Scoring rule added!")
     
-    # Calculate scores for all leads
+    # Scores are kept fresh incrementally; a full run is only needed after rule changes
+    conn = get_client_db()
+    pending = conn.execute("SELECT COUNT(*) FROM lead_score_queue").fetchone()[0]
+    st.caption(f"{pending} customers waiting for an incremental score update")
+    if pending and st.button("Apply Pending Updates"):
+        processed = process_lead_score_queue(conn, st.session_state.client_db)
+        st.success(f"Rescored {processed} queued customers")
+
+    # Calculate scores for all leads in the background
     if st.button("Calculate Lead Scores"):
-        conn = get_client_db()
-        leads_df = pd.read_sql_query("""
-            SELECT * FROM customers WHERE status='Lead'
-        """, conn)
-        
-        rules_df = pd.read_sql_query("""
-            SELECT * FROM lead_scoring_rules
-        """, conn)
-        
-        # Simple scoring example
-        scores = {}
-        for _, lead in leads_df.iterrows():
-            score = 0
-            # Add company size score
-            if lead.get('company_size', 0) > 100:
-                score += 20
-            # Add interaction score
-            interactions = pd.read_sql_query("""
-                SELECT COUNT(*) as count FROM contacts 
-                WHERE customer_id=?
-            """, conn, params=(lead['id'],)).iloc[0]['count']
-            score += interactions * 5
-            
-            scores[lead['id']] = score
-        
-        # Update scores in database
-        c = conn.cursor()
-        for lead_id, score in scores.items():
-            c.execute("""UPDATE customers 
-                        SET lead_score=? WHERE id=?""",
-                     (score, lead_id))
-        conn.commit()
-        
-        # Show scores
-        scored_leads = pd.read_sql_query("""
-            SELECT name, lead_score FROM customers 
-            WHERE status='Lead' ORDER BY lead_score DESC
-        """, conn)
-        st.write("Lead Scores:")
-        st.dataframe(scored_leads)
+        if active_job(conn, 'lead_scoring'):
+            st.warning("Lead scores are already being calculated")
+        else:
+            JobRunner.instance().submit(conn, st.session_state.client_db, 'lead_scoring',
+                                        "Lead score calculation", lead_score_job,
+                                        st.session_state.client_db)
+    show_jobs('lead_scoring', limit=1)
+
+    # Show scores
+    scored_leads = pd.read_sql_query("""
+        SELECT name, lead_score FROM customers 
+        WHERE status='Lead' ORDER BY lead_score DESC
+    """, conn)
+    st.write("Lead Scores:")
+    st.dataframe(scored_leads)
+
+# Customer segmentation engine
+class SegmentationEngine:
+    """MiniBatchKMeans segmentation with a model persisted per tenant
+
+    Training streams customers in keyset chunks through partial_fit, so
+    memory stays bounded by chunk_size. New or changed customers (segment
+    IS NULL) are assigned with the stored model without refitting.
+    """
+    features = ['total_revenue', 'avg_deal_size', 'total_deals']
+    segment_names = ['Low Value', 'Medium Value', 'High Value']
+
+    def __init__(self, client_db, n_clusters=3, chunk_size=10000):
+        self.client_db = client_db
+        self.n_clusters = n_clusters
+        self.chunk_size = chunk_size
+        self.model_path = (DatabaseManager.pool().db_dir / "models" /
+                           f"{Path(client_db).stem}_segmentation.joblib")
+
+    def _feature_chunks(self, conn, where="1"):
+        """Yield (ids, feature matrix) for customers matching where, chunk by chunk"""
+        last_id = 0
+        while True:
+            chunk = pd.read_sql_query(f"""
+                SELECT c.id,
+                       COALESCE(SUM(d.amount), 0) as total_revenue,
+                       COALESCE(AVG(d.amount), 0) as avg_deal_size,
+                       COUNT(d.id) as total_deals
+                FROM customers c
+                LEFT JOIN deals d ON d.customer_id = c.id
+                WHERE c.id > ? AND {where}
+                GROUP BY c.id
+                ORDER BY c.id
+                LIMIT ?
+            """, conn, params=(last_id, self.chunk_size))
+            if chunk.empty:
+                return
+            last_id = int(chunk['id'].iloc[-1])
+            # log1p tames the long tail of deal sizes before scaling
+            yield chunk['id'].to_numpy(), np.log1p(chunk[self.features].clip(lower=0).to_numpy())
+
+    def load(self):
+        """The tenant's trained model, or None if it has never been trained"""
+        if not self.model_path.exists():
+            return None
+        mtime = self.model_path.stat().st_mtime
+        store = _segmentation_models()
+        with store['lock']:
+            cached = store['models'].get(self.client_db)
+            if cached is None or cached[0] != mtime:
+                cached = (mtime, joblib.load(self.model_path))
+                store['models'][self.client_db] = cached
+        return cached[1]
+
+    def fit(self, conn, progress=None):
+        """Train on every customer with two streaming passes, then assign all segments
+
+        progress(fraction, message) is called as each pass starts.
+        """
+        if progress:
+            progress(0.0, "Scaling features")
+        scaler = MinMaxScaler()
+        for _, X in self._feature_chunks(conn):
+            scaler.partial_fit(X)
+        if not hasattr(scaler, 'data_min_'):
+            return None
+
+        if progress:
+            progress(1 / 3, "Clustering customers")
+        kmeans = MiniBatchKMeans(n_clusters=self.n_clusters, random_state=42, n_init=3)
+        seen = 0
+        for _, X in self._feature_chunks(conn):
+            # partial_fit needs at least n_clusters samples in the first batch
+            if seen == 0 and len(X) < self.n_clusters:
+                X = np.repeat(X, self.n_clusters, axis=0)
+            kmeans.partial_fit(scaler.transform(X))
+            seen += len(X)
+
+        # Name clusters by their centre's revenue, lowest first
+        centers = np.expm1(scaler.inverse_transform(kmeans.cluster_centers_))
+        order = np.argsort(centers[:, 0])
+        names = (self.segment_names if self.n_clusters == len(self.segment_names)
+                 else [f"Segment {rank + 1}" for rank in range(self.n_clusters)])
+        model = {
+            'scaler': scaler,
+            'kmeans': kmeans,
+            'labels': {int(cluster): names[rank] for rank, cluster in enumerate(order)},
+            'centers': pd.DataFrame(centers[order], columns=self.features,
+                                    index=[names[rank] for rank in range(self.n_clusters)]),
+            'trained_at': datetime.now(),
+            'n_customers': seen,
+        }
+        self.model_path.parent.mkdir(exist_ok=True)
+        joblib.dump(model, self.model_path)
+        if progress:
+            progress(2 / 3, "Assigning segments")
+        self.assign(conn, model, where="1")
+        return model
+
+    def assign(self, conn, model=None, where="c.segment IS NULL", max_chunks=None):
+        """Write segments for matching customers with the stored model; returns the count"""
+        model = model or self.load()
+        if model is None:
+            return 0
+        assigned = chunks = 0
+        for ids, X in self._feature_chunks(conn, where):
+            clusters = model['kmeans'].predict(model['scaler'].transform(X))
+            conn.executemany("UPDATE customers SET segment=? WHERE id=?",
+                             zip((model['labels'][int(c)] for c in clusters), ids.tolist()))
+            conn.commit()
+            assigned += len(ids)
+            chunks += 1
+            if chunks == max_chunks:
+                break
+        return assigned
+
+@st.cache_resource(show_spinner=False)
+def _segmentation_models():
+    # models: client_db -> (model file mtime, model), shared by every session
+    return {'models': {}, 'lock': threading.Lock()}
 
 def customer_segmentation():
     st.subheader("Customer Segmentation")
     
     conn = get_client_db()
-    customers_df = pd.read_sql_query("""
-        SELECT c.*, 
-               COUNT(d.id) as total_deals,
-               SUM(d.amount) as total_revenue,
-               AVG(d.amount) as avg_deal_size
-        FROM customers c
-        LEFT JOIN deals d ON c.id = d.customer_id
+    engine = SegmentationEngine(st.session_state.client_db)
+
+    if st.button("Retrain Segmentation Model"):
+        if active_job(conn, 'segmentation'):
+            st.warning("The segmentation model is already being trained")
+        else:
+            JobRunner.instance().submit(conn, st.session_state.client_db, 'segmentation',
+                                        "Segmentation training", segmentation_job,
+                                        st.session_state.client_db)
+    show_jobs('segmentation', limit=1)
+
+    model = engine.load()
+    if model is None:
+        st.info("No segmentation model yet. Train one to assign customer segments.")
+        return
+
+    # Only customers added or changed since the last run are assigned here,
+    # one bounded chunk per page view
+    assigned = SegmentationEngine(st.session_state.client_db, chunk_size=2000).assign(
+        conn, model, max_chunks=1)
+    st.caption(f"Model trained {model['trained_at']:%Y-%m-%d %H:%M} on {model['n_customers']} "
+               f"customers; {assigned} new or changed customers assigned now")
+
+    segment_counts = pd.read_sql_query("""
+        SELECT segment, COUNT(*) as customers
+        FROM customers
+        WHERE segment IS NOT NULL
+        GROUP BY segment
+    """, conn)
+    fig = px.bar(segment_counts, x='segment', y='customers', title='Customers per Segment')
+    st.plotly_chart(fig)
+
+    # Segment analysis from the model's cluster centres
+    st.write("Segment Analysis (typical customer per segment)")
+    st.dataframe(model['centers'].round(2))
+
+    # Scatter of the most recent customers only, to keep the query bounded
+    sample_df = pd.read_sql_query("""
+        SELECT c.name, c.segment,
+               COALESCE(SUM(d.amount), 0) as total_revenue,
+               COUNT(d.id) as total_deals
+        FROM (SELECT id, name, segment FROM customers ORDER BY id DESC LIMIT 2000) c
+        LEFT JOIN deals d ON d.customer_id = c.id
         GROUP BY c.id
     """, conn)
-    
-    if not customers_df.empty:
-        # Prepare data for segmentation
-        features = ['total_revenue', 'avg_deal_size', 'total_deals']
-        X = customers_df[features].fillna(0)
-        
-        # Normalize data
-        scaler = MinMaxScaler()
-        X_scaled = scaler.fit_transform(X)
-        
-        # Simple segmentation based on revenue and engagement
-        customers_df['segment'] = np.where(
-            (X_scaled[:, 0] > 0.7) & (X_scaled[:, 2] > 0.7),
-            'High Value',
-            np.where(
-                (X_scaled[:, 0] > 0.3) & (X_scaled[:, 2] > 0.3),
-                'Medium Value',
-                'Low Value'
-            )
-        )
-        
-        # Display segments
-        fig = px.scatter(customers_df, 
-                        x='total_revenue',
-                        y='total_deals',
-                        color='segment',
-                        title='Customer Segmentation',
-                        hover_data=['name'])
+    if not sample_df.empty:
+        fig = px.scatter(sample_df, x='total_revenue', y='total_deals', color='segment',
+                         title='Customer Segmentation (latest 2,000 customers)',
+                         hover_data=['name'])
         st.plotly_chart(fig)
-        
-        # Segment analysis
-        st.write("Segment Analysis")
-        segment_analysis = customers_df.groupby('segment').agg({
-            'id': 'count',
-            'total_revenue': 'sum',
-            'avg_deal_size': 'mean'
-        }).round(2)
-        st.dataframe(segment_analysis)
+
+
+# Background jobs
+class JobProgress:
+    """Progress handle passed to a running job
+
+    Reports go through a separate autocommit connection, so they never
+    commit the job's own work or disturb its open cursors. They are written
+    at most every `interval` seconds and skipped while the job holds the
+    write lock.
+    """
+
+    def __init__(self, conn, status_conn, job_id, interval=0.5):
+        self.conn = conn
+        self.status_conn = status_conn
+        self.job_id = job_id
+        self.interval = interval
+        self.fraction = 0.0
+        self.message = None
+        self._written_at = 0.0
+
+    def update(self, fraction=None, message=None):
+        if fraction is not None:
+            self.fraction = min(max(float(fraction), 0.0), 1.0)
+        if message is not None:
+            self.message = message
+        now = time.monotonic()
+        if now - self._written_at < self.interval or self.conn.in_transaction:
+            return
+        self._written_at = now
+        try:
+            self.status_conn.execute("UPDATE background_jobs SET progress = ?, message = ? "
+                                     "WHERE id = ?", (self.fraction, self.message, self.job_id))
+        except sqlite3.OperationalError:
+            pass  # busy; the next report catches up
+
+class JobRunner:
+    """Process-wide thread pool for long operations started from the UI
+
+    The pool lives outside st.session_state, so a job keeps running when the
+    user navigates away or reloads the page. Each job is a row in the
+    tenant's background_jobs table holding status, progress and a JSON
+    result, which the UI polls. A heartbeat thread keeps extending the
+    lease (locked_until) of every job the runner owns, so any process can
+    tell live jobs from those whose process died: only jobs with an
+    expired lease are marked failed.
+    """
+
+    def __init__(self, workers=2, lease=60):
+        self.lease = lease
+        self._executor = ThreadPoolExecutor(max_workers=workers,
+                                            thread_name_prefix="background-jobs")
+        self._owned = {}  # client_db -> ids of this runner's queued and running jobs
+        self._maintenance = set()  # (client_db, name) of housekeeping queued or running
+        self._stopping = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._heartbeat, name="job-heartbeat", daemon=True)
+        self._thread.start()
+
+    @staticmethod
+    def instance():
+        """The shared job runner, created on first use"""
+        return _shared_job_runner()
+
+    def stop(self, wait=True):
+        """Stop taking jobs; the heartbeat lasts until the submitted ones finish"""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        self._executor.shutdown(wait=wait)
+
+    def _connect(self, client_db):
+        pool = DatabaseManager.pool()
+        conn = sqlite3.connect(str(pool.db_dir / client_db), isolation_level=None,
+                               check_same_thread=False)
+        return apply_sqlite_profile(conn, pool.profile)
+
+    def _heartbeat(self):
+        while True:
+            with self._cond:
+                if self._stopping and not self._owned:
+                    return
+                self._cond.wait(self.lease / 3)
+                owned = {client_db: list(ids) for client_db, ids in self._owned.items()}
+            for client_db, job_ids in owned.items():
+                conn = self._connect(client_db)
+                try:
+                    conn.execute(f"UPDATE background_jobs SET locked_until = ? "
+                                 f"WHERE id IN ({', '.join('?' * len(job_ids))})",
+                                 [time.time() + self.lease] + job_ids)
+                except sqlite3.Error:
+                    pass  # retried on the next beat, well before the lease runs out
+                finally:
+                    conn.close()
+
+    def recover(self, conn, client_db):
+        """Fail the tenant's jobs whose owning process stopped renewing their lease"""
+        now = time.time()
+        expired = ("status IN ('queued', 'running') "
+                   "AND (locked_until IS NULL OR locked_until < ?)")
+        if conn.execute(f"SELECT 1 FROM background_jobs WHERE {expired} LIMIT 1",
+                        (now,)).fetchone():
+            conn.execute(f"""UPDATE background_jobs
+                             SET status = 'failed', error = 'Interrupted: the process running it stopped',
+                                 finished_at = CURRENT_TIMESTAMP
+                             WHERE {expired}""", (now,))
+            conn.commit()
+
+    def submit(self, conn, client_db, kind, description, fn, *args):
+        """Queue fn(conn, progress, *args) as a job and return its id
+
+        fn runs on a pooled connection of its own and returns a
+        JSON-serialisable result.
+        """
+        self.recover(conn, client_db)
+        job_id = conn.execute("INSERT INTO background_jobs (kind, description, locked_until) "
+                              "VALUES (?, ?, ?) RETURNING id",
+                              (kind, description, time.time() + self.lease)).fetchone()[0]
+        conn.commit()
+        with self._cond:
+            self._owned.setdefault(client_db, set()).add(job_id)
+        self._executor.submit(self._run, client_db, job_id, fn, args)
+        return job_id
+
+    def request_maintenance(self, client_db, name, fn):
+        """Run fn(conn, client_db) on the pool unless it is already pending for the tenant
+
+        For housekeeping that should not hold up a page render. It is not
+        recorded in background_jobs; a failed run is retried on the next
+        request.
+        """
+        key = (client_db, name)
+        with self._cond:
+            if self._stopping or key in self._maintenance:
+                return
+            self._maintenance.add(key)
+        self._executor.submit(self._run_maintenance, key, fn)
+
+    def _run_maintenance(self, key, fn):
+        client_db = key[0]
+        pool = DatabaseManager.pool()
+        conn = pool.acquire(client_db)
+        try:
+            fn(conn, client_db)
+        except sqlite3.Error:
+            pass  # left queued; drained by the next request
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+            pool.release(client_db, conn)
+            with self._cond:
+                self._maintenance.discard(key)
+
+    def _run(self, client_db, job_id, fn, args):
+        pool = DatabaseManager.pool()
+        status_conn = self._connect(client_db)
+        conn = None
+        try:
+            conn = pool.acquire(client_db)
+            status_conn.execute("UPDATE background_jobs SET status = 'running', "
+                                "started_at = CURRENT_TIMESTAMP WHERE id = ?", (job_id,))
+            try:
+                result = fn(conn, JobProgress(conn, status_conn, job_id), *args)
+                if conn.in_transaction:
+                    conn.commit()
+            except Exception as e:
+                if conn.in_transaction:
+                    conn.rollback()
+                status_conn.execute("""UPDATE background_jobs
+                                       SET status = 'failed', error = ?,
+                                           finished_at = CURRENT_TIMESTAMP
+                                       WHERE id = ?""", (str(e) or type(e).__name__, job_id))
+            else:
+                status_conn.execute("""UPDATE background_jobs
+                                       SET status = 'succeeded', progress = 1, result = ?,
+                                           finished_at = CURRENT_TIMESTAMP
+                                       WHERE id = ?""", (json.dumps(result, default=str), job_id))
+        finally:
+            if conn is not None:
+                pool.release(client_db, conn)
+            status_conn.close()
+            with self._cond:
+                self._owned[client_db].discard(job_id)
+                if not self._owned[client_db]:
+                    del self._owned[client_db]
+                self._cond.notify()
+
+@st.cache_resource(show_spinner=False, on_release=partial(JobRunner.stop, wait=False))
+def _shared_job_runner():
+    return JobRunner()
+
+def active_job(conn, kind):
+    """Id of a queued or running job of kind whose lease is live, or None"""
+    row = conn.execute("SELECT id FROM background_jobs WHERE kind = ? "
+                       "AND status IN ('queued', 'running') AND locked_until >= ? LIMIT 1",
+                       (kind, time.time())).fetchone()
+    return row[0] if row else None
+
+def lead_score_job(conn, progress, client_db):
+    progress.update(0.0, "Scoring leads")
+    return calculate_lead_scores(conn, client_db)
+
+def segmentation_job(conn, progress, client_db):
+    model = SegmentationEngine(client_db).fit(conn, progress.update)
+    return {'n_customers': model['n_customers'] if model else 0}
+
+def import_job(conn, progress, path, table, mapping, chunk_size, on_duplicate):
+    """Import a spooled upload, deleting the copy afterwards"""
+    def report(rows, fraction, rate):
+        progress.update(fraction, f"{rows:,} rows processed ({rate:,.0f} rows/s)")
+
+    try:
+        with open(path, 'rb') as file:
+            return import_csv(conn, file, table, mapping, chunk_size=chunk_size,
+                              on_duplicate=on_duplicate, progress=report)
+    finally:
+        Path(path).unlink(missing_ok=True)
+
+def export_job(conn, progress, table, label, export_format, incremental):
+    """Export table to a temporary file
+
+    The watermark is left alone; it only advances once the file has been
+    downloaded (confirm_export_download), so an increment nobody fetched
+    stays in the change log for the next export.
+    """
+    suffix, mime = EXPORT_FORMATS[export_format]
+    fd, path = tempfile.mkstemp(prefix=f"{table}_", suffix=suffix)
+    os.close(fd)
+    if incremental:
+        since = get_export_watermark(conn, table)
+        total = conn.execute("SELECT COUNT(DISTINCT row_id) FROM changes "
+                             "WHERE table_name = ? AND id > ?", (table, since)).fetchone()[0]
+    else:
+        total = conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+
+    def report(rows):
+        progress.update(rows / total if total else 0.0, f"{rows:,} rows written")
+
+    try:
+        if incremental:
+            rows, until = export_changes(conn, table, path, export_format, since=since,
+                                         progress=report)
+            name = f"{label.lower()}_changes_{since + 1}_{until}{suffix}"
+        else:
+            # A full export is the baseline later incremental exports continue from
+            until = latest_change_id(conn, table)
+            rows = export_table(conn, table, path, export_format, progress=report)
+            name = f"{label.lower()}_export{suffix}"
+    except Exception:
+        Path(path).unlink(missing_ok=True)
+        raise
+    return {'table': table, 'path': path, 'rows': rows, 'mime': mime, 'name': name,
+            'until': until}
+
+def confirm_export_download(client_db, job_id, table, until):
+    """Advance the table's export watermark once an export has been downloaded
+
+    Runs as a callback of the job panel fragment, whose reruns never reach
+    release_connections, so it holds a pooled connection only while it works.
+    """
+    pool = DatabaseManager.pool()
+    conn = pool.acquire(client_db)
+    try:
+        conn.execute("UPDATE background_jobs SET result = json_set(result, '$.downloaded', 1) "
+                     "WHERE id = ?", (job_id,))
+        save_export_watermark(conn, table, until)
+    finally:
+        if conn.in_transaction:
+            conn.rollback()
+        pool.release(client_db, conn)
+
+def show_lead_score_result(job_id, result):
+    for attribute, condition, points in result['skipped']:
+        st.warning(f"Ignored rule '{attribute} {condition}' ({points} points): "
+                   "condition not understood")
+    timings = result['timings']
+    st.caption(f"Scored {result['scored']} leads ({result['updated']} changed) in "
+               f"{sum(timings.values()) * 1000:.0f} ms: "
+               + ", ".join(f"{step} {seconds * 1000:.0f} ms" for step, seconds in timings.items()))
+
+def show_segmentation_result(job_id, result):
+    if result['n_customers']:
+        st.success(f"Model trained on {result['n_customers']} customers")
+    else:
+        st.info("No customers to segment yet")
+
+def show_import_result(job_id, result):
+    st.success(f"Imported {result['inserted']:,} new and updated {result['updated']:,} of "
+               f"{result['rows']:,} records in {result['seconds']:.1f}s "
+               f"({result['rows_per_second']:,.0f} rows/s)")
+    if result['duplicates']:
+        st.info(f"Skipped {result['duplicates']:,} duplicate records")
+    if result['rejected']:
+        st.warning(f"Rejected {result['rejected']:,} invalid records")
+        st.dataframe(pd.DataFrame(result['errors'], columns=['line', 'problem']),
+                     hide_index=True)
+
+def show_export_result(job_id, result):
+    path = Path(result['path'])
+    if not path.exists():
+        st.caption(f"{result['name']}: file no longer available")
+        return
+    st.caption(f"{result['name']}: {result['rows']:,} rows, {path.stat().st_size / 1024:,.1f} KB"
+               + (", downloaded" if result.get('downloaded') else ""))
+    # Read from disk only when the download is requested
+    st.download_button(
+        label="Download Export",
+        data=path.read_bytes,
+        file_name=result['name'],
+        mime=result['mime'],
+        key=f"job_download_{job_id}",
+        on_click=confirm_export_download,
+        args=(st.session_state.client_db, job_id, result['table'], result['until'])
+    )
+
+# Job kind -> (label, result renderer)
+JOB_KINDS = {
+    'lead_scoring': ("Lead scoring", show_lead_score_result),
+    'segmentation': ("Segmentation", show_segmentation_result),
+    'import': ("Import", show_import_result),
+    'export': ("Export", show_export_result),
+}
+
+def show_jobs(kind=None, limit=3):
+    """Recent jobs with their progress, refreshing every 2 s while any is active"""
+    client_db = st.session_state.client_db
+    conn = get_client_db()
+    JobRunner.instance().recover(conn, client_db)
+    kinds = [kind] if kind else list(JOB_KINDS)
+    placeholders = ", ".join("?" * len(kinds))
+    active = {row[0] for row in conn.execute(
+        f"SELECT id FROM background_jobs WHERE kind IN ({placeholders}) "
+        "AND status IN ('queued', 'running')", kinds)}
+
+    @st.fragment(run_every=2 if active else None)
+    def job_panel():
+        # Fragment reruns happen outside main(), so lease nothing to this thread
+        pool = DatabaseManager.pool()
+        conn = pool.acquire(client_db)
+        try:
+            jobs = conn.execute(f"""SELECT id, kind, description, status, progress, message,
+                                           result, error, created_at
+                                    FROM background_jobs WHERE kind IN ({placeholders})
+                                    ORDER BY id DESC LIMIT ?""", kinds + [limit]).fetchall()
+        finally:
+            pool.release(client_db, conn)
+        for job_id, job_kind, description, status, progress, message, result, error, created_at in jobs:
+            if status in ('queued', 'running'):
+                st.progress(progress, text=f"{description}: {message or status}")
+            elif job_id in active:
+                # Finished since the page was drawn; redraw it with the new data
+                st.rerun()
+            elif status == 'failed':
+                st.error(f"{description} failed ({created_at}): {error}")
+            else:
+                st.write(f"**{description}** ({created_at})")
+                JOB_KINDS[job_kind][1](job_id, json.loads(result))
+
+    job_panel()
+
+def background_jobs():
+    st.subheader("Background Jobs")
+    conn = get_client_db()
+    counts = dict(conn.execute("SELECT status, COUNT(*) FROM background_jobs GROUP BY status"))
+    st.caption(", ".join(f"{counts.get(status, 0)} {status}"
+                         for status in ('queued', 'running', 'succeeded', 'failed')))
+    show_jobs(limit=20)
 
 
 def main():
+    try:
+        render_app()
+    finally:
+        # Hand this run's connections back to the pool
+        DatabaseManager.release_connections()
+
+
+def render_app():
     if 'db_manager' not in st.session_state:
         st.session_state.db_manager = DatabaseManager()
     if not login():
@@ -1385,113 +4535,145 @@ def main():
 
     st.title(f"CRM System - {st.session_state.username}")
 
-    # Main category tabs
-    main_tabs = st.tabs([
-        "Dashboard",
-        "Customer Management",
-        "Sales Management",
-        "Analytics & Reporting",
-        "Marketing Tools",
-        "System Tools"
-    ])
-
-    # Dashboard Tab
-    with main_tabs[0]:
-        show_dashboard()
-
-    # Customer Management Tab
-    with main_tabs[1]:
-        customer_section = st.selectbox(
-            "Select Customer Management Area",
-            ["Customers", "Communications", "Segmentation", "Lead Scoring", "Meeting Management"]
-        )
-
-        if customer_section == "Customers":
-            tab1, tab2 = st.tabs(["Add Customer", "View Customers"])
-            with tab1:
-                add_customer()
-            with tab2:
-                view_customers()
-        elif customer_section == "Communications":
-            tab1, tab2 = st.tabs(["Send Communication", "Email Templates"])
-            with tab1:
-                manage_communications()
-            with tab2:
-                manage_email_templates()
-        elif customer_section == "Segmentation":
-            customer_segmentation()
-        elif customer_section == "Lead Scoring":
-            lead_scoring()
-        elif customer_section == "Meeting Management":
-            meeting_management()
-
-    # Sales Management Tab
-    with main_tabs[2]:
-        sales_section = st.selectbox(
-            "Select Sales Management Area",
-            ["Deals", "Tasks", "Calendar", "Documents"]
-        )
-
-        if sales_section == "Deals":
-            manage_deals()
-        elif sales_section == "Tasks":
-            manage_tasks()
-        elif sales_section == "Calendar":
-            calendar_management()
-        elif sales_section == "Documents":
-            document_management()
-
-    # Analytics & Reporting Tab
-    with main_tabs[3]:
-        analytics_section = st.selectbox(
-            "Select Analytics Area",
-            ["Analytics Dashboard", "Sales Forecasting", "Performance Metrics"]
-        )
-
-        if analytics_section == "Analytics Dashboard":
-            show_enhanced_analytics()
-        elif analytics_section == "Sales Forecasting":
-            sales_forecasting()
-        elif analytics_section == "Performance Metrics":
-            performance_dashboard()
-
-    # Marketing Tools Tab
-    with main_tabs[4]:
-        marketing_section = st.selectbox(
-            "Select Marketing Area",
-            ["Marketing Campaigns", "Content Management", "Form Builder", "SEO Tools"]
-        )
-
-        if marketing_section == "Marketing Campaigns":
-            marketing_campaigns()
-        elif marketing_section == "Content Management":
-            content_management()
-        elif marketing_section == "Form Builder":
-            form_builder()
-        elif marketing_section == "SEO Tools":
-            seo_tools()
-
-    # System Tools Tab
-    with main_tabs[5]:
-        system_section = st.selectbox(
-            "Select System Area",
-            ["Team Collaboration", "Automation", "Workflow Automation", "Data Management"]
-        )
-
-        if system_section == "Team Collaboration":
-            team_collaboration()
-        elif system_section == "Automation":
-            automation_rules()
-        elif system_section == "Workflow Automation":
-            workflow_automation()
-        elif system_section == "Data Management":
-            tab1, tab2 = st.tabs(["Custom Fields", "Import/Export"])
-            with tab1:
-                manage_custom_fields()
-            with tab2:
-                import_export_data()
-
-    # [Rest of the main function remains the same, but using get_client_db()]
+    search_text = st.sidebar.text_input("Search CRM", key="global_search")
+    if search_text.strip():
+        show_search_results(search_text)
+
+    # Only the selected section runs, so each rerun queries just that page
+    section = st.sidebar.radio("Navigation", list(MAIN_SECTIONS), key="main_section")
+    MAIN_SECTIONS[section]()
+
+    # Queued lead score updates and automation events are handled in the background
+    conn = get_client_db()
+    if conn is None:
+        return
+    if conn.execute("SELECT 1 FROM lead_score_queue LIMIT 1").fetchone():
+        JobRunner.instance().request_maintenance(st.session_state.client_db, 'lead_score_queue',
+                                                 process_lead_score_queue)
+    if conn.execute("SELECT 1 FROM automation_events WHERE available_at <= datetime('now') LIMIT 1").fetchone():
+        JobRunner.instance().request_maintenance(st.session_state.client_db, 'automation_events',
+                                                 process_automation_events)
+    if conn.execute("SELECT 1 FROM scheduled_actions WHERE status = 'pending' LIMIT 1").fetchone():
+        ActionScheduler.instance().notify(st.session_state.client_db)
+    # Resume delivery of mail queued before a restart
+    if conn.execute("SELECT 1 FROM email_outbox WHERE next_attempt_at IS NOT NULL LIMIT 1").fetchone():
+        EmailOutboxWorker.instance().notify(st.session_state.client_db)
+
+
+def select_view(label, options, key):
+    """Horizontal selector used in place of st.tabs so hidden views never run"""
+    return st.radio(label, options, horizontal=True, key=key,
+                    label_visibility="collapsed")
+
+def customer_management_section():
+    customer_section = st.selectbox(
+        "Select Customer Management Area",
+        ["Customers", "Communications", "Segmentation", "Lead Scoring", "Meeting Management"]
+    )
+
+    if customer_section == "Customers":
+        view = select_view("Customers", ["Add Customer", "View Customers"], "customers_view")
+        if view == "Add Customer":
+            add_customer()
+        else:
+            view_customers()
+    elif customer_section == "Communications":
+        view = select_view("Communications",
+                           ["Send Communication", "Email Campaign", "Email Templates"],
+                           "communications_view")
+        if view == "Send Communication":
+            manage_communications()
+        elif view == "Email Campaign":
+            email_campaign()
+        else:
+            manage_email_templates()
+    elif customer_section == "Segmentation":
+        customer_segmentation()
+    elif customer_section == "Lead Scoring":
+        lead_scoring()
+    elif customer_section == "Meeting Management":
+        meeting_management()
+
+def sales_management_section():
+    sales_section = st.selectbox(
+        "Select Sales Management Area",
+        ["Deals", "Tasks", "Calendar", "Documents"]
+    )
+
+    if sales_section == "Deals":
+        manage_deals()
+    elif sales_section == "Tasks":
+        manage_tasks()
+    elif sales_section == "Calendar":
+        calendar_management()
+    elif sales_section == "Documents":
+        document_management()
+
+def analytics_section():
+    analytics_area = st.selectbox(
+        "Select Analytics Area",
+        ["Analytics Dashboard", "Sales Forecasting", "Pipeline Simulation", "Performance Metrics"]
+    )
+
+    if analytics_area == "Analytics Dashboard":
+        show_enhanced_analytics()
+    elif analytics_area == "Sales Forecasting":
+        sales_forecasting()
+    elif analytics_area == "Pipeline Simulation":
+        show_pipeline_simulation()
+    elif analytics_area == "Performance Metrics":
+        performance_dashboard()
+
+def marketing_section():
+    marketing_area = st.selectbox(
+        "Select Marketing Area",
+        ["Marketing Campaigns", "Content Management", "Form Builder", "SEO Tools"]
+    )
+
+    if marketing_area == "Marketing Campaigns":
+        marketing_campaigns()
+    elif marketing_area == "Content Management":
+        content_management()
+    elif marketing_area == "Form Builder":
+        form_builder()
+    elif marketing_area == "SEO Tools":
+        seo_tools()
+
+def system_tools_section():
+    system_section = st.selectbox(
+        "Select System Area",
+        ["Team Collaboration", "Automation", "Workflow Automation", "Data Management"]
+    )
+
+    if system_section == "Team Collaboration":
+        team_collaboration()
+    elif system_section == "Automation":
+        automation_rules()
+    elif system_section == "Workflow Automation":
+        workflow_automation()
+    elif system_section == "Data Management":
+        view = select_view("Data Management",
+                           ["Custom Fields", "Import/Export", "Background Jobs",
+                            "Database Settings"],
+                           "data_management_view")
+        if view == "Custom Fields":
+            manage_custom_fields()
+        elif view == "Import/Export":
+            import_export_data()
+        elif view == "Background Jobs":
+            background_jobs()
+        else:
+            show_database_settings()
+
+# Sidebar navigation: section name -> render function
+MAIN_SECTIONS = {
+    "Dashboard": show_dashboard,
+    "Customer Management": customer_management_section,
+    "Sales Management": sales_management_section,
+    "Analytics & Reporting": analytics_section,
+    "Marketing Tools": marketing_section,
+    "System Tools": system_tools_section,
+}
 
 if __name__ == "__main__":
     main()
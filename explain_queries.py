@@ -0,0 +1,198 @@
+"""Run EXPLAIN QUERY PLAN on every SQL literal in crm5.py and flag table scans.
+
+Queries are planned against a freshly migrated client database. A scan is
+flagged when the query filters or sorts, so an index should serve it;
+whole-table reads are listed as full reads, and scans of the small
+trigger-maintained rollup tables are expected. Exits non-zero if any query
+was flagged.
+
+SQL built with f-strings cannot be planned from the source. The main
+dynamic queries (filtered keyset pages, search, mail merge, scoring,
+segmentation, automation lookups and incremental export) are instead
+captured by running their builders with representative arguments; every
+other f-string query is listed as skipped.
+
+    python explain_queries.py [--source crm5.py] [--db path/to/client.db]
+"""
+import argparse
+import ast
+import re
+import sqlite3
+import sys
+import tempfile
+from pathlib import Path
+
+import crm5
+from crm5 import SUMMARY_TABLES, SchemaMigrator
+
+SQL_START = re.compile(r"^\s*(SELECT\s.+\sFROM\s|INSERT\s+INTO\s|UPDATE\s+\w+\s+SET\s"
+                       r"|DELETE\s+FROM\s|WITH\s)", re.IGNORECASE | re.DOTALL)
+SELECTIVE = re.compile(r"\b(WHERE|ORDER\s+BY)\b", re.IGNORECASE)
+PLAN_TABLE = re.compile(r"^(?:SCAN|SEARCH) (\w+)")
+
+# Tables small enough that scanning them is the intended plan
+SMALL_TABLES = set(SUMMARY_TABLES) | {"table_versions"}
+
+# These functions query auth.db, not a client database
+AUTH_DB_FUNCTIONS = {"login"}
+
+
+def find_queries(source_path):
+    """Yield (line number, function name, sql) for each SQL string literal"""
+    tree = ast.parse(Path(source_path).read_text())
+    for func in ast.walk(tree):
+        if (not isinstance(func, (ast.FunctionDef, ast.AsyncFunctionDef))
+                or func.name in AUTH_DB_FUNCTIONS):
+            continue
+        # Fragments of f-strings are not complete statements
+        fragments = {id(part) for node in ast.walk(func) if isinstance(node, ast.JoinedStr)
+                     for part in node.values}
+        for node in ast.walk(func):
+            if (isinstance(node, ast.Constant) and id(node) not in fragments and isinstance(node.value, str)
+                    and SQL_START.match(node.value)):
+                yield node.lineno, func.name, " ".join(node.value.split())
+
+
+def find_dynamic_queries(source_path):
+    """Yield (line number, function name) for each f-string that builds SQL"""
+    tree = ast.parse(Path(source_path).read_text())
+    # Outer functions are walked first, so nested functions claim their own lines
+    sites = {}
+    for func in ast.walk(tree):
+        if not isinstance(func, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            continue
+        for node in ast.walk(func):
+            if (isinstance(node, ast.JoinedStr) and node.values
+                    and isinstance(node.values[0], ast.Constant)
+                    and SQL_START.match(node.values[0].value)):
+                sites[node.lineno] = func.name
+    yield from sorted(sites.items())
+
+
+def seed_sample_rows(conn):
+    """A few related rows so builders reach their later queries"""
+    conn.executemany("INSERT INTO customers (name, email, status, industry, budget) "
+                     "VALUES (?, ?, 'Lead', 'Tech', 5000)",
+                     [("Acme", "a@acme.test"), ("Globex", "g@globex.test")])
+    conn.execute("INSERT INTO deals (customer_id, amount, probability, stage) "
+                 "VALUES (1, 1000, 50, 'Proposal')")
+    conn.execute("INSERT INTO tasks (customer_id, title, due_date, status) "
+                 "VALUES (1, 'Call', '2030-01-01', 'Pending')")
+    conn.commit()
+
+
+def representative_calls(conn):
+    """(builder name, call) pairs that run crm5's dynamic queries"""
+    plan = crm5.compile_scoring_rules([("Industry", "contains tech", 10),
+                                       ("Budget", ">1000", 5),
+                                       ("Company Size", "10-500", 3),
+                                       ("Interaction Level", "per interaction", 2)])
+    if plan['skipped']:
+        raise ValueError(f"Representative scoring rules not understood: {plan['skipped']}")
+    segments = crm5.SegmentationEngine("explain.db")
+    export_path = Path(tempfile.mkdtemp()) / "changes.csv.gz"
+    return [
+        ("fetch_customers_page", lambda: crm5.fetch_customers_page(conn)),
+        ("fetch_customers_page", lambda: crm5.fetch_customers_page(
+            conn, ["Lead", "Prospect"], "acme", after_id=1)),
+        ("global_search", lambda: crm5.global_search(conn, "acme")),
+        ("render_emails", lambda: crm5.render_emails(
+            conn, "Hello {customer_name}", "{deal_value} due {due_date}", ["Lead"])),
+        ("scoring_query", lambda: conn.execute(crm5.scoring_query(plan), plan['params']).fetchall()),
+        ("scoring_query", lambda: conn.execute(
+            crm5.scoring_query(plan, "c.status = 'Lead' AND c.id IN (?, ?)"),
+            plan['params'] + [1, 2]).fetchall()),
+        ("_feature_chunks", lambda: list(segments._feature_chunks(conn, "c.segment IS NULL"))),
+        ("_load_automation_customers", lambda: crm5._load_automation_customers(conn, [1, 2])),
+        ("export_changes", lambda: crm5.export_changes(conn, "customers", export_path, "CSV (gzip)")),
+    ]
+
+
+def capture_dynamic_queries(conn):
+    """Yield (builder name, sql) for each statement the representative calls execute"""
+    for name, call in representative_calls(conn):
+        statements = []
+        conn.set_trace_callback(statements.append)
+        try:
+            call()
+        finally:
+            conn.set_trace_callback(None)
+            conn.rollback()
+        for sql in statements:
+            # FTS5 reads its shadow tables through the same connection
+            if SQL_START.match(sql) and "'main'." not in sql:
+                yield name, " ".join(sql.split())
+
+
+def explain(conn, sql):
+    """Return the detail column of each EXPLAIN QUERY PLAN row"""
+    params = [None] * sql.count("?")
+    return [row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params)]
+
+
+def is_scan(detail):
+    return detail.startswith("SCAN") and "INDEX" not in detail or "TEMP B-TREE" in detail
+
+
+def only_small_tables(plan):
+    tables = {match.group(1) for match in map(PLAN_TABLE.match, plan) if match}
+    return bool(tables) and tables <= SMALL_TABLES
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--source", default=Path(__file__).with_name("crm5.py"))
+    parser.add_argument("--db", help="client database to plan against "
+                                     "(default: a fresh migrated database)")
+    args = parser.parse_args()
+
+    if args.db:
+        conn = sqlite3.connect(args.db)
+    else:
+        conn = sqlite3.connect(str(Path(tempfile.mkdtemp()) / "explain.db"))
+        SchemaMigrator.migrate(conn)
+        seed_sample_rows(conn)
+
+    queries = list(find_queries(args.source))
+    instantiated = set()
+    for name, sql in capture_dynamic_queries(conn):
+        instantiated.add(name)
+        queries.append(("-", f"{name} (instantiated)", sql))
+
+    flagged = 0
+    seen = set()
+    for lineno, func, sql in queries:
+        if sql in seen:
+            continue
+        seen.add(sql)
+        try:
+            plan = explain(conn, sql)
+        except sqlite3.Error as e:
+            print(f"ERROR  {func}:{lineno}  {e}\n       {sql[:120]}")
+            continue
+        scans = [detail for detail in plan if is_scan(detail)]
+        if only_small_tables(plan):
+            scans = []
+        if scans and SELECTIVE.search(sql):
+            flagged += 1
+            status = "SCAN "
+        elif scans:
+            status = "FULL "
+        else:
+            status = "OK   "
+        print(f"{status}  {func}:{lineno}  {sql[:120]}")
+        for detail in plan:
+            print(f"         {detail}")
+
+    skipped = [(lineno, func) for lineno, func in find_dynamic_queries(args.source)
+               if func not in instantiated]
+    for lineno, func in skipped:
+        print(f"SKIP   {func}:{lineno}  SQL built with an f-string; not planned")
+
+    print(f"\n{len(seen)} queries planned, {len(skipped)} dynamic queries skipped, "
+          f"{flagged} flagged")
+    return 1 if flagged else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,28 @@
+"""Bring every client database up to the latest schema version.
+
+Run once at deploy time, before starting the Streamlit app:
+
+    python migrate_tenants.py --workers 8
+"""
+import argparse
+
+from crm5 import SchemaMigrator
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--db-dir", default="client_databases",
+                        help="directory containing the client databases")
+    parser.add_argument("--workers", type=int, default=8,
+                        help="number of databases to migrate in parallel")
+    args = parser.parse_args()
+
+    results = SchemaMigrator.migrate_all(args.db_dir, max_workers=args.workers)
+    for db_name, (start, end) in results.items():
+        status = "up to date" if start == end else f"migrated {start} -> {end}"
+        print(f"{db_name}: {status}")
+    print(f"{len(results)} client databases at schema version {SchemaMigrator.latest_version()}")
+
+
+if __name__ == "__main__":
+    main()
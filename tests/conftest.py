@@ -0,0 +1,20 @@
+import sqlite3
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from crm5 import SchemaMigrator  # noqa: E402
+
+
+@pytest.fixture
+def conn(tmp_path, monkeypatch):
+    """A freshly migrated client database; the working directory is a temp dir"""
+    monkeypatch.chdir(tmp_path)
+    Path("client_databases").mkdir()
+    conn = sqlite3.connect(str(Path("client_databases") / "client_test.db"))
+    SchemaMigrator.migrate(conn)
+    yield conn
+    conn.close()
@@ -0,0 +1,84 @@
+import json
+
+import pytest
+
+from crm5 import AutomationRuleIndex, mark_tables_changed, process_automation_events
+
+
+def rule(rule_id, trigger_type, conditions, action_type="Notify Team", details=None):
+    return (rule_id, f"rule {rule_id}", trigger_type, json.dumps(conditions), action_type,
+            json.dumps(details or {}))
+
+
+def workflow(workflow_id, trigger_type, field, operator, value, actions=("Create Task",)):
+    return (workflow_id, f"workflow {workflow_id}", trigger_type,
+            json.dumps({'field': field, 'operator': operator, 'value': value}), json.dumps(list(actions)))
+
+
+def matched(index, event_type, payload, customer=None):
+    return sorted((item['source'], item['id']) for item in index.match(event_type, payload, customer))
+
+
+def test_stage_change_matches_exact_stage_pair():
+    index = AutomationRuleIndex([rule(1, 'Deal Stage Change', {'from_stage': 'Proposal', 'to_stage': 'Won'}),
+                                 rule(2, 'Deal Stage Change', {'from_stage': 'Lead', 'to_stage': 'Won'})], [])
+    assert matched(index, 'Deal Stage Change', {'from_stage': 'Proposal', 'to_stage': 'Won'}) == [('rule', 1)]
+    assert matched(index, 'Deal Stage Change', {'from_stage': 'Won', 'to_stage': 'Proposal'}) == []
+
+
+def test_new_lead_filters_on_source_and_minimum_score():
+    index = AutomationRuleIndex([rule(1, 'New Lead', {'lead_source': 'Website'}),
+                                 rule(2, 'New Lead', {'lead_source': 'Website', 'minimum_score': 50}),
+                                 rule(3, 'New Lead', {'lead_source': 'Referral'})], [])
+    website = {'lead_source': 'Website'}
+    assert matched(index, 'New Lead', website, {'lead_score': 10}) == [('rule', 1)]
+    assert matched(index, 'New Lead', website, {'lead_score': 50}) == [('rule', 1), ('rule', 2)]
+    assert matched(index, 'New Lead', {'lead_source': 'Social Media'}, {'lead_score': 90}) == []
+
+
+@pytest.mark.parametrize("old, new, expected", [
+    (10, 40, [1]),        # crosses 30 only
+    (10, 80, [1, 2]),     # crosses both
+    (40, 60, [2]),        # already past 30
+    (60, 40, []),         # falling scores fire nothing
+    (30, 49, []),         # starting at a threshold is not a crossing
+])
+def test_score_change_fires_thresholds_crossed_upwards(old, new, expected):
+    index = AutomationRuleIndex([rule(1, 'Score Change', {'minimum_score': 30}),
+                                 rule(2, 'Score Change', {'minimum_score': 50})], [])
+    result = matched(index, 'Score Change', {'old_score': old, 'new_score': new})
+    assert result == [('rule', rule_id) for rule_id in expected]
+
+
+def test_workflow_conditions():
+    index = AutomationRuleIndex([], [workflow(1, 'New Lead', 'Industry', 'Equals', 'Tech'),
+                                     workflow(2, 'New Lead', 'Company Size', 'Greater Than', '100'),
+                                     workflow(3, 'New Lead', 'Email', 'Contains', '@acme.'),
+                                     workflow(4, 'Task Due', 'Industry', 'Equals', 'Tech')])
+    customer = {'industry': 'tech', 'company_size': 250, 'email': 'jo@acme.com'}
+    assert matched(index, 'New Lead', {}, customer) == [('workflow', 1), ('workflow', 2), ('workflow', 3)]
+    small = {'industry': 'Retail', 'company_size': 100, 'email': 'jo@example.com'}
+    assert matched(index, 'New Lead', {}, small) == []
+    assert matched(index, 'New Lead', {}, None) == []
+
+
+def test_unknown_triggers_and_fields_are_not_indexed():
+    index = AutomationRuleIndex([rule(1, 'Unknown', {})], [workflow(2, 'New Lead', 'Phone', 'Equals', '1')])
+    assert index.size == 0
+
+
+def test_events_run_their_actions_once(conn):
+    conn.execute("""INSERT INTO automation_rules (name, trigger_type, trigger_conditions, action_type,
+                                                  action_details, is_active)
+                    VALUES ('welcome', 'New Lead', '{}', 'Create Task', '{"task_title": "Welcome"}', 1)""")
+    mark_tables_changed(conn, 'automation_rules')
+    conn.commit()
+    conn.executemany("INSERT INTO customers (name, email, status) VALUES (?, ?, 'Lead')",
+                     [(f"lead{i}", f"lead{i}@x.com") for i in range(5)])
+    conn.execute("INSERT INTO customers (name, email, status) VALUES ('client', 'c@x.com', 'Customer')")
+    conn.commit()
+
+    assert process_automation_events(conn, batch_size=2) == 5
+    assert process_automation_events(conn) == 0
+    assert conn.execute("SELECT COUNT(*) FROM tasks WHERE title = 'Welcome'").fetchone()[0] == 5
+    assert conn.execute("SELECT COUNT(*) FROM automation_runs WHERE status = 'done'").fetchone()[0] == 5
@@ -0,0 +1,65 @@
+import pytest
+
+from crm5 import fetch_customers_page
+
+
+@pytest.fixture
+def customers(conn):
+    statuses = ['Lead', 'Customer', 'Inactive']
+    conn.executemany("INSERT INTO customers (name, email, status) VALUES (?, ?, ?)",
+                     [(f"name{i}", f"user{i}@example.com", statuses[i % 3]) for i in range(1, 31)])
+    conn.executemany("INSERT INTO customers (name, email, status) VALUES (?, ?, 'Lead')",
+                     [("100% real", "pct@example.com"), ("under_score", "us@example.com")])
+    conn.commit()
+    return conn
+
+
+def all_pages(conn, page_size, **filters):
+    pages, after_id = [], 0
+    while True:
+        page = fetch_customers_page(conn, page_size=page_size, after_id=after_id, **filters)
+        pages.append(list(page['rows']['id']))
+        after_id = page['last_id']
+        if not page['has_next']:
+            return pages, page['total']
+
+
+def test_pages_cover_every_row_once_in_id_order(customers):
+    pages, total = all_pages(customers, 10)
+    ids = [customer_id for page in pages for customer_id in page]
+    assert ids == list(range(1, 33))
+    assert total == 32
+    assert [len(page) for page in pages] == [10, 10, 10, 2]
+
+
+def test_exact_multiple_of_page_size_has_no_empty_trailing_page(customers):
+    pages, _ = all_pages(customers, 16)
+    assert [len(page) for page in pages] == [16, 16]
+
+
+def test_page_after_the_last_id_is_empty(customers):
+    page = fetch_customers_page(customers, page_size=10, after_id=32)
+    assert page['rows'].empty
+    assert not page['has_next']
+    assert page['last_id'] == 32
+
+
+def test_several_statuses_merge_in_id_order(customers):
+    pages, total = all_pages(customers, 7, statuses=['Inactive', 'Lead'])
+    ids = [customer_id for page in pages for customer_id in page]
+    expected = [row[0] for row in customers.execute(
+        "SELECT id FROM customers WHERE status IN ('Lead', 'Inactive') ORDER BY id")]
+    assert ids == expected
+    assert total == len(expected)
+
+
+def test_status_and_search_combine(customers):
+    page = fetch_customers_page(customers, ['Customer'], "name1", page_size=50)
+    assert list(page['rows']['name']) == ["name1", "name10", "name13", "name16", "name19"]
+    assert page['total'] == 5
+
+
+@pytest.mark.parametrize("search, name", [("100%", "100% real"), ("r_s", "under_score")])
+def test_search_treats_like_wildcards_literally(customers, search, name):
+    page = fetch_customers_page(customers, search=search, page_size=50)
+    assert list(page['rows']['name']) == [name]
@@ -0,0 +1,113 @@
+import asyncio
+import smtplib
+import time
+
+import pytest
+
+from crm5 import EmailOutboxWorker, outbox_status, queue_emails
+
+
+class FakeSMTP:
+    """Stands in for SMTPConnectionPool; errors are looked up by recipient"""
+
+    def __init__(self, errors=None):
+        self.errors = errors or {}
+        self.sent = []
+
+    async def send(self, message):
+        error = self.errors.get(message['To'])
+        if error is None:
+            self.sent.append(message['To'])
+        return error
+
+
+@pytest.fixture
+def worker(conn):
+    return EmailOutboxWorker("client_databases", {'sender': 'crm@example.com'},
+                             max_attempts=3, backoff=60)
+
+
+def deliver(worker, conn, smtp):
+    return asyncio.run(worker._deliver_batch(conn, smtp))
+
+
+def outbox(conn):
+    return conn.execute("""SELECT o.to_email, o.attempts, o.next_attempt_at, o.locked_until, l.status
+                           FROM email_outbox o JOIN communication_logs l ON l.id = o.log_id
+                           ORDER BY o.log_id""").fetchall()
+
+
+def make_due(conn):
+    conn.execute("UPDATE email_outbox SET next_attempt_at = 0 WHERE next_attempt_at IS NOT NULL")
+    conn.commit()
+
+
+def test_queue_skips_missing_and_header_breaking_addresses(conn):
+    queued = queue_emails(conn, [(1, None, "s", "b"), (1, "  ", "s", "b"),
+                                 (1, "a@x.com\nBcc: b@x.com", "s", "b"), (1, " ok@x.com ", "s", "b")])
+    assert queued == 1
+    assert [row[0] for row in outbox(conn)] == ["ok@x.com"]
+
+
+def test_sent_message_leaves_the_outbox(conn, worker):
+    queue_emails(conn, [(1, "ok@x.com", "Hello", "Body")])
+    smtp = FakeSMTP()
+    assert deliver(worker, conn, smtp) == 1
+    assert smtp.sent == ["ok@x.com"]
+    assert outbox(conn) == []
+    assert conn.execute("SELECT status FROM communication_logs").fetchone()[0] == "Sent"
+
+
+def test_transient_error_backs_off_then_fails_after_max_attempts(conn, worker):
+    queue_emails(conn, [(1, "busy@x.com", "Hello", "Body")])
+    smtp = FakeSMTP({"busy@x.com": smtplib.SMTPResponseException(451, b"try later")})
+
+    before = time.time()
+    deliver(worker, conn, smtp)
+    (_, attempts, next_attempt_at, locked_until, status), = outbox(conn)
+    assert (attempts, locked_until, status) == (1, None, "Queued")
+    assert next_attempt_at >= before + 60
+
+    # Not due yet, so nothing is claimed
+    assert deliver(worker, conn, smtp) == 0
+
+    make_due(conn)
+    deliver(worker, conn, smtp)
+    (_, attempts, next_attempt_at, _, _), = outbox(conn)
+    assert attempts == 2
+    assert next_attempt_at >= before + 120
+
+    make_due(conn)
+    deliver(worker, conn, smtp)
+    assert outbox(conn) == [("busy@x.com", 3, None, None, "Failed")]
+    assert outbox_status(conn) == (0, 1)
+
+
+def test_permanent_error_fails_at_once(conn, worker):
+    queue_emails(conn, [(1, "gone@x.com", "Hello", "Body")])
+    refused = smtplib.SMTPRecipientsRefused({"gone@x.com": (550, b"no such user")})
+    deliver(worker, conn, FakeSMTP({"gone@x.com": refused}))
+    assert outbox(conn) == [("gone@x.com", 1, None, None, "Failed")]
+
+
+def test_unbuildable_message_fails_alone(conn, worker):
+    queue_emails(conn, [(1, "ok@x.com", "Hello", "Body")])
+    log_id = conn.execute("INSERT INTO communication_logs (customer_id, type, subject, content, status) "
+                          "VALUES (1, 'Email', 's', 'b', 'Queued')").lastrowid
+    conn.execute("INSERT INTO email_outbox (log_id, to_email, next_attempt_at) VALUES (?, ?, 0)",
+                 (log_id, "bad@x.com\r\nBcc: z@x.com"))
+    conn.commit()
+
+    smtp = FakeSMTP()
+    assert deliver(worker, conn, smtp) == 2
+    assert smtp.sent == ["ok@x.com"]
+    (to_email, _, next_attempt_at, _, status), = outbox(conn)
+    assert (to_email.startswith("bad@x.com"), next_attempt_at, status) == (True, None, "Failed")
+    assert conn.execute("SELECT last_error FROM email_outbox").fetchone()[0].startswith("Invalid message")
+
+
+def test_claimed_messages_are_not_claimed_again(conn, worker):
+    queue_emails(conn, [(1, "ok@x.com", "Hello", "Body")])
+    conn.execute("UPDATE email_outbox SET locked_until = ?", (time.time() + 300,))
+    conn.commit()
+    assert deliver(worker, conn, FakeSMTP()) == 0
@@ -0,0 +1,58 @@
+import io
+
+import pytest
+
+from crm5 import import_csv
+
+MAPPING = {'Name': 'name', 'Email': 'email', 'Status': 'status'}
+
+
+def csv_file(*rows):
+    return io.BytesIO("\n".join(["Name,Email,Status", *rows]).encode())
+
+
+def test_inserts_new_rows(conn):
+    result = import_csv(conn, csv_file("A,a@x.com,Lead", "B,b@x.com,Customer"), 'customers', MAPPING)
+    assert (result['inserted'], result['updated'], result['written']) == (2, 0, 2)
+    assert conn.execute("SELECT COUNT(*) FROM customers").fetchone()[0] == 2
+
+
+def test_skip_mode_counts_existing_keys_as_duplicates(conn):
+    import_csv(conn, csv_file("A,a@x.com,Lead"), 'customers', MAPPING)
+    result = import_csv(conn, csv_file("A2,a@x.com,Customer", "B,b@x.com,Lead"), 'customers', MAPPING)
+    assert (result['inserted'], result['updated'], result['duplicates']) == (1, 0, 1)
+    assert conn.execute("SELECT name FROM customers WHERE email = 'a@x.com'").fetchone()[0] == "A"
+
+
+def test_update_mode_separates_updates_from_inserts(conn):
+    import_csv(conn, csv_file("A,a@x.com,Lead", "B,b@x.com,Lead"), 'customers', MAPPING)
+    result = import_csv(conn, csv_file("A2,a@x.com,Customer", "C,c@x.com,Lead", "B2,b@x.com,Lead"),
+                        'customers', MAPPING, on_duplicate='update')
+    assert (result['inserted'], result['updated'], result['written']) == (1, 2, 3)
+    assert result['duplicates'] == 0
+    assert conn.execute("SELECT name, status FROM customers WHERE email = 'a@x.com'").fetchone() == ("A2", "Customer")
+
+
+def test_update_mode_counts_key_repeated_within_a_chunk(conn):
+    result = import_csv(conn, csv_file("A,a@x.com,Lead", "A2,a@x.com,Customer"),
+                        'customers', MAPPING, on_duplicate='update')
+    assert (result['inserted'], result['updated']) == (1, 1)
+    assert conn.execute("SELECT name FROM customers").fetchall() == [("A2",)]
+
+
+def test_update_mode_counts_across_chunks(conn):
+    rows = [f"N{i},u{i}@x.com,Lead" for i in range(5)] + [f"M{i},u{i}@x.com,Lead" for i in range(3)]
+    result = import_csv(conn, csv_file(*rows), 'customers', MAPPING, chunk_size=2, on_duplicate='update')
+    assert (result['rows'], result['inserted'], result['updated']) == (8, 5, 3)
+
+
+def test_invalid_rows_are_rejected_with_their_line(conn):
+    result = import_csv(conn, io.BytesIO(b"Customer,Amount\n1,100\n1,lots\n1,250.5\n"), 'deals',
+                        {'Customer': 'customer_id', 'Amount': 'amount'})
+    assert (result['inserted'], result['rejected']) == (2, 1)
+    assert [line for line, _ in result['errors']] == [3]
+
+
+def test_unmapped_required_column_raises(conn):
+    with pytest.raises(ValueError):
+        import_csv(conn, csv_file("A,a@x.com,Lead"), 'customers', {'Email': 'email'})
@@ -0,0 +1,22 @@
+import sqlite3
+
+from crm5 import SQLITE_PERFORMANCE_PROFILE, apply_sqlite_profile, get_sqlite_settings
+
+
+def test_profile_is_applied_and_reported(tmp_path):
+    conn = apply_sqlite_profile(sqlite3.connect(str(tmp_path / "client.db")))
+    settings = get_sqlite_settings(conn)
+    assert set(settings) == set(SQLITE_PERFORMANCE_PROFILE)
+    # mmap_size is capped by how SQLite was compiled, so only the rest is exact
+    assert settings.pop('mmap_size') >= 0
+    assert settings == {'journal_mode': 'WAL', 'synchronous': 'NORMAL', 'cache_size': -65536,
+                        'temp_store': 'MEMORY', 'busy_timeout': 5000}
+    conn.close()
+
+
+def test_custom_profile_overrides_defaults(tmp_path):
+    profile = dict(SQLITE_PERFORMANCE_PROFILE, synchronous='FULL', busy_timeout=250)
+    conn = apply_sqlite_profile(sqlite3.connect(str(tmp_path / "client.db")), profile)
+    settings = get_sqlite_settings(conn)
+    assert (settings['synchronous'], settings['busy_timeout']) == ('FULL', 250)
+    conn.close()